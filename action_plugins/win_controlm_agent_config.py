@@ -0,0 +1,634 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Informatique CDC. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""Action plugin of the win_controlm_agent_config module.
+
+Consecutive win_controlm_agent_config tasks of the same block are merged into a single
+remote execution. The first task runs the module with the settings of all the merged
+tasks, keeps its own share of the result and stores the share of each following task in
+a host fact. When a following task runs, it returns its stored share without contacting
+the host.
+
+The arguments of each task are first checked against the options documented in the stub
+of the module and the constraints of its settings table, read by the
+win_controlm_agent_config_options file of the role module_utils, so that an invalid argument
+fails the task without contacting the host.
+
+With trust_cached_facts_for, a task whose settings match the controlm_agent fact cached for
+the host returns without contacting the host while the fact is recent enough.
+"""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import calendar
+import copy
+import json
+import os
+import re
+import sys
+import time
+
+from ansible.module_utils.six import integer_types, string_types
+from ansible.module_utils._text import to_text
+from ansible.plugins.action import ActionBase
+
+try:
+    from ansible import context
+except ImportError:  # Ansible < 2.8
+    context = None
+
+# The documentation of the module is read by a file of the role module_utils, shared with the
+# compliance tool. Ansible only ships the module utils to the modules, it is imported from its path.
+MODULE_UTILS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module_utils')
+if MODULE_UTILS_PATH not in sys.path:
+    sys.path.append(MODULE_UTILS_PATH)
+import win_controlm_agent_config_options as documentation  # noqa: E402
+
+MODULE_NAME = 'win_controlm_agent_config'
+
+# Fact holding the results of the tasks merged into a previous task, indexed by task UUID.
+# The fact is the only way to pass them to the following tasks, which run in other worker
+# processes. It is emptied once the last merged task has taken its result.
+BATCH_FACT = '_win_controlm_agent_config_batch'
+
+# Attributes of the tasks which must be the same for them to be merged into one execution
+EXECUTION_ATTRIBUTES = (
+    'check_mode',
+    'diff',
+    'ignore_errors',
+    'become',
+    'become_user',
+    'become_method',
+    'environment',
+    'delegate_to',
+    'notify',
+    'no_log',
+    'async_val',
+    'poll',
+    'timeout',
+)
+
+# Options which do not define a setting of the agent. Tasks are merged only if they share
+# the same values for these options.
+CONTROL_OPTIONS = frozenset([
+    'firewall_rule_group',
+    'firewall_rule_name',
+    'connectivity_timeout',
+    'diagnostic_duration',
+    'instances',
+    'log_usage_timeout',
+    'merge_tasks',
+    'mode',
+    'plan',
+    'profile',
+    'report_log_usage',
+    'restart',
+    'restart_timeout',
+    'return_config',
+    'settings',
+    'tuning_profile',
+    'trust_cached_facts_for',
+    'tuning_profiles',
+    'verify',
+    'verify_connectivity',
+])
+
+# Fact holding the configuration of each agent instance returned by the module, indexed by instance name
+FACT = 'controlm_agent'
+
+# Options which need the host even when its configuration is known
+HOST_OPTIONS = ('diagnostic_duration', 'report_log_usage', 'tuning_profile')
+
+# Timestamps of the module, in the round-trip format of .NET
+TIMESTAMP_PATTERN = re.compile(r'^(?P<seconds>\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?P<fraction>\.\d+)?Z$')
+
+# Options whose entries accept the settings of the agent along with their own suboptions
+SETTING_CONTAINERS = frozenset(['instances', 'settings', 'tuning_profiles'])
+
+# Values accepted as booleans by Ansible.Basic
+BOOLEANS_TRUE = frozenset(['y', 'yes', 'on', '1', 'true', 't', '1.0'])
+BOOLEANS_FALSE = frozenset(['n', 'no', 'off', '0', 'false', 'f', '0.0'])
+
+_options = None
+
+
+class ArgumentError(ValueError):
+    """Raised when an argument of a task does not match the documented options."""
+
+
+def parse_options(documented, table):
+    """Returns the documented options with their constraints, the setting containers accepting every setting."""
+    options = documentation.parse_options(documented, table)
+
+    # Like the argument spec of the module, the entries of these options accept every setting
+    settings = dict((name, option) for name, option in options.items() if name not in CONTROL_OPTIONS)
+    for name in SETTING_CONTAINERS & set(options):
+        options[name]['suboptions'] = dict(settings, **options[name].get('suboptions', {}))
+    return options
+
+
+def load_options(path=documentation.STUB_PATH, settings_path=documentation.SETTINGS_PATH):
+    """Reads the options from the DOCUMENTATION of the module stub and their constraints from the settings table."""
+    try:
+        table = documentation.load_settings_table(settings_path, documentation.load_documented_settings(path))
+        return parse_options(documentation.load_stub_variable('DOCUMENTATION', path)['options'], table)
+    except documentation.DocumentationError as error:
+        raise ArgumentError(to_text(error))
+
+
+def get_options():
+    """Returns the documented options, read once per controller process, or None without a stub."""
+    global _options
+    if _options is None and os.path.exists(documentation.STUB_PATH):
+        _options = load_options()
+    return _options
+
+
+def format_context(message, context):
+    if context:
+        message += ' found in %s' % ' -> '.join(context)
+    return message
+
+
+def convert_value(name, value, option_type, context):
+    """Converts an argument like Ansible.Basic does, raising an ArgumentError if it cannot be converted."""
+    try:
+        if option_type == 'bool':
+            if isinstance(value, bool):
+                return value
+            text = to_text(value).lower().strip()
+            if text in BOOLEANS_TRUE:
+                return True
+            if text in BOOLEANS_FALSE:
+                return False
+            raise ValueError("The value '%s' is not a valid boolean. Valid booleans include: %s"
+                             % (text, ', '.join(sorted(BOOLEANS_TRUE) + sorted(BOOLEANS_FALSE))))
+        if option_type == 'int':
+            if isinstance(value, bool):
+                raise ValueError('a boolean is not an integer')
+            if isinstance(value, integer_types):
+                return value
+            return int(to_text(value))
+        if option_type == 'dict':
+            if isinstance(value, dict):
+                return value
+            if isinstance(value, string_types) and value.startswith('{') and value.endswith('}'):
+                return json.loads(value)
+            if isinstance(value, string_types) and '=' in value:
+                # The key=value form is parsed by the module only
+                return None
+            raise ValueError('the value cannot be converted to a dict, it must either be a JSON string or in the key=value form')
+        if option_type == 'list':
+            if isinstance(value, list):
+                return value
+            if isinstance(value, string_types):
+                return [item.strip() for item in value.split(',')]
+            if isinstance(value, integer_types):
+                return [value]
+            raise ValueError('the value cannot be converted to a list')
+    except ValueError as error:
+        raise ArgumentError(format_context('argument for %s is of type %s and we were unable to convert to %s: %s'
+                                           % (name, type(value), option_type, error), context))
+    return value if isinstance(value, string_types) else to_text(value)
+
+
+def check_arguments(args, options, context=()):
+    """Checks arguments against options, as the argument spec of the module would.
+
+    Raises an ArgumentError for an unsupported argument, a value which cannot be converted
+    to the type of its option or which is not one of its choices, out of its range or too
+    long, or a missing required argument. Returns the converted arguments indexed by option
+    name, without the null ones.
+    """
+    names = {}
+    for name, option in options.items():
+        for legal_name in [name] + option['aliases']:
+            names[legal_name.lower()] = name
+    unsupported = [name for name in args if name.lower() not in names]
+    if unsupported:
+        raise ArgumentError('%s. Supported parameters include: %s' % (
+            format_context('Unsupported parameters for (%s) module: %s' % (MODULE_NAME, ', '.join(sorted(unsupported))), context),
+            ', '.join(sorted(set(names.values()) | set(alias for option in options.values() for alias in option['aliases'])))))
+
+    converted = {}
+    for arg_name, value in args.items():
+        name = names[arg_name.lower()]
+        option = options[name]
+        if value is None:
+            continue
+        value = convert_value(name, value, option['type'], context)
+        if value is None:
+            continue
+        if option['choices'] is not None:
+            values = value if option['type'] == 'list' else [value]
+            choices = [to_text(choice) for choice in option['choices']]
+            no_match = [to_text(item) for item in values if to_text(item).lower() not in [choice.lower() for choice in choices]]
+            if no_match:
+                raise ArgumentError(format_context('value of %s must be %s: %s. Got no match for: %s' % (
+                    name, 'one or more of' if option['type'] == 'list' else 'one of', ', '.join(choices), ', '.join(no_match)), context))
+        if 'min' in option and not option['min'] <= value <= option['max']:
+            raise ArgumentError(format_context('value of %s must be between %d and %d, got: %s' % (name, option['min'], option['max'], value), context))
+        if 'max_length' in option and len(value) > option['max_length']:
+            raise ArgumentError(format_context('value of %s must not exceed %d characters, got: %d' % (name, option['max_length'], len(value)), context))
+        if 'suboptions' in option:
+            entries = value if option['type'] == 'list' else [value]
+            value = [check_arguments(entry, option['suboptions'], tuple(context) + (name,)) if isinstance(entry, dict) else entry for entry in entries]
+            if option['type'] != 'list':
+                value = value[0]
+        converted[name] = value
+
+    missing = sorted(name for name, option in options.items() if option['required'] and name not in converted)
+    if missing:
+        raise ArgumentError(format_context('missing required arguments: %s' % ', '.join(missing), context))
+    return converted
+
+
+def check_requirements(settings, options, context=()):
+    """Raises an ArgumentError if a setting requires another setting which is set to another value."""
+    for name, value in settings.items():
+        if 'requires' not in options.get(name, {}) or value in (None, ''):
+            continue
+        required_name, required_value = options[name]['requires']
+        if required_name in settings and to_text(settings[required_name]).lower() != required_value.lower():
+            raise ArgumentError(format_context('value of %s requires %s to be %s, got: %s'
+                                               % (name, required_name, required_value, settings[required_name]), context))
+
+
+def validate_arguments(args, options):
+    """Checks the arguments of a task against the documented options and the constraints between settings.
+
+    Returns the converted arguments, see check_arguments.
+    """
+    converted = check_arguments(args, options)
+    settings = get_task_settings(converted)
+    check_requirements(settings, options)
+    for instance in converted.get('instances') or []:
+        if isinstance(instance, dict):
+            instance_settings = dict(settings, **dict((name, value) for name, value in instance.items() if name not in ('name', 'service_name')))
+            check_requirements(instance_settings, options, ('instances', to_text(instance.get('name'))))
+    for profile in converted.get('tuning_profiles') or []:
+        if isinstance(profile, dict):
+            check_requirements(profile, options, ('tuning_profiles', to_text(profile.get('name'))))
+    return converted
+
+
+def parse_timestamp(text):
+    """Returns the seconds since the epoch of a UTC timestamp of the module, or None if it cannot be parsed."""
+    match = TIMESTAMP_PATTERN.match(text) if isinstance(text, string_types) else None
+    if match is None:
+        return None
+    return calendar.timegm(time.strptime(match.group('seconds'), '%Y-%m-%dT%H:%M:%S')) + float(match.group('fraction') or 0)
+
+
+def is_known_compliant(entry, settings, now, max_age):
+    """Tests if a cached fact entry, collected less than max_age seconds ago, holds the desired settings.
+
+    An entry collected by a run which wrote to the registry, with a pending restart or past the
+    restore of time-limited diagnostic settings is not trusted.
+    """
+    if not isinstance(entry, dict) or entry.get('written') or entry.get('restart_required'):
+        return False
+    collected = parse_timestamp(entry.get('collected'))
+    if collected is None or abs(now - collected) > max_age:
+        return False
+    if entry.get('expires') is not None:
+        expires = parse_timestamp(entry['expires'])
+        if expires is None or expires <= now:
+            return False
+    config = entry.get('config') or {}
+    for name, value in settings.items():
+        if name not in config:
+            return False
+        # The module compares the text values without case
+        if isinstance(value, string_types):
+            if to_text(config[name]).lower() != value.lower():
+                return False
+        elif config[name] != value:
+            return False
+    return True
+
+
+def get_cached_result(args, facts, now, keep_diff):
+    """Returns the result of a task from the controlm_agent fact cached for the host.
+
+    Returns None if the host must be contacted: trust_cached_facts_for is not set, an option
+    needs the host, an instance has no cached entry or its entry is not known to hold the
+    desired settings.
+    """
+    max_age = args.get('trust_cached_facts_for')
+    if not max_age or not isinstance(facts, dict):
+        return None
+    if args.get('mode', 'enforce') != 'enforce' or args.get('verify_connectivity', 'none') != 'none' or any(args.get(name) for name in HOST_OPTIONS):
+        return None
+
+    settings = get_task_settings(args)
+    if args.get('instances'):
+        targets = []
+        for instance in args['instances']:
+            # The instances installed since the facts were cached are unknown
+            if not isinstance(instance, dict) or instance.get('name') == 'all' or instance.get('name') not in facts:
+                return None
+            instance_settings = dict((name, value) for name, value in instance.items() if name not in ('name', 'service_name'))
+            targets.append((instance['name'], dict(settings, **instance_settings)))
+    else:
+        names = [name for name, entry in facts.items() if isinstance(entry, dict) and entry.get('default_instance')]
+        if len(names) != 1:
+            return None
+        targets = [(names[0], settings)]
+    if not all(is_known_compliant(facts[name], target_settings, now, max_age) for name, target_settings in targets):
+        return None
+
+    instance_results = {}
+    for name, dummy in targets:
+        instance_result = {'changed': False, 'restart_required': False}
+        if keep_diff:
+            instance_result['diff'] = {'before': {}, 'after': {}}
+        return_config = args.get('return_config', 'full')
+        if return_config == 'full':
+            instance_result['config'] = copy.deepcopy(facts[name]['config'])
+        elif return_config == 'changed':
+            instance_result['config'] = {}
+        instance_results[name] = instance_result
+
+    if args.get('instances'):
+        result = {'changed': False, 'restart_required': False, 'instances': instance_results}
+        if keep_diff:
+            result['diff'] = {'before': dict((name, {}) for name in instance_results), 'after': dict((name, {}) for name in instance_results)}
+    else:
+        result = instance_results[targets[0][0]]
+    result['from_cached_facts'] = True
+    return result
+
+
+def merge_facts(module_result, facts):
+    """Adds the entries of the controlm_agent fact returned by the module to the cached entries.
+
+    The fact returned by the module holds only the configured instances and would otherwise
+    replace the entries of the other instances.
+    """
+    returned = (module_result.get('ansible_facts') or {}).get(FACT)
+    if not isinstance(returned, dict):
+        return None
+    merged = dict(facts) if isinstance(facts, dict) else {}
+    merged.update(returned)
+    return merged
+
+
+def is_fully_converted(args, converted):
+    """Tests if the converted arguments of a task hold all its arguments.
+
+    The settings dictionary in the key=value form is only parsed by the module, the
+    settings of such a task are not known on the controller.
+    """
+    return args.get('settings') is None or 'settings' in converted
+
+
+def get_task_settings(args):
+    """Returns the settings defined by the arguments of a task, the options taking precedence over the settings dictionary.
+
+    The arguments are the ones converted by validate_arguments, indexed by option name.
+    """
+    settings = dict(args.get('settings') or {})
+    settings.update((name, value) for name, value in args.items() if name not in CONTROL_OPTIONS)
+    return settings
+
+
+def get_control_options(args):
+    """Returns the options of a task which do not define a setting."""
+    return dict((name, value) for name, value in args.items() if name in CONTROL_OPTIONS and name not in ('settings', 'merge_tasks'))
+
+
+def merge_task_settings(task_settings):
+    """Merges the settings of several tasks.
+
+    Returns None if two tasks define different values for the same setting, as the
+    intermediate value would never be written.
+    """
+    merged = {}
+    for settings in task_settings:
+        for name, value in settings.items():
+            if name in merged and merged[name] != value:
+                return None
+            merged[name] = value
+    return merged
+
+
+def split_result(result, task_settings, keep_diff):
+    """Splits the result of the merged execution into one result per task.
+
+    The diff of a setting goes to the task defining it. The changes which do not belong to
+    any task, such as firewall rules or a pending restart, go to the first task.
+    """
+    diff = result.get('diff') or {}
+    before = diff.get('before') or {}
+    after = diff.get('after') or {}
+    owned = set()
+    for settings in task_settings[1:]:
+        owned.update(settings)
+
+    results = []
+    for index, settings in enumerate(task_settings):
+        if index == 0:
+            names = [name for name in after if name in settings or name not in owned]
+        else:
+            names = [name for name in after if name in settings]
+        task_result = dict((key, value) for key, value in result.items() if key not in ('changed', 'diff', 'ansible_facts'))
+        if index > 0:
+            # The timings of the execution are reported once, by the first task
+            task_result.pop('timings', None)
+        task_result['changed'] = bool(names)
+        if keep_diff:
+            task_result['diff'] = {
+                'before': dict((name, before.get(name)) for name in names),
+                'after': dict((name, after[name]) for name in names),
+            }
+        results.append(task_result)
+
+    if result.get('changed') and not any(task_result['changed'] for task_result in results):
+        results[0]['changed'] = True
+    return results
+
+
+def get_execution_context(task):
+    """Returns the attributes of a task which must be the same for the tasks merged into one execution."""
+    return [getattr(task, name, None) for name in EXECUTION_ATTRIBUTES]
+
+
+def split_batch(batch, uuid):
+    """Returns the result stored for a merged task, and the batch left for the following merged tasks.
+
+    The result is None if the task was not merged into a previous task. The batch left is then
+    empty: the merged tasks directly follow the task which ran them, any other stored result is
+    stale.
+    """
+    batch = dict(batch or {})
+    if uuid not in batch:
+        return None, {}
+    return batch.pop(uuid), batch
+
+
+class ActionModule(ActionBase):
+
+    TRANSFERS_FILES = False
+
+    def _get_following_tasks(self):
+        """Returns the tasks following the current task in its block."""
+        parent = getattr(self._task, '_parent', None)
+        tasks = getattr(parent, 'block', None) or []
+        for index, task in enumerate(tasks):
+            if getattr(task, '_uuid', None) == self._task._uuid:
+                return tasks[index + 1:]
+        return []
+
+    def _is_mergeable(self, task, task_vars):
+        """Tests if a following task can run within the current task."""
+        if task.action != self._task.action:
+            return False
+        if task.when or task.loop or task.loop_with or task.until or task.vars or task.run_once:
+            return False
+        if get_execution_context(task) != get_execution_context(self._task):
+            return False
+        if context is not None:
+            only_tags = context.CLIARGS.get('tags')
+            skip_tags = context.CLIARGS.get('skip_tags')
+            if (only_tags or skip_tags) and not task.evaluate_tags(only_tags, skip_tags, all_vars=task_vars):
+                return False
+        return True
+
+    def _validate_arguments(self, args):
+        """Returns the error message of the first invalid argument and the converted arguments.
+
+        The error message is None if the arguments are valid. The converted arguments are None
+        if the arguments are invalid or cannot be checked, without the stub of the module.
+        """
+        options = get_options()
+        if options is None:
+            return None, None
+        try:
+            return None, validate_arguments(args, options)
+        except ArgumentError as error:
+            return to_text(error), None
+
+    def _get_cached_result(self, converted, task_vars):
+        """Returns the result of the task from the cached facts of the host, or None if the host must be contacted."""
+        if converted is None or not converted.get('trust_cached_facts_for'):
+            return None
+        facts = (task_vars.get('ansible_facts') or {}).get(FACT)
+        return get_cached_result(converted, facts, time.time(), self._task.diff)
+
+    def _get_merged_tasks(self, args, converted, task_vars):
+        """Returns the following tasks to merge with their converted arguments.
+
+        The settings of the tasks are compared by option name, once their aliases, case and
+        types are converted like the module would.
+        """
+        if converted is None or not is_fully_converted(args, converted):
+            return []
+        # A plan is made and applied for the settings of a single task
+        if not converted.get('merge_tasks', True) or converted.get('instances') or converted.get('mode', 'enforce') != 'enforce':
+            return []
+
+        merged = []
+        control_options = get_control_options(converted)
+        task_settings = [get_task_settings(converted)]
+        for task in self._get_following_tasks():
+            if not self._is_mergeable(task, task_vars):
+                break
+            try:
+                task_args = self._templar.template(task.args)
+            except Exception:
+                break
+            # An invalid task fails on its own
+            error, task_converted = self._validate_arguments(task_args)
+            if error is not None or not is_fully_converted(task_args, task_converted):
+                break
+            if not task_converted.get('merge_tasks', True) or get_control_options(task_converted) != control_options:
+                break
+            if merge_task_settings(task_settings + [get_task_settings(task_converted)]) is None:
+                break
+            task_settings.append(get_task_settings(task_converted))
+            merged.append((task, task_converted))
+        return merged
+
+    def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp  # tmp no longer has any effect
+
+        stored_batch = (task_vars.get('ansible_facts') or {}).get(BATCH_FACT)
+        task_result, batch = split_batch(stored_batch, self._task._uuid)
+        if task_result is not None:
+            result.update(task_result)
+            result['ansible_facts'] = {BATCH_FACT: batch}
+            return result
+
+        args = dict(self._task.args)
+        error, converted = self._validate_arguments(args)
+        if error is not None:
+            result.update(failed=True, msg=error)
+            return result
+
+        cached_result = self._get_cached_result(converted, task_vars)
+        if cached_result is not None:
+            result.update(cached_result)
+            if stored_batch:
+                result.setdefault('ansible_facts', {})[BATCH_FACT] = batch
+            return result
+
+        facts = (task_vars.get('ansible_facts') or {}).get(FACT)
+        merged_tasks = self._get_merged_tasks(args, converted, task_vars)
+        if not merged_tasks:
+            args.pop('merge_tasks', None)
+            args.pop('trust_cached_facts_for', None)
+            module_result = self._execute_module(module_name=MODULE_NAME, module_args=args, task_vars=task_vars)
+            merged_facts = merge_facts(module_result, facts)
+            if merged_facts is not None:
+                module_result['ansible_facts'][FACT] = merged_facts
+            if stored_batch and not module_result.get('failed'):
+                module_result.setdefault('ansible_facts', {})[BATCH_FACT] = batch
+            result.update(module_result)
+            return result
+
+        task_settings = [get_task_settings(converted)] + [get_task_settings(task_converted) for dummy, task_converted in merged_tasks]
+        module_args = get_control_options(converted)
+        module_args.pop('trust_cached_facts_for', None)
+        module_args['settings'] = merge_task_settings(task_settings)
+
+        # The diff is always needed to tell which task changed which setting
+        keep_diff = self._task.diff
+        self._task.diff = True
+        try:
+            module_result = self._execute_module(module_name=MODULE_NAME, module_args=module_args, task_vars=task_vars)
+        finally:
+            self._task.diff = keep_diff
+
+        if module_result.get('failed'):
+            result.update(module_result)
+            return result
+
+        task_results = split_result(module_result, task_settings, keep_diff)
+        for (task, dummy), task_result in zip(merged_tasks, task_results[1:]):
+            batch[task._uuid] = copy.deepcopy(task_result)
+        result.update(task_results[0])
+        result['merged_tasks'] = [task.get_name() for task, dummy in merged_tasks]
+        result['ansible_facts'] = {BATCH_FACT: batch}
+        merged_facts = merge_facts(module_result, facts)
+        if merged_facts is not None:
+            result['ansible_facts'][FACT] = merged_facts
+        return result
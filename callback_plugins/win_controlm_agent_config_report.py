@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Informatique CDC. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""Callback plugin writing the Control-M Agent configurations returned by the play to a file.
+
+Each configuration is written as soon as the result of its host comes in, and only the value
+counts of each setting are kept in memory. At the end of the playbook, the file is read again
+once to find the hosts deviating from the majority value or from a baseline.
+"""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+name: win_controlm_agent_config_report
+type: notification
+short_description: Writes the Control-M Agent configurations of the play to a file and summarizes them
+description:
+    - Writes the C(config) and the C(diff) returned by the M(win_controlm_agent_config) and M(win_controlm_agent_config_info) tasks to a JSON lines or CSV file, as the results come in.
+    - At the end of the playbook, writes a summary with, for each setting, the count of each value, the count of changes and the hosts whose value differs from the value of the majority of the results or from the I(baseline).
+    - The memory used does not depend on the number of hosts. Only the counts of the first I(max_values) values of each setting are kept, and the file is read again once to find the deviating hosts.
+    - A configuration returned several times for the same host, for instance by consecutive tasks, is counted each time.
+    - The result of each item of a looped task is written as its own record. The failed and skipped items are ignored.
+requirements:
+    - enable in configuration, for instance with C(callbacks_enabled = win_controlm_agent_config_report) in the C(defaults) section of C(ansible.cfg)
+options:
+    path:
+        description: Path of the file where the configurations are written.
+        type: path
+        default: controlm_agent_config.jsonl
+        env:
+            - name: WIN_CONTROLM_AGENT_CONFIG_REPORT_PATH
+        ini:
+            - section: callback_win_controlm_agent_config_report
+              key: path
+    format:
+        description:
+            - Format of the file.
+            - With C(jsonl), each line holds the C(host), C(instance), C(task), C(changed), C(config) and C(diff) of a result.
+            - With C(csv), each row holds the C(host), C(instance), C(task), C(setting), C(value), C(changed), C(before) and C(after) of a setting. The values are encoded in JSON.
+        type: str
+        choices: [ jsonl, csv ]
+        default: jsonl
+        env:
+            - name: WIN_CONTROLM_AGENT_CONFIG_REPORT_FORMAT
+        ini:
+            - section: callback_win_controlm_agent_config_report
+              key: format
+    summary_path:
+        description:
+            - Path of the JSON lines file where the summary is written.
+            - Defaults to the I(path) with the C(.summary.jsonl) extension.
+        type: path
+        env:
+            - name: WIN_CONTROLM_AGENT_CONFIG_REPORT_SUMMARY_PATH
+        ini:
+            - section: callback_win_controlm_agent_config_report
+              key: summary_path
+    baseline:
+        description:
+            - Path of a YAML or JSON file holding the desired value of some settings, indexed by setting name.
+            - The hosts whose value differs from the baseline are listed in the summary.
+        type: path
+        env:
+            - name: WIN_CONTROLM_AGENT_CONFIG_REPORT_BASELINE
+        ini:
+            - section: callback_win_controlm_agent_config_report
+              key: baseline
+    max_values:
+        description:
+            - Maximum number of distinct values counted for each setting. The other values are counted together.
+        type: int
+        default: 50
+        env:
+            - name: WIN_CONTROLM_AGENT_CONFIG_REPORT_MAX_VALUES
+        ini:
+            - section: callback_win_controlm_agent_config_report
+              key: max_values
+'''
+
+import csv
+import io
+import json
+import os
+
+from ansible.plugins.callback import CallbackBase
+
+try:
+    import yaml
+except ImportError:  # The baseline is read as JSON only
+    yaml = None
+
+MODULE_NAMES = frozenset(['win_controlm_agent_config', 'win_controlm_agent_config_info'])
+
+CSV_FIELDS = ['host', 'instance', 'task', 'setting', 'value', 'changed', 'before', 'after']
+
+
+def encode_value(value):
+    """Returns the JSON text of a setting value, used to count and compare the values."""
+    return json.dumps(value, sort_keys=True)
+
+
+def get_reports(result):
+    """Returns the instance name, configuration, diff and changed flag of each instance of a module result.
+
+    The result of a looped task holds the result of each item, which are reported one by one
+    but for the failed and skipped items.
+    """
+    if isinstance(result.get('results'), list):
+        return [report for item in result['results'] if isinstance(item, dict) and not item.get('failed') and not item.get('skipped')
+                for report in get_reports(item)]
+    if isinstance(result.get('instances'), dict):
+        return [(name, instance.get('config'), instance.get('diff'), instance.get('changed', False))
+                for name, instance in result['instances'].items()]
+    if 'config' in result or 'diff' in result:
+        return [(None, result.get('config'), result.get('diff'), result.get('changed', False))]
+    return []
+
+
+def get_changed_settings(diff):
+    """Returns the settings changed in a diff, as a dictionary of (before, after) tuples."""
+    diff = diff or {}
+    before = diff.get('before') or {}
+    after = diff.get('after') or {}
+    return dict((name, (before.get(name), value)) for name, value in after.items() if name != 'firewall_rules')
+
+
+class SettingSummary:
+    """Counts the values and the changes of a setting, keeping at most max_values distinct values."""
+
+    def __init__(self, max_values):
+        self.max_values = max_values
+        self.values = {}
+        self.other_values = 0
+        self.records = 0
+        self.changed = 0
+
+    def add(self, encoded_value):
+        self.records += 1
+        if encoded_value in self.values:
+            self.values[encoded_value] += 1
+        elif len(self.values) < self.max_values:
+            self.values[encoded_value] = 1
+        else:
+            self.other_values += 1
+
+    def majority(self):
+        """Returns the encoded value of more than half of the records, or None if there is no such value or no other value."""
+        if not self.values or (len(self.values) == 1 and not self.other_values):
+            return None
+        value = max(self.values, key=lambda value: self.values[value])
+        if self.values[value] * 2 <= self.records:
+            return None
+        return value
+
+
+class ConfigReport:
+    """Writes the configurations to a file as they come in and summarizes them once closed."""
+
+    def __init__(self, path, file_format='jsonl', summary_path=None, baseline=None, max_values=50):
+        self.path = path
+        self.file_format = file_format
+        self.summary_path = summary_path or os.path.splitext(path)[0] + '.summary.jsonl'
+        self.baseline = dict((name, encode_value(value)) for name, value in (baseline or {}).items())
+        self.max_values = max_values
+        self.settings = {}
+        self.records = 0
+        self._file = None
+        self._writer = None
+
+    def _open(self):
+        self._file = io.open(self.path, 'w', encoding='utf-8', newline='')
+        if self.file_format == 'csv':
+            self._writer = csv.DictWriter(self._file, fieldnames=CSV_FIELDS)
+            self._writer.writeheader()
+
+    def _get_setting(self, name):
+        if name not in self.settings:
+            self.settings[name] = SettingSummary(self.max_values)
+        return self.settings[name]
+
+    def add(self, host, task, result):
+        """Writes the configurations of a module result and counts their values."""
+        for instance, config, diff, changed in get_reports(result):
+            if self._file is None:
+                self._open()
+            config = config or {}
+            changed_settings = get_changed_settings(diff)
+            for name, value in config.items():
+                self._get_setting(name).add(encode_value(value))
+            for name in changed_settings:
+                self._get_setting(name).changed += 1
+            self.records += 1
+
+            if self.file_format == 'csv':
+                for name in sorted(set(config) | set(changed_settings)):
+                    before, after = changed_settings.get(name, (None, None))
+                    self._writer.writerow({
+                        'host': host,
+                        'instance': instance or '',
+                        'task': task,
+                        'setting': name,
+                        'value': encode_value(config[name]) if name in config else '',
+                        'changed': name in changed_settings,
+                        'before': encode_value(before) if name in changed_settings else '',
+                        'after': encode_value(after) if name in changed_settings else '',
+                    })
+            else:
+                record = {'host': host, 'instance': instance, 'task': task, 'changed': changed, 'config': config, 'diff': diff}
+                self._file.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def _read_values(self):
+        """Reads the file again and yields the host, instance, setting and encoded value of each configured setting."""
+        with io.open(self.path, 'r', encoding='utf-8', newline='') as report:
+            if self.file_format == 'csv':
+                for row in csv.DictReader(report):
+                    if row['value'] != '':
+                        yield row['host'], row['instance'] or None, row['setting'], row['value']
+            else:
+                for line in report:
+                    record = json.loads(line)
+                    for name, value in (record.get('config') or {}).items():
+                        yield record['host'], record['instance'], name, encode_value(value)
+
+    def close(self):
+        """Closes the file and writes the summary.
+
+        The summary holds one line per deviating setting of a host, followed by one line per setting.
+        """
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+
+        majorities = dict((name, setting.majority()) for name, setting in self.settings.items())
+        deviations = dict((name, {'majority': 0, 'baseline': 0}) for name in self.settings)
+        with io.open(self.summary_path, 'w', encoding='utf-8') as summary:
+            for host, instance, name, value in self._read_values():
+                for reason, expected in (('majority', majorities.get(name)), ('baseline', self.baseline.get(name))):
+                    if expected is not None and value != expected:
+                        deviations[name][reason] += 1
+                        summary.write(json.dumps({
+                            'host': host,
+                            'instance': instance,
+                            'setting': name,
+                            'value': json.loads(value),
+                            'reason': reason,
+                            'expected': json.loads(expected),
+                        }, sort_keys=True) + '\n')
+
+            for name in sorted(self.settings):
+                setting = self.settings[name]
+                line = {
+                    'setting': name,
+                    'records': setting.records,
+                    'changed': setting.changed,
+                    'values': [{'value': json.loads(value), 'count': count}
+                               for value, count in sorted(setting.values.items(), key=lambda item: -item[1])],
+                    'other_values': setting.other_values,
+                    'deviating_from_majority': deviations[name]['majority'],
+                }
+                if majorities[name] is not None:
+                    line['majority'] = json.loads(majorities[name])
+                if name in self.baseline:
+                    line['baseline'] = json.loads(self.baseline[name])
+                    line['deviating_from_baseline'] = deviations[name]['baseline']
+                summary.write(json.dumps(line, sort_keys=True) + '\n')
+
+
+def load_baseline(path):
+    """Loads the desired values of the settings from a YAML or JSON file."""
+    with io.open(path, 'r', encoding='utf-8') as baseline:
+        if yaml is not None:
+            return yaml.safe_load(baseline) or {}
+        return json.load(baseline)
+
+
+class CallbackModule(CallbackBase):
+
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'notification'
+    CALLBACK_NAME = 'win_controlm_agent_config_report'
+    CALLBACK_NEEDS_ENABLED = True
+    # Ansible < 2.11
+    CALLBACK_NEEDS_WHITELIST = True
+
+    def __init__(self, display=None):
+        super(CallbackModule, self).__init__(display=display)
+        self._report = None
+
+    def set_options(self, task_keys=None, var_options=None, direct=None):
+        super(CallbackModule, self).set_options(task_keys=task_keys, var_options=var_options, direct=direct)
+        baseline_path = self.get_option('baseline')
+        self._report = ConfigReport(
+            path=self.get_option('path'),
+            file_format=self.get_option('format'),
+            summary_path=self.get_option('summary_path'),
+            baseline=load_baseline(baseline_path) if baseline_path else None,
+            max_values=self.get_option('max_values'),
+        )
+
+    def v2_runner_on_ok(self, result):
+        if self._report is None or result._task.action.split('.')[-1] not in MODULE_NAMES:
+            return
+        self._report.add(result._host.get_name(), result._task.get_name(), result._result)
+
+    def v2_playbook_on_stats(self, stats):
+        if self._report is None or not self._report.records:
+            return
+        self._report.close()
+        self._display.display('The Control-M Agent configurations of %d results are written in %s and summarized in %s'
+                              % (self._report.records, self._report.path, self._report.summary_path))
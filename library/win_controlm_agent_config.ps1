@@ -1,274 +1,219 @@
 #!powershell
 
 #AnsibleRequires -CSharpUtil Ansible.Basic
-
-$spec = @{
-    options             = @{
-        agent_to_server_port               = @{ type = "int"; choices = @(1024..65535) }
-        server_to_agent_port               = @{ type = "int"; choices = @(1024..65535) }
-        primary_controlm_server_host       = @{ type = "str" } # do not use IP address
-        authorized_controlm_server_hosts   = @{ type = "str" } # do not use IP address
-        diagnostic_level                   = @{ type = "int"; choices = @(1..4) }
-        communication_trace                = @{ type = "bool" } # (0-OFF|1-ON) : [0]
-        days_to_retain_log_files           = @{ type = "int"; choices = @(1..99) }
-        daily_log_file_enabled             = @{ type = "bool" }
-        tracker_event_port                 = @{ type = "int"; choices = @(1025..65535) }
-        logical_agent_name                 = @{ type = "str" }
-        java_new_ar                        = @{ type = "bool" }
-        persistent_connection              = @{ type = "bool" }
-        allow_comm_init                    = @{ type = "bool" }
-        foreign_language_support           = @{ type = "str"; choices = @('LATIN-1', 'CJK') }
-        ssl                                = @{ type = "bool" }
-        server_agent_protocol_version      = @{ type = "int" }
-        autoedit_inline                    = @{ type = "bool" }
-        listen_to_network_interface        = @{ type = "str" }
-        ctms_address_mode                  = @{ type = "str"; choices = @('', 'IP') }
-        timeout_for_agent_utilities        = @{ type = "int" }
-        tcpip_timeout                      = @{ type = "int"; choices = @(0..999999) }
-        tracker_polling_interval           = @{ type = "int"; choices = @(1..86400) }
-        limit_log_file_size                = @{ type = "int"; choices = @(1..1000) }
-        limit_log_version                  = @{ type = "int"; choices = @(1..99) }
-        measure_usage_day                  = @{ type = "int" }
-        logon_as_user                      = @{ type = "bool" }
-        logon_domain                       = @{ type = "str" }
-        job_children_inside_job_object     = @{ type = "bool" }
-        job_statistics_to_sysout           = @{ type = "bool" }
-        job_output_name                    = @{ type = "str"; choices = @('MEMNAME', 'JOBNAME') }
-        wrap_parameters_with_double_quotes = @{ type = "int"; choices = @(1, 2, 3, 4) }
-        run_user_logon_script              = @{ type = "bool" }
-        cjk_encoding                       = @{ type = "str"; choices = @('', 'UTF-8', 'JAPANESE EUC', 'JAPANESE SHIFT-JIS', 'KOREAN EUC', 'SIMPLIFIED CHINESE GBK', 'SIMPLIFIED CHINESE GB', 'TRADITIONAL CHINESE EUC', 'TRADITIONAL CHINESE BIG') } # (CJK Encoding) Determines the CJK encoding used by Control-M/Agent to run jobs.
-        default_printer                    = @{ type = "str" }
-        echo_job_commands_into_sysout      = @{ type = "bool" }
-        smtp_server_relay_name             = @{ type = "bool" }
-        smtp_port                          = @{ type = "int"; choices = @(0..65535) }
-        smtp_sender_mail                   = @{ type = "str" }
-        smtp_sender_friendly_name          = @{ type = "str" }
-        smtp_reply_to_mail                 = @{ type = "str" }
-    }
-    supports_check_mode = $true
+#Requires -Module Ansible.ModuleUtils.ControlMAgent
+
+$AgentRegistryPath = Get-ControlMRegistryPath
+
+# Registry key and Windows service of the agent instance being configured, see Select-ControlMInstance.
+# They live in the script scope, where Select-ControlMInstance updates them.
+$script:InstanceRegistryPath = $AgentRegistryPath
+$script:ServiceName = 'ctmag'
+
+# Elapsed milliseconds of each phase and call counts, returned in timings with the profile option
+$ModuleStopwatch = [System.Diagnostics.Stopwatch]::StartNew()
+$PhaseStopwatch = [System.Diagnostics.Stopwatch]::StartNew()
+$script:Timings = [ordered]@{
+    spec_ms                  = 0
+    snapshot_ms              = 0
+    connectivity_ms          = 0
+    compare_ms               = 0
+    write_ms                 = 0
+    firewall_ms              = 0
+    restart_ms               = 0
+    report_ms                = 0
+    log_usage_ms             = 0
+    total_ms                 = 0
+    registry_reads           = 0
+    registry_writes          = 0
+    firewall_filters_scanned = 0
 }
 
-# All entries to REG_SZ type
-$configuration = @{
-    agent_to_server_port               = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'ATCMNDATA' ; Default = '7005' }
-    server_to_agent_port               = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'AGCMNDATA' ; Default = '7006' }
-    primary_controlm_server_host       = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'CTMSHOST' ; Default = '' }
-    authorized_controlm_server_hosts   = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'CTMPERMHOSTS' ; Default = '' }
-    diagnostic_level                   = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'DBGLVL'; Default = '0' }
-    communication_trace                = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'COMM_TRACE'; Default = '0' }
-    days_to_retain_log_files           = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'LOGKEEPDAYS'; Default = '1' }
-    daily_log_file_enabled             = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'AG_LOG_ON'; Default = 'Y' }
-    tracker_event_port                 = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'TRACKER_EVENT_PORT'; Default = '7035' }
-    logical_agent_name                 = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'LOGICAL_AGENT_NAME' ; Default = "$env:COMPUTERNAME" }
-    java_new_ar                        = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'JAVA_AR' ; Default = 'N' }
-    persistent_connection              = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'PERSISTENT_CONNECTION'; Default = 'N' }
-    allow_comm_init                    = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'ALLOW_COMM_INIT'; Default = 'Y' }
-    foreign_language_support           = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'I18N'; Default = 'LATIN-1' }
-    ssl                                = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'COMMOPT'; Default = 'SSL=N' }
-    server_agent_protocol_version      = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'PROTOCOL_VERSION'; Default = '12' }
-    autoedit_inline                    = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'USE_JOB_VARIABLES'; Default = 'Y' }
-    listen_to_network_interface        = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'LISTEN_INTERFACE'; Default = '*ANY' }
-    ctms_address_mode                  = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'CTMS_ADDR_MODE'; Default = '' }
-    timeout_for_agent_utilities        = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'UTTIMEOUT'; Default = '600' }
-    tcpip_timeout                      = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'TCP_IP_TIMEOUT'; Default = '60' }
-    tracker_polling_interval           = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'EVENT_TIMEOUT' ; Default = '60' }
-    limit_log_file_size                = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'LIMIT_LOG_FILE_SIZE'; Default = '10' }
-    limit_log_version                  = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'LIMIT_LOG_VERSIONS'; Default = '10' }
-    measure_usage_day                  = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'MEASURE_USAGE_DAYS'; Default = '7' }
-    logon_as_user                      = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\WIN' ; Name = 'LOGON_AS_USER'; Default = 'N' }
-    logon_domain                       = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\WIN' ; Name = 'DOMAIN'; Default = '' }
-    job_children_inside_job_object     = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\WIN' ; Name = 'JOB_WAIT'; Default = 'Y' }
-    add_job_statistics_to_sysout       = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\WIN' ; Name = 'JOB_STATISTIC'; Default = 'Y' }
-    job_output_name                    = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\WIN' ; Name = 'OUTPUT_NAME'; Default = 'MEMNAME' }
-    wrap_parameters_with_double_quotes = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\WIN' ; Name = 'WRAP_PARAM_QUOTES'; Default = '4' }
-    run_user_logon_script              = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\WIN' ; Name = 'RUN_USER_LOGON_SCRIPT'; Default = 'N' }
-    cjk_encoding                       = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\WIN' ; Name = 'APPLICATION_LOCALE'; Default = '' }
-    default_printer                    = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\WIN' ; Name = 'DFTPRT'; Default = '' }
-    echo_job_commands_into_sysout      = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\WIN' ; Name = 'ECHO_OUTPUT'; Default = 'Y' }
-    smtp_server_relay_name             = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\WIN' ; Name = 'SMTP_SERVER_NAME'; Default = '' }
-    smtp_port                          = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\WIN' ; Name = 'SMTP_PORT_NUMBER'; Default = '25' }
-    smtp_sender_mail                   = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\WIN' ; Name = 'SMTP_SENDER_EMAIL'; Default = 'control@m' }
-    smtp_sender_friendly_name          = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\WIN' ; Name = 'SMTP_SENDER_FRIENDLY_NAME'; Default = '' }
-    smtp_reply_to_mail                 = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\WIN' ; Name = 'SMTP_REPLY_TO_EMAIL'; Default = '' }
-    default_agent_name                 = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent' ; Name = 'DEFAULT_AGENT'; Default = '' }
-    cm_type                            = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\WIN' ; Name = 'APPLICATION_VERSION'; Default = '' }
-    cm_name                            = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'CM_APPL_TYPE'; Default = '' }
-    agent_version                      = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'CODE_VERSION'; Default = '' }
-    fd_number                          = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'FD_NUMBER'; Default = '' }
-    fix_number                         = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'FIX_NUMBER'; Default = '' }
-    agent_directory                    = @{ Path = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent\CONFIG' ; Name = 'AGENT_DIR'; Default = '' }
-}
-
-function Get-ModuleParameter {
-    <#
-    .SYNOPSIS
-    Removes defined parameter values from a passed $PSBoundParameters object
-
-    .DESCRIPTION
-    When passed a $PSBoundParameters hashtable, this function removes standard parameters
-    (like Verbose/Confirm etc) and returns the passed object with only the non-standard
-    parameters left in place.
-
-    .PARAMETER Parameters
-    This is the input object from which to remove the default set of parameters.
-    It is intended to accept the $PSBoundParameters object from another function.
-
-    .PARAMETER ParametersToRemove
-    Accepts an array of any additional parameter keys which should be removed from the passed input
-    object. Specifying additional parameter names/keys here means that the default value assigned
-    to the BaseParameters parameter will remain unchanged.
-
-    .EXAMPLE
-    $PSBoundParameters | Get-ModuleParameter
-
-    .EXAMPLE
-    Get-ModuleParameter -Parameters $PSBoundParameters -ParametersToRemove param1,param2
-
-    .INPUTS
-    $PSBoundParameters object
-
-    .OUTPUTS
-    Hashtable/$PSBoundParameters object, with defined parameters removed.
-    #>
-    [System.Diagnostics.CodeAnalysis.SuppressMessageAttribute('PSUseDeclaredVarsMoreThanAssignments', 'FilteredParameters', Justification = "False Positive")]
-    [CmdletBinding()]
-    [OutputType('System.Collections.Hashtable')]
-    param(
-        [parameter(
-            Position = 0,
-            Mandatory = $true,
-            ValueFromPipeline = $true)]
-        [Hashtable]$Parameters,
-
-        [parameter(
-            Mandatory = $false)]
-        [array]$ParametersToRemove = @()
-
-    )
-
-    BEGIN {
-
-        $BaseParameters = [Collections.Generic.List[String]]@(
-            [System.Management.Automation.PSCmdlet]::CommonParameters +
-            [System.Management.Automation.PSCmdlet]::OptionalCommonParameters
-        )
+# Configuration of each instance returned in the controlm_agent fact, see Get-ControlMInstanceResult
+$script:Facts = [ordered]@{ }
+
+# Registry value of the agent key recording when a restart has been deferred
+$RestartPendingName = 'ANSIBLE_RESTART_PENDING'
+
+# Registry value of the agent key recording the hash of the CONFIG and WIN registry values and
+# the hashes of the desired settings verified against them, see Test-ControlMFingerprint
+$FingerprintName = 'ANSIBLE_CONFIG_FINGERPRINT'
+$FingerprintLimit = 16
+
+# Version of the plan returned with mode=plan, a plan of another version is rejected with mode=apply
+$PlanVersion = 1
+
+# Registry value of the agent key recording the values to restore when a time-limited diagnostic ends,
+# and the settings which can be time-limited with the diagnostic_duration option
+$DiagnosticRevertName = 'ANSIBLE_DIAGNOSTIC_REVERT'
+$DiagnosticSettings = @('diagnostic_level', 'communication_trace')
+
+# Settings of the Control-M Agent, see Ansible.ModuleUtils.ControlMAgent
+$settings = Get-ControlMSettingTable
+
+# Log directories reported with the report_log_usage option.
+#   Path     : directory under the agent directory
+#   Filter   : wildcards of the file names of the category, the other files of the directory belong to
+#              the category of the same directory without a filter
+#   Retention: setting holding the number of days the files are kept. The agent has no other retention
+#              setting for the dailylog directory than measure_usage_day, which also applies to its files.
+#   SizeLimit: setting holding the maximum size of a file in MB
+#   Versions : setting holding the number of older versions kept for a log file, the versions of a log
+#              file share its name up to a trailing .<number>
+#   Enabled  : setting which must be enabled for the files to be written
+$LogCategories = [ordered]@{
+    proclog  = @{ Path = 'proclog'; Retention = 'days_to_retain_log_files'; SizeLimit = 'limit_log_file_size'; Versions = 'limit_log_version' }
+    trace    = @{ Path = 'proclog'; Filter = @('*.trc', '*trace*'); Retention = 'days_to_retain_log_files'; Enabled = 'communication_trace' }
+    dailylog = @{ Path = 'dailylog'; Retention = 'measure_usage_day'; Enabled = 'daily_log_file_enabled' }
+}
 
+# Presets of the tuning_profile option, expanded into settings. The settings dictionary and
+# the options take precedence over them, and the tuning_profiles option extends them.
+$TuningProfiles = [ordered]@{
+    high_throughput = [ordered]@{
+        persistent_connection         = $true
+        allow_comm_init               = $true
+        tracker_polling_interval      = 30
+        tcpip_timeout                 = 120
+        diagnostic_level              = 0
+        communication_trace           = $false
+        echo_job_commands_into_sysout = $false
+        add_job_statistics_to_sysout  = $false
     }
-
-    PROCESS {
-
-        $Parameters.Keys | ForEach-Object {
-
-            $FilteredParameters = @{ }
-
-        } {
-
-            if (($BaseParameters + $ParametersToRemove) -notcontains $PSItem) {
-
-                $FilteredParameters.Add($PSItem, $Parameters[$PSItem])
-
-            }
-
-        } { $FilteredParameters }
-
+    low_overhead    = [ordered]@{
+        persistent_connection         = $false
+        tracker_polling_interval      = 300
+        diagnostic_level              = 0
+        communication_trace           = $false
+        limit_log_file_size           = 5
+        limit_log_version             = 2
+        days_to_retain_log_files      = 1
+        echo_job_commands_into_sysout = $false
+        add_job_statistics_to_sysout  = $false
     }
+    troubleshooting = [ordered]@{
+        diagnostic_level              = 4
+        communication_trace           = $true
+        limit_log_file_size           = 100
+        limit_log_version             = 20
+        days_to_retain_log_files      = 7
+        echo_job_commands_into_sysout = $true
+        add_job_statistics_to_sysout  = $true
+    }
+}
 
-    END { }
-
+# The argument spec is generated from the settings table, ranges are checked once the module is created
+$spec = @{
+    options             = @{ }
+    supports_check_mode = $true
+}
+foreach ($Setting in $settings.GetEnumerator()) {
+    if ($Setting.Value.ReadOnly) { continue }
+    $Option = @{ type = $Setting.Value.Type }
+    if ($Setting.Value.Choices) { $Option.choices = $Setting.Value.Choices }
+    if ($Setting.Value.Aliases) { $Option.aliases = $Setting.Value.Aliases }
+    $spec.options[$Setting.Key] = $Option
+}
+$spec.options.instances = @{
+    type     = "list"
+    elements = "dict"
+    options  = @{
+        name         = @{ type = "str"; required = $true }
+        service_name = @{ type = "str" }
+    }
 }
-Function Convert-StringToSnakeCase {
+$spec.options.settings = @{
+    type    = "dict"
+    options = @{ }
+}
+$spec.options.tuning_profiles = @{
+    type     = "list"
+    elements = "dict"
+    options  = @{
+        name = @{ type = "str"; required = $true }
+    }
+}
+foreach ($Option in @($spec.options.Keys)) {
+    if ($Option -in @('instances', 'settings', 'tuning_profiles')) { continue }
+    $spec.options.instances.options[$Option] = $spec.options[$Option]
+    $spec.options.settings.options[$Option] = $spec.options[$Option]
+    $spec.options.tuning_profiles.options[$Option] = $spec.options[$Option]
+}
+$spec.options.tuning_profile = @{ type = "str" }
+$spec.options.firewall_rule_name = @{ type = "str" }
+$spec.options.firewall_rule_group = @{ type = "str" }
+$spec.options.restart = @{ type = "str"; choices = @('auto', 'never', 'deferred'); default = 'auto' }
+$spec.options.restart_timeout = @{ type = "int"; default = 120 }
+$spec.options.return_config = @{ type = "str"; choices = @('full', 'changed', 'none'); default = 'full' }
+$spec.options.profile = @{ type = "bool"; default = $false }
+$spec.options.verify = @{ type = "str"; choices = @('fingerprint', 'full'); default = 'fingerprint' }
+$spec.options.verify_connectivity = @{ type = "str"; choices = @('none', 'report', 'fail'); default = 'none' }
+$spec.options.connectivity_timeout = @{ type = "int"; default = 5 }
+$spec.options.mode = @{ type = "str"; choices = @('enforce', 'plan', 'apply'); default = 'enforce' }
+$spec.options.plan = @{ type = "dict" }
+$spec.options.diagnostic_duration = @{ type = "int" }
+$spec.options.report_log_usage = @{ type = "bool"; default = $false }
+$spec.options.log_usage_timeout = @{ type = "int"; default = 30 }
+# Handled by the action plugin on the controller
+$spec.options.merge_tasks = @{ type = "bool"; default = $true }
+$spec.options.trust_cached_facts_for = @{ type = "int" }
+$spec.required_if = @(, @('mode', 'apply', @('plan')))
+
+Function Add-ControlMTiming {
     <#
     .SYNOPSIS
-    This function convert a string in convert a string in camelCase format to snake_case
-    .PARAMETER String
-    Specifies the string in snake_case format.
+    Adds the time elapsed on a stopwatch to a phase of the timings, then restarts the stopwatch for the next phase.
+    .PARAMETER Phase
+    Specifies the name of the phase.
+    .PARAMETER Stopwatch
+    Specifies the stopwatch started at the beginning of the phase.
     #>
-    [OutputType([System.String])]
     param (
-        [Parameter(Mandatory = $true, Position = 0)]
+        [Parameter(Mandatory = $true)]
         [string]
-        $string
+        $Phase,
+        [Parameter(Mandatory = $true)]
+        [System.Diagnostics.Stopwatch]
+        $Stopwatch
     )
-    # cope with pluralized abbreaviations such as TargetGroupARNs
-    if ($string -cmatch "[A-Z]{3,}s") {
-        $replacement_string = $string -creplace $matches[0], "_$($matches[0].ToLower())"
-
-        # handle when there was nothing before the plural pattern
-        if ($replacement_string.StartsWith("_") -and -not $string.StartsWith("_")) {
-            $replacement_string = $replacement_string.Substring(1)
-        }
-        $string = $replacement_string
-    }
-    $string = $string -creplace "(.)([A-Z][a-z]+)", '$1_$2'
-    $string = $string -creplace "([a-z0-9])([A-Z])", '$1_$2'
-    $string = $string.ToLower()
 
-    return $string
+    $script:Timings["$($Phase)_ms"] += $Stopwatch.ElapsedMilliseconds
+    $Stopwatch.Restart()
 }
 
-function ConvertTo-Boolean {
+Function Test-ControlMReadOnly {
     <#
     .SYNOPSIS
-    This function Convert common values to Powershell boolean values $true and $false.
-    .PARAMETER value
-    Specifies the string to convert.
+    Tests if the host must be left unchanged, in check mode or when a plan is made with mode=plan.
     #>
-    param
-    (
-        [Parameter(Mandatory = $false, ValueFromPipeline = $true)]
-        [string]
-        $value
-    )
-    switch ($value) {
-        "y" { return $true; }
-        "yes" { return $true; }
-        "true" { return $true; }
-        "t" { return $true; }
-        1 { return $true; }
-        "n" { return $false; }
-        "no" { return $false; }
-        "false" { return $false; }
-        "f" { return $false; }
-        0 { return $false; }
-    }
-}
+    [OutputType([System.Boolean])]
+    param ()
 
-Function ConvertFrom-ControlMParameter {
+    return ($module.CheckMode -or ($module.Params.mode -eq 'plan'))
+}
 
+Function Assert-ControlMSettingRange {
+    <#
+    .SYNOPSIS
+    Fails the module if a parameter is out of the range defined in the settings table.
+    .PARAMETER Parameters
+    Specifies the module parameters.
+    #>
     param (
         [Parameter(Mandatory = $true)]
-        [string]
-        $Name,
-        [string]
-        $Value
+        $Parameters
     )
-    $ConvertedValue = $null
 
-    if ($Name -eq 'SSL') {
-        $ConvertedValue = ($Value -contains 'SSL=Y')
-    }
-    elseif ($Name -eq 'CommunicationTrace') {
-        $ConvertedValue = ConvertTo-Boolean -Value $Value;
-    }
-    elseif (-not $script:ParameterList[$Name]) {
-        $ConvertedValue = [string]$Value
-    }
-    else {
-        $ParameterType = $script:ParameterList[$Name].ParameterType.Name
-        $ConvertedValue = switch ($ParameterType) {
-            "Int32" {
-                [int]$int = $null
-                [int32]::TryParse($Value, [ref]$int) | Out-Null; $int; break
-            }
-            "Boolean" {
-                ConvertTo-Boolean -Value $Value; break
-            }
-            default {
-                [string]$Value
-            }
+    foreach ($Setting in $settings.GetEnumerator()) {
+        if (-not $Parameters.ContainsKey($Setting.Key) -or ($null -eq $Parameters[$Setting.Key])) { continue }
+        $Value = $Parameters[$Setting.Key]
+        if ($Setting.Value.ContainsKey('Min') -and (($Value -lt $Setting.Value.Min) -or ($Value -gt $Setting.Value.Max))) {
+            $module.FailJson("value of $($Setting.Key) must be between $($Setting.Value.Min) and $($Setting.Value.Max), got: $Value")
+        }
+        if ($Setting.Value.ContainsKey('MaxLength') -and ($Value.Length -gt $Setting.Value.MaxLength)) {
+            $module.FailJson("value of $($Setting.Key) must not exceed $($Setting.Value.MaxLength) characters, got: $($Value.Length)")
         }
     }
-    return $ConvertedValue
 }
 
 Function ConvertTo-ControlMParameter {
@@ -279,25 +224,24 @@ Function ConvertTo-ControlMParameter {
         [string]
         $Name,
         [Parameter(Mandatory = $true)]
+        [AllowEmptyString()]
         $Value
     )
 
     $NewValue = $null
+    $Setting = $settings[$Name]
 
-    if ($Name -eq 'SSL') {
+    if ($Setting.Format -eq 'SSL') {
         $NewSetting = if ([bool]$Value) { 'SSL=Y' } else { 'SSL=N' }
-        $ControlMValue = Get-ControlMParameter -Name 'SSL'
-        $NewValue = if ([string]::IsNullOrEmpty($Value)) { $NewSetting } else { $ControlMValue -replace "SSL=[N|Y]", $NewSetting }
+        $ControlMValue = Get-ControlMParameter -Name $Name
+        $NewValue = if ($ControlMValue -match 'SSL=[NY]') { $ControlMValue -replace "SSL=[NY]", $NewSetting } else { $NewSetting }
     }
-    elseif ($Name -eq 'CommunicationTrace') {
+    elseif ($Setting.Format -eq 'Numeric') {
         $NewValue = if ([bool]$Value) { '1' } else { '0' }
     }
-    elseif ($value -is [bool]) {
+    elseif ($Setting.Type -eq 'bool') {
         $NewValue = if ([bool]$Value) { 'Y' } else { 'N' }
     }
-    elseif ($value -is [int]) {
-        $NewValue = [string]$Value
-    }
     else {
         $NewValue = [string]$Value
     }
@@ -313,404 +257,1914 @@ Function Get-ControlMParameter {
         $Name
     )
 
-    $optionName = Convert-StringToSnakeCase -String $Name
-    if ( -not $configuration.ContainsKey($optionName) ) {
-        $module.FailJson("The configuration hashtable does not contain the `"$optionName`" setting converted from the `"$Name`" parameter name")
+    if ( -not $settings.Contains($Name) ) {
+        $module.FailJson("The settings table does not contain the `"$Name`" setting")
     }
 
-    $RegistryInfo = $configuration[$optionName]
-    Get-ItemProperty -Path $RegistryInfo.Path -Name $RegistryInfo.Name -ErrorAction SilentlyContinue -ErrorVariable RegistryError -OutVariable RegistryEntry | Out-Null
-    if ($RegistryError) { $RegistryValue = $RegistryInfo.Default } else { $RegistryValue = $($RegistryEntry.$($RegistryInfo.Name)) }
-
-    return $RegistryValue
+    return Get-ControlMSnapshotValue -Snapshot $script:Snapshot -Name $Name -Root $script:InstanceRegistryPath
 }
 
-Function Set-ControlMParameter {
-
-    [OutputType([System.Boolean])]
+Function New-ControlMChange {
+    <#
+    .SYNOPSIS
+    Builds the change of a setting if the value stored in the registry differs.
+    .PARAMETER Name
+    Specifies the name of the setting.
+    .PARAMETER Value
+    Specifies the value to store in the registry.
+    .PARAMETER BeforeValue
+    Specifies the current value reported in the diff.
+    .PARAMETER AfterValue
+    Specifies the desired value reported in the diff.
+    .OUTPUTS
+    A hashtable describing the change, or $null if the registry value is already set.
+    #>
+    [OutputType('System.Collections.Hashtable')]
     param (
-        [Parameter(Mandatory = $true, ValueFromPipeline = $true)]
+        [Parameter(Mandatory = $true)]
         [string]
         $Name,
-        [Parameter(Mandatory = $true, ValueFromPipeline = $true)]
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyString()]
         [string]
-        $Value
+        $Value,
+        $BeforeValue,
+        $AfterValue
     )
 
-    $optionName = Convert-StringToSnakeCase -String $Name
-    if ( -not $configuration.ContainsKey($optionName) ) {
-        $module.FailJson("The configuration hashtable does not contain the `"$optionName`" setting converted from the `"$Name`" parameter name")
-    }
-    $Changed = $false
-
     $CurrentValue = Get-ControlMParameter -Name $Name
-    if ($CurrentValue -ne $Value) {
-        $Changed = $true
-        if (-not $module.CheckMode) {
-            $RegistryInfo = $configuration[$optionName]
-            Set-ItemProperty -Path $RegistryInfo.Path -Name $RegistryInfo.Name -Value $Value -ErrorAction SilentlyContinue -ErrorVariable RegistryError
-            if ($RegistryError) {
-                $module.FailJson("An error occurs when saving the `"$optionName`" setting in the registry: $RegistryError")
-            }
-        }
+    if ($CurrentValue -eq $Value) {
+        return $null
     }
-    return $Changed
-}
 
-function Restart-AgentService {
-
-    if (-not $module.CheckMode) {
-        Restart-Service -Name ctmag -Force -ErrorAction SilentlyContinue -ErrorVariable ProcessError
-        If ($ProcessError) {
-            $module.FailJson("The Control/M Agent Windows service could not be restarted. $ProcessError")
-        }
+    $Path = Get-ControlMRegistryPath -Name $Name -Root $script:InstanceRegistryPath
+    return @{
+        Option        = $Name
+        Path          = $Path
+        Name          = $settings[$Name].Name
+        Value         = $Value
+        PreviousValue = $CurrentValue
+        Exists        = $script:Snapshot[$Path].ContainsKey($settings[$Name].Name)
+        BeforeValue   = $BeforeValue
+        AfterValue    = $AfterValue
     }
 }
 
-Function Get-TargetResource {
+Function Get-ControlMChangeSet {
     <#
     .SYNOPSIS
-    Retrieves all settings of the configuration.
+    Works out the full list of registry values to change before anything is written.
     .PARAMETER Parameters
-    This is the input object from the name of parameters to retrieve.
-    .PARAMETER ParametersAdd
-    Accepts an array of any additional parameter keys which should be add
-    object.
+    Specifies the desired settings indexed by setting name.
+    .PARAMETER Resources
+    Specifies the current settings indexed by setting name.
+    .OUTPUTS
+    An array of changes built by New-ControlMChange.
     #>
-    [OutputType('System.Collections.Hashtable')]
+    [OutputType('System.Array')]
     param (
-        [parameter(Position = 0, ValueFromPipeline = $true)]
-        [array]$Parameters = @($script:ParameterList.Keys),
-        [array]
-        $ParametersToAdd = @()
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyCollection()]
+        [Hashtable]
+        $Parameters,
+        [Parameter(Mandatory = $true)]
+        [Hashtable]
+        $Resources
     )
 
-    $TargetResource = @{ }
+    $ChangeSet = [System.Collections.ArrayList]@()
+    $Parameters.Keys | Where-Object { $Resources.ContainsKey($_) -and ($Resources[$_] -ne $Parameters[$_]) } | ForEach-Object {
 
-    $Parameters + $ParametersToAdd | ForEach-Object {
-        $ControlMValue = Get-ControlMParameter -Name $_
-        $Value = ConvertFrom-ControlMParameter -Name $_ -Value $ControlMValue
-        $targetResource[$_] = $Value
-    }
+        $ControlMValue = ConvertTo-ControlMParameter -Name $_ -Value $Parameters[$_]
+        $Change = New-ControlMChange -Name $_ -Value $ControlMValue -BeforeValue $Resources[$_] -AfterValue $Parameters[$_]
+        if ($Change) { $ChangeSet.Add($Change) | Out-Null }
 
-    return $targetResource
+        # The primary server is also the only authorized server when no list is defined
+        if ($_ -eq 'primary_controlm_server_host') {
+            if (-not $Resources['authorized_controlm_server_hosts'] -and -not $Parameters['authorized_controlm_server_hosts']) {
+                $Change = New-ControlMChange -Name 'authorized_controlm_server_hosts' -Value $ControlMValue -BeforeValue '' -AfterValue $Parameters[$_]
+                if ($Change) { $ChangeSet.Add($Change) | Out-Null }
+            }
+        }
+    }
+    return , $ChangeSet.ToArray()
 }
 
-Function Test-TargetResource {
-    [CmdletBinding()]
-    [OutputType([System.Boolean])]
+Function Open-ControlMRegistryKey {
+    <#
+    .SYNOPSIS
+    Opens a registry key of the local machine for writing.
+    .PARAMETER Path
+    Specifies the path of the registry key with the HKLM: drive.
+    .OUTPUTS
+    The opened registry key. The caller must dispose it.
+    #>
+    [OutputType([Microsoft.Win32.RegistryKey])]
     param (
-        [ValidateRange(1024, 65535)]
-        [int]
-        $AgentToServerPort,
-        [ValidateRange(1024, 65535)]
-        [int]
-        $ServerToAgentPort,
-        [string]
-        $PrimaryControlmServerHost,
-        [string]
-        $AuthorizedControlmServerHosts,
-        [ValidateRange(0, 4)]
-        [int]
-        $DiagnosticLevel,
-        [bool]
-        $CommunicationTrace,
-        [ValidateRange(1, 99)]
-        [int]
-        $DaysToRetainLogFiles,
-        [bool]
-        $DailyLogFileEnabled = $true,
-        [ValidateRange(1024, 65535)]
-        [int]
-        $TrackerEventPort,
-        [string]
-        $LogicalAgentName,
-        [bool]
-        $PersistentConnection,
-        [bool]
-        $AllowCommInit,
-        [ValidateSet("LATIN-1", "CJK")]
-        [string]
-        $ForeignLanguageSupport,
-        [bool]
-        $SSL,
-        [ValidateRange(1, 12)]
-        [int]
-        $ServerAgentProtocolVersion,
-        [bool]
-        $AutoeditInline,
-        [string]
-        $ListenToNetworkInterface,
-        [ValidateSet("", "IP")]
-        [string]
-        $CtmsAddressMode,
-        [int]
-        $TimeoutForAgentUtilities,
-        [ValidateRange(0, 999999)]
-        [int]
-        $TcpipTimeout,
-        [ValidateRange(1, 86400)]
-        [int]
-        $TrackerPollingInterval,
-        [validateRange(1, 1000)]
-        [int]
-        $LimitLogFileSize,
-        [validateRange(0, 99)]
-        [int]
-        $LimitLogVersion,
-        [validateRange(1, 99)]
-        [int]
-        $MeasureUsageDay,
-        [bool]
-        $LogonAsUser,
-        [string]
-        $LogonDomain,
-        [bool]
-        $JobChildrenInsideJobObject,
-        [bool]
-        $AddJobStatisticsToSysout,
-        [ValidateSet("MEMNAME", "JOBNAME")]
-        [string]
-        $JobOutputName,
-        [validateRange(1, 4)]
-        [int]
-        $WrapParametersWithDoubleQuotes,
-        [bool]
-        $RunUserLogonScript,
-        [ValidateSet("", "UTF-8", "JAPANESE EUC", "JAPANESE SHIFT-JIS", "KOREAN EUC", "SIMPLIFIED CHINESE GBK", "SIMPLIFIED CHINESE GB", "TRADITIONAL CHINESE EUC", "TRADITIONAL CHINESE BIG5")]
-        [string]
-        $CjkEncoding,
-        [string]
-        $DefaultPrinter,
-        [bool]
-        $EchoJobCommandsIntoSysout,
-        [string]
-        $SmtpServerRelayName,
-        [ValidateRange(0, 65535)]
-        [int]
-        $SmtpPort,
-        [ValidateLength(0, 99)]
-        [string]
-        $SmtpSenderMail,
-        [string]
-        $SmtpSenderFriendlyName,
+        [Parameter(Mandatory = $true)]
         [string]
-        $SmtpReplyToMail
+        $Path
     )
-    $isCompliant = $true;
 
-    $resources = Get-TargetResource
-
-    if ($resources.Length -eq 0) {
-        return $false
+    $SubKeyPath = $Path -replace '^HKLM:\\', ''
+    $RegistryKey = [Microsoft.Win32.Registry]::LocalMachine.OpenSubKey($SubKeyPath, $true)
+    if ($null -eq $RegistryKey) {
+        throw "The registry key `"$Path`" does not exist"
     }
-    $Parameters = $PSBoundParameters | Get-ModuleParameter
-
-    $difference = $Parameters.Keys | ForEach-Object { if ($resources.ContainsKey($_)) { if ($resources[$_] -ne $Parameters[$_] ) { $_ } } }
-    $isCompliant = ($null -eq $difference)
-
-    return $isCompliant
+    return $RegistryKey
 }
 
-function Set-TargetResource {
-
-    [OutputType([System.Boolean])]
+Function Undo-ControlMChangeSet {
+    <#
+    .SYNOPSIS
+    Restores the previous registry values of the changes already written.
+    .PARAMETER ChangeSet
+    Specifies the changes to roll back.
+    .OUTPUTS
+    The errors raised during the rollback.
+    #>
+    [OutputType('System.String')]
     param (
-        [ValidateRange(1024, 65535)]
-        [int]
-        $AgentToServerPort,
-        [ValidateRange(1024, 65535)]
-        [int]
-        $ServerToAgentPort,
-        [string]
-        $PrimaryControlmServerHost,
-        [string]
-        $AuthorizedControlmServerHosts,
-        [ValidateRange(0, 4)]
-        [int]
-        $DiagnosticLevel,
-        [bool]
-        $CommunicationTrace,
-        [ValidateRange(1, 99)]
-        [int]
-        $DaysToRetainLogFiles,
-        [bool]
-        $DailyLogFileEnabled = $true,
-        [ValidateRange(1024, 65535)]
-        [int]
-        $TrackerEventPort,
-        [string]
-        $LogicalAgentName,
-        [bool]
-        $PersistentConnection,
-        [bool]
-        $AllowCommInit,
-        [ValidateSet("LATIN-1", "CJK")]
-        [string]
-        $ForeignLanguageSupport,
-        [bool]
-        $SSL,
-        [ValidateRange(1, 12)]
-        [int]
-        $ServerAgentProtocolVersion,
-        [bool]
-        $AutoeditInline,
-        [string]
-        $ListenToNetworkInterface,
-        [ValidateSet("", "IP")]
-        [string]
-        $CtmsAddressMode,
-        [int]
-        $TimeoutForAgentUtilities,
-        [ValidateRange(0, 999999)]
-        [int]
-        $TcpipTimeout,
-        [ValidateRange(1, 86400)]
-        [int]
-        $TrackerPollingInterval,
-        [validateRange(1, 1000)]
-        [int]
-        $LimitLogFileSize,
-        [validateRange(0, 99)]
-        [int]
-        $LimitLogVersion,
-        [validateRange(1, 99)]
-        [int]
-        $MeasureUsageDay,
-        [bool]
-        $LogonAsUser,
-        [string]
-        $LogonDomain,
-        [bool]
-        $JobChildrenInsideJobObject,
-        [bool]
-        $AddJobStatisticsToSysout,
-        [ValidateSet("MEMNAME", "JOBNAME")]
-        [string]
-        $JobOutputName,
-        [validateRange(1, 4)]
-        [int]
-        $WrapParametersWithDoubleQuotes,
-        [bool]
-        $RunUserLogonScript,
-        [ValidateSet("", "UTF-8", "JAPANESE EUC", "JAPANESE SHIFT-JIS", "KOREAN EUC", "SIMPLIFIED CHINESE GBK", "SIMPLIFIED CHINESE GB", "TRADITIONAL CHINESE EUC", "TRADITIONAL CHINESE BIG5")]
-        [string]
-        $CjkEncoding,
-        [string]
-        $DefaultPrinter,
-        [bool]
-        $EchoJobCommandsIntoSysout,
-        [string]
-        $SmtpServerRelayName,
-        [ValidateRange(0, 65535)]
-        [int]
-        $SmtpPort,
-        [ValidateLength(0, 99)]
-        [string]
-        $SmtpSenderMail,
-        [string]
-        $SmtpSenderFriendlyName,
-        [string]
-        $SmtpReplyToMail
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyCollection()]
+        [array]
+        $ChangeSet
     )
 
-    $module.Result.changed = $false
-    $Parameters = $PSBoundParameters | Get-ModuleParameter
-    $resources = Get-TargetResource
-
-    $Parameters.Keys | ForEach-Object { if ($resources.ContainsKey($_)) {
-            if ($resources[$_] -ne $Parameters[$_] ) {
-
-                $ControlMValue = ConvertTo-ControlMParameter -Name $_ -Value $Parameters[$_]
-
-                if (Set-ControlMParameter -Name $_ -Value $ControlMValue) {
-                    $optionName = Convert-StringToSnakeCase -String $_
-                    $module.Diff.before.$optionName = $resources[$_]
-                    $module.Diff.after.$optionName = $Parameters[$_]
-                    $module.Result.changed = $true
-                }
-                if ($_ -eq 'PrimaryControlmServerHost') {
-                    if (-not $resources['AuthorizedControlmServerHosts'] -and -not $Parameters['AuthorizedControlmServerHosts']) {
-                        if (Set-ControlMParameter -Name 'AuthorizedControlmServerHosts' -Value $ControlMValue) {
-                            $module.Diff.before.primary_controlm_server_host = ''
-                            $module.Diff.after.primary_controlm_server_host = $Parameters[$_]
-                            $module.Result.changed = $true
-                        }
+    $RollbackErrors = @()
+    $ChangeSet | Group-Object -Property { $_.Path } | ForEach-Object {
+        try {
+            $RegistryKey = Open-ControlMRegistryKey -Path $_.Name
+            try {
+                foreach ($Change in $_.Group) {
+                    if ($Change.Exists) {
+                        $RegistryKey.SetValue($Change.Name, [string]$Change.PreviousValue, [Microsoft.Win32.RegistryValueKind]::String)
                     }
+                    else {
+                        $RegistryKey.DeleteValue($Change.Name, $false)
+                    }
+                    $script:Timings['registry_writes'] += 1
                 }
             }
+            finally {
+                $RegistryKey.Dispose()
+            }
+        }
+        catch {
+            $RollbackErrors += "$($_.Exception.Message)"
         }
     }
+    return ($RollbackErrors -join '; ')
+}
+
+Function Invoke-ControlMChangeSet {
+    <#
+    .SYNOPSIS
+    Writes a change set in the registry.
+    .DESCRIPTION
+    Each registry key is opened once for writing, then read back once to confirm the new values.
+    If a write fails, the previous values are restored before failing the module.
+    .PARAMETER ChangeSet
+    Specifies the changes built by Get-ControlMChangeSet.
+    #>
+    param (
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyCollection()]
+        [array]
+        $ChangeSet
+    )
 
-    if (-not $module.CheckMode) {
-        @('AgentToServerPort') | ForEach-Object {
-            $Name = $_
-            if ($Parameters[$Name]) {
-                $PortFilter = Get-NetFirewallPortFilter | Where-Object { $_.RemotePort -Eq $resources[$Name] }
-                $PortFilter | Set-NetFirewallPortFilter -RemotePort $Parameters[$Name] -ErrorAction SilentlyContinue -ErrorVariable ProcessError
-                if ($ProcessError) {
-                    $module.FailJson("An error occurs when changing the firewall rule with the $($resources[$Name]) remote port to $($Parameters[$Name]) : $ProcessError")
+    $Applied = [System.Collections.ArrayList]@()
+    $ErrorMessage = $null
+
+    foreach ($Group in ($ChangeSet | Group-Object -Property { $_.Path })) {
+        $CurrentOption = $Group.Group[0].Option
+        try {
+            $RegistryKey = Open-ControlMRegistryKey -Path $Group.Name
+            try {
+                foreach ($Change in $Group.Group) {
+                    $CurrentOption = $Change.Option
+                    $RegistryKey.SetValue($Change.Name, $Change.Value, [Microsoft.Win32.RegistryValueKind]::String)
+                    $script:Timings['registry_writes'] += 1
+                    $Applied.Add($Change) | Out-Null
                 }
             }
-        }
-        @('ServerToAgentPort', 'TrackerEventPort') | ForEach-Object {
-            $Name = $_
-            if ($Parameters[$Name]) {
-                $PortFilter = Get-NetFirewallPortFilter | Where-Object { $_.LocalPort -Eq $resources[$Name] }
-                $PortFilter | Set-NetFirewallPortFilter -LocalPort $Parameters[$Name] -ErrorAction SilentlyContinue -ErrorVariable ProcessError
-                if ($ProcessError) {
-                    $module.FailJson("An error occurs when changing the firewall rule with the $($resources[$Name]) local port to $($Parameters[$Name]) : $ProcessError")
-                }
+            finally {
+                $RegistryKey.Dispose()
             }
         }
+        catch {
+            $ErrorMessage = "An error occurs when saving the `"$CurrentOption`" setting in the registry: $($_.Exception.Message)"
+            break
+        }
 
-        if ($module.Diff.after.tracker_event_port) {
-            Restart-AgentService
-        } elseif ($module.Diff.after.limit_log_file_size) {
-            Restart-AgentService
-        } elseif ($module.Diff.after.limit_log_version) {
-            Restart-AgentService
+        $script:Timings['registry_reads'] += 1
+        $RegistryValues = Get-ControlMRegistryKey -Path $Group.Name
+        $Mismatch = $Group.Group | Where-Object { [string]$RegistryValues[$_.Name] -ne $_.Value } | Select-Object -First 1
+        if ($Mismatch) {
+            $ErrorMessage = "The `"$($Mismatch.Option)`" setting read back from the registry does not match the saved value"
+            break
         }
     }
-    return $module.Result.changed
-}
 
-$module = [Ansible.Basic.AnsibleModule]::Create($args, $spec)
+    if ($ErrorMessage) {
+        $RollbackErrors = Undo-ControlMChangeSet -ChangeSet $Applied.ToArray()
+        if ($RollbackErrors) {
+            $module.FailJson("$ErrorMessage. The previous values could not be restored: $RollbackErrors")
+        }
+        $module.FailJson("$ErrorMessage. The previous values have been restored.")
+    }
 
-$service = Get-Service -Name ctmag -ErrorAction SilentlyContinue -ErrorVariable ProcessError
-If ($ProcessError) {
-    $module.FailJson("The Control/M Agent Windows service is not installed. $ProcessError")
+    # Keep the snapshot in line with the registry for the final report
+    $ChangeSet | ForEach-Object { $script:Snapshot[$_.Path][$_.Name] = $_.Value }
 }
 
-$module.Diff.before = @{ }
-$module.Diff.after = @{ }
+Function Get-ControlMFirewallPortFilter {
+    <#
+    .SYNOPSIS
+    Lists the port filters of the firewall rules once.
+    .DESCRIPTION
+    When the firewall_rule_name or firewall_rule_group options are defined, only the port filters
+    of the matching rules are listed. Otherwise all the port filters of the machine are listed.
+    #>
+    param ()
 
-$BaseParameters = [Collections.Generic.List[String]]@(
-    [System.Management.Automation.PSCmdlet]::CommonParameters +
-    [System.Management.Automation.PSCmdlet]::OptionalCommonParameters
-)
+    $RuleName = $module.Params.firewall_rule_name
+    $RuleGroup = $module.Params.firewall_rule_group
+    if (-not $RuleName -and -not $RuleGroup) {
+        return Get-NetFirewallPortFilter
+    }
 
-$script:ParameterList = (Get-Command -Name 'Test-TargetResource').Parameters
-@($script:ParameterList.Keys) | ForEach-Object {
-    if ($_ -in $BaseParameters) {
-        $script:ParameterList.Remove($_) | Out-Null
+    if ($RuleName) {
+        $Rules = Get-NetFirewallRule -DisplayName $RuleName -ErrorAction SilentlyContinue
+        if ($RuleGroup) { $Rules = $Rules | Where-Object { $_.DisplayGroup -like $RuleGroup } }
+    }
+    else {
+        $Rules = Get-NetFirewallRule -DisplayGroup $RuleGroup -ErrorAction SilentlyContinue
     }
+    return $Rules | Get-NetFirewallPortFilter
 }
 
-$params = @{ }
-$ParameterList.Keys | ForEach-Object {
-    $optionName = Convert-StringToSnakeCase -String $_
-    if ($module.Params.ContainsKey($optionName) -and -not ($null -eq $module.Params.$optionName)) {
-        $params.$($_) = $module.Params.$optionName
+Function Get-ControlMFirewallChange {
+    <#
+    .SYNOPSIS
+    Works out the firewall port filters to update for the ports changed in the registry.
+    .DESCRIPTION
+    The port filters are listed only if a port changes, and are indexed by the previous port
+    in a single pass.
+    .PARAMETER ChangeSet
+    Specifies the changes built by Get-ControlMChangeSet.
+    .OUTPUTS
+    An array of hashtables with the port filter, the port property and the previous and new port lists.
+    #>
+    [OutputType('System.Array')]
+    param (
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyCollection()]
+        [array]
+        $ChangeSet
+    )
+
+    $PortChanges = @{ }
+    $ChangeSet | Where-Object { $settings[$_.Option].Firewall } | ForEach-Object {
+        $PortChanges["$($settings[$_.Option].Firewall):$($_.PreviousValue)"] = $_
+    }
+    if ($PortChanges.Count -eq 0) {
+        return , @()
+    }
+
+    $FirewallChanges = [System.Collections.ArrayList]@()
+    foreach ($Filter in @(Get-ControlMFirewallPortFilter)) {
+        $script:Timings['firewall_filters_scanned'] += 1
+        foreach ($Property in @('LocalPort', 'RemotePort')) {
+            $Ports = @($Filter.$Property | ForEach-Object { [string]$_ })
+            $NewPorts = @($Ports | ForEach-Object {
+                    $PortChange = $PortChanges["$($Property):$_"]
+                    if ($PortChange) { $PortChange.Value } else { $_ }
+                })
+            if (($NewPorts -join ',') -ne ($Ports -join ',')) {
+                $FirewallChanges.Add(@{
+                        Filter   = $Filter
+                        Rule     = $Filter.InstanceID
+                        Property = $Property
+                        Before   = $Ports
+                        After    = $NewPorts
+                    }) | Out-Null
+            }
+        }
+    }
+    return , $FirewallChanges.ToArray()
+}
+
+Function Invoke-ControlMFirewallChange {
+    <#
+    .SYNOPSIS
+    Updates the port filters of the firewall rules.
+    .PARAMETER FirewallChanges
+    Specifies the changes built by Get-ControlMFirewallChange.
+    #>
+    param (
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyCollection()]
+        [array]
+        $FirewallChanges
+    )
+
+    foreach ($FirewallChange in $FirewallChanges) {
+        $PortParameter = @{ $FirewallChange.Property = $FirewallChange.After }
+        $FirewallChange.Filter | Set-NetFirewallPortFilter @PortParameter -ErrorAction SilentlyContinue -ErrorVariable ProcessError
+        if ($ProcessError) {
+            $module.FailJson("An error occurs when changing the $($FirewallChange.Property) of the firewall rule `"$($FirewallChange.Rule)`" from $($FirewallChange.Before -join ',') to $($FirewallChange.After -join ',') : $ProcessError")
+        }
+    }
+}
+
+function Restart-AgentService {
+
+    if (-not (Test-ControlMReadOnly)) {
+        Restart-Service -Name $ServiceName -Force -ErrorAction SilentlyContinue -ErrorVariable ProcessError
+        If ($ProcessError) {
+            $module.FailJson("The Control/M Agent Windows service could not be restarted. $ProcessError")
+        }
+    }
+}
+
+Function Test-ControlMAgentPort {
+    <#
+    .SYNOPSIS
+    Tests if a TCP port accepts connections.
+    .PARAMETER ComputerName
+    Specifies the host name or IP address to connect to.
+    .PARAMETER Port
+    Specifies the TCP port to connect to.
+    .PARAMETER Timeout
+    Specifies the maximum time in milliseconds to wait for the connection.
+    #>
+    [OutputType([System.Boolean])]
+    param (
+        [Parameter(Mandatory = $true)]
+        [string]
+        $ComputerName,
+        [Parameter(Mandatory = $true)]
+        [int]
+        $Port,
+        [int]
+        $Timeout = 1000
+    )
+
+    $Client = New-Object -TypeName System.Net.Sockets.TcpClient
+    try {
+        $Connection = $Client.ConnectAsync($ComputerName, $Port)
+        return ($Connection.Wait($Timeout) -and $Client.Connected)
+    }
+    catch {
+        return $false
+    }
+    finally {
+        $Client.Close()
+    }
+}
+
+Function Wait-ControlMAgentReady {
+    <#
+    .SYNOPSIS
+    Waits until the Control-M Agent service is running and the server-to-agent port accepts connections.
+    .PARAMETER Timeout
+    Specifies the maximum time in seconds to wait.
+    #>
+    param (
+        [Parameter(Mandatory = $true)]
+        [int]
+        $Timeout
+    )
+
+    $Port = [int](Get-ControlMParameter -Name 'server_to_agent_port')
+    $Interface = Get-ControlMParameter -Name 'listen_to_network_interface'
+    $ComputerName = if (-not $Interface -or $Interface -eq '*ANY') { '127.0.0.1' } else { $Interface }
+
+    $Stopwatch = [System.Diagnostics.Stopwatch]::StartNew()
+    do {
+        $Service = Get-Service -Name $ServiceName -ErrorAction SilentlyContinue
+        if (($Service.Status -eq 'Running') -and (Test-ControlMAgentPort -ComputerName $ComputerName -Port $Port)) {
+            return
+        }
+        Start-Sleep -Milliseconds 500
+    } while ($Stopwatch.Elapsed.TotalSeconds -lt $Timeout)
+
+    $module.FailJson("The Control/M Agent Windows service does not accept connections on the port $Port $Timeout seconds after the restart.")
+}
+
+Function Get-ControlMAgentStartTime {
+    <#
+    .SYNOPSIS
+    Returns the time in UTC when the process of the Control-M Agent service started.
+    #>
+    [OutputType([System.DateTime])]
+    param ()
+
+    $Service = Get-CimInstance -ClassName Win32_Service -Filter "Name='$ServiceName'" -ErrorAction SilentlyContinue
+    if (-not $Service -or -not $Service.ProcessId) {
+        return $null
+    }
+    $Process = Get-Process -Id $Service.ProcessId -ErrorAction SilentlyContinue
+    if (-not $Process) {
+        return $null
+    }
+    return $Process.StartTime.ToUniversalTime()
+}
+
+Function Test-ControlMRestartPending {
+    <#
+    .SYNOPSIS
+    Tests if a deferred restart is still pending.
+    .DESCRIPTION
+    The restart is no longer pending once the agent has been restarted after it was deferred,
+    for instance by a handler of the play.
+    #>
+    [OutputType([System.Boolean])]
+    param ()
+
+    $Marker = $script:Snapshot[$InstanceRegistryPath][$RestartPendingName]
+    if (-not $Marker) {
+        return $false
+    }
+    $DeferredTime = [DateTime]::Parse($Marker, [System.Globalization.CultureInfo]::InvariantCulture, [System.Globalization.DateTimeStyles]::RoundtripKind)
+    $StartTime = Get-ControlMAgentStartTime
+    return -not ($StartTime -and ($StartTime -gt $DeferredTime))
+}
+
+Function Set-ControlMRestartPending {
+    <#
+    .SYNOPSIS
+    Records or clears a deferred restart in the agent registry key.
+    .PARAMETER Pending
+    Specifies whether a restart is pending.
+    #>
+    param (
+        [Parameter(Mandatory = $true)]
+        [bool]
+        $Pending
+    )
+
+    $RegistryKey = Open-ControlMRegistryKey -Path $InstanceRegistryPath
+    try {
+        if ($Pending) {
+            $Marker = [DateTime]::UtcNow.ToString('o')
+            $RegistryKey.SetValue($RestartPendingName, $Marker, [Microsoft.Win32.RegistryValueKind]::String)
+            $script:Snapshot[$InstanceRegistryPath][$RestartPendingName] = $Marker
+        }
+        else {
+            $RegistryKey.DeleteValue($RestartPendingName, $false)
+            $script:Snapshot[$InstanceRegistryPath].Remove($RestartPendingName)
+        }
+        $script:Timings['registry_writes'] += 1
+    }
+    finally {
+        $RegistryKey.Dispose()
+    }
+}
+
+Function Invoke-ControlMRestartPolicy {
+    <#
+    .SYNOPSIS
+    Restarts the Control-M Agent according to the restart option.
+    .DESCRIPTION
+    A restart is required when a setting flagged with Restart in the settings table has changed,
+    or when a deferred restart is still pending.
+    With auto, the agent is restarted once and the module waits until it accepts connections.
+    With deferred, the restart is recorded in the registry and reported until the agent is restarted.
+    With never, the restart is only reported.
+    #>
+    param ()
+
+    $Changed = @($module.Diff.after.Keys | Where-Object { $settings.Contains($_) -and $settings[$_].Restart })
+    $Pending = Test-ControlMRestartPending
+    $module.Result.restart_required = ($Changed.Count -gt 0) -or $Pending
+
+    if (-not $module.Result.restart_required -or (Test-ControlMReadOnly)) {
+        return
+    }
+
+    switch ($module.Params.restart) {
+        'auto' {
+            Restart-AgentService
+            Wait-ControlMAgentReady -Timeout $module.Params.restart_timeout
+            if ($Pending) { Set-ControlMRestartPending -Pending $false }
+            $module.Result.restart_required = $false
+            $module.Result.changed = $true
+        }
+        'deferred' {
+            if (-not $Pending) { Set-ControlMRestartPending -Pending $true }
+        }
+    }
+}
+
+Function Get-ControlMDiagnosticRevert {
+    <#
+    .SYNOPSIS
+    Reads the pending revert of the time-limited diagnostic settings of the selected instance from the snapshot.
+    .OUTPUTS
+    A hashtable with the Expires time, the Restart flag and the values to Restore, each with the option,
+    the registry path and name, and the previous registry value or $null if the value did not exist.
+    $null when no revert is pending.
+    #>
+    [OutputType('System.Collections.Hashtable')]
+    param ()
+
+    $Marker = $script:Snapshot[$InstanceRegistryPath][$DiagnosticRevertName]
+    if (-not $Marker) {
+        return $null
+    }
+    $Revert = ConvertFrom-Json -InputObject $Marker
+    # ConvertFrom-Json already returns a date on PowerShell 6 and later
+    $Expires = $Revert.expires
+    if ($Expires -isnot [DateTime]) {
+        $Expires = [DateTime]::Parse($Expires, [System.Globalization.CultureInfo]::InvariantCulture, [System.Globalization.DateTimeStyles]::RoundtripKind)
+    }
+    return @{
+        Expires = $Expires.ToUniversalTime()
+        Restart = [bool]$Revert.restart
+        Restore = @($Revert.values | Where-Object { $_ })
+    }
+}
+
+Function Get-ControlMDiagnosticReport {
+    <#
+    .SYNOPSIS
+    Returns the pending revert of the time-limited diagnostic settings as reported in diagnostic_revert.
+    .PARAMETER Revert
+    Specifies the revert returned by Get-ControlMDiagnosticRevert.
+    #>
+    [OutputType('System.Collections.Hashtable')]
+    param (
+        [Parameter(Mandatory = $true)]
+        [Hashtable]
+        $Revert
+    )
+
+    $PreviousValues = @{ }
+    foreach ($Value in $Revert.Restore) {
+        $RegistryValue = if ($null -eq $Value.value) { $settings[$Value.option].Default } else { $Value.value }
+        $PreviousValues[$Value.option] = ConvertFrom-ControlMParameter -Name $Value.option -Value $RegistryValue
+    }
+    return @{
+        expires           = $Revert.Expires.ToString('o')
+        remaining_minutes = [int][Math]::Max(0, [Math]::Ceiling(($Revert.Expires - [DateTime]::UtcNow).TotalMinutes))
+        settings          = $PreviousValues
+    }
+}
+
+Function Set-ControlMDiagnosticRevert {
+    <#
+    .SYNOPSIS
+    Records or clears the revert of the time-limited diagnostic settings in the agent registry key.
+    .PARAMETER Revert
+    Specifies the expires, restart and values entries of the revert, or $null to clear it.
+    #>
+    param (
+        [Hashtable]
+        $Revert
+    )
+
+    $RegistryKey = Open-ControlMRegistryKey -Path $InstanceRegistryPath
+    try {
+        if ($Revert) {
+            $Marker = ConvertTo-Json -InputObject $Revert -Compress -Depth 3
+            $RegistryKey.SetValue($DiagnosticRevertName, $Marker, [Microsoft.Win32.RegistryValueKind]::String)
+            $script:Snapshot[$InstanceRegistryPath][$DiagnosticRevertName] = $Marker
+        }
+        else {
+            $RegistryKey.DeleteValue($DiagnosticRevertName, $false)
+            $script:Snapshot[$InstanceRegistryPath].Remove($DiagnosticRevertName)
+        }
+        $script:Timings['registry_writes'] += 1
+    }
+    finally {
+        $RegistryKey.Dispose()
+    }
+}
+
+Function Get-ControlMDiagnosticRevertTaskName {
+    [OutputType([System.String])]
+    param ()
+
+    return "Ansible Control-M Agent diagnostic revert ($ServiceName)"
+}
+
+Function Register-ControlMDiagnosticRevertTask {
+    <#
+    .SYNOPSIS
+    Registers the one-shot scheduled task reverting the time-limited diagnostic settings of the selected instance.
+    .DESCRIPTION
+    The task runs as SYSTEM once the duration has elapsed, or as soon as possible if the host was
+    stopped at that time. It restores the values recorded in the agent registry key, restarts the agent
+    if a restored setting requires it, then removes the record and unregisters itself.
+    An existing task of the instance is replaced.
+    .PARAMETER Expires
+    Specifies when the settings are reverted.
+    #>
+    param (
+        [Parameter(Mandatory = $true)]
+        [DateTime]
+        $Expires
+    )
+
+    $TaskName = Get-ControlMDiagnosticRevertTaskName
+    $Script = @"
+`$Path = '$($InstanceRegistryPath -replace "'", "''")'
+`$Marker = (Get-ItemProperty -Path `$Path -Name '$DiagnosticRevertName' -ErrorAction SilentlyContinue).'$DiagnosticRevertName'
+if (`$Marker) {
+    `$Revert = ConvertFrom-Json -InputObject `$Marker
+    foreach (`$Value in @(`$Revert.values)) {
+        if (`$null -eq `$Value.value) {
+            Remove-ItemProperty -Path `$Value.path -Name `$Value.name -ErrorAction SilentlyContinue
+        }
+        else {
+            Set-ItemProperty -Path `$Value.path -Name `$Value.name -Value `$Value.value -Type String
+        }
+    }
+    Remove-ItemProperty -Path `$Path -Name '$DiagnosticRevertName'
+    if (`$Revert.restart -and ((Get-Service -Name '$($ServiceName -replace "'", "''")').Status -eq 'Running')) {
+        Restart-Service -Name '$($ServiceName -replace "'", "''")' -Force
+    }
+}
+Unregister-ScheduledTask -TaskName '$($TaskName -replace "'", "''")' -Confirm:`$false
+"@
+    $EncodedScript = [Convert]::ToBase64String([System.Text.Encoding]::Unicode.GetBytes($Script))
+    $Action = New-ScheduledTaskAction -Execute 'powershell.exe' -Argument "-NoProfile -NonInteractive -ExecutionPolicy Bypass -EncodedCommand $EncodedScript"
+    $Trigger = New-ScheduledTaskTrigger -Once -At $Expires.ToLocalTime()
+    $Principal = New-ScheduledTaskPrincipal -UserId 'SYSTEM' -LogonType ServiceAccount -RunLevel Highest
+    $TaskSettings = New-ScheduledTaskSettingsSet -StartWhenAvailable
+    Register-ScheduledTask -TaskName $TaskName -Action $Action -Trigger $Trigger -Principal $Principal -Settings $TaskSettings -Force | Out-Null
+}
+
+Function Unregister-ControlMDiagnosticRevertTask {
+    <#
+    .SYNOPSIS
+    Unregisters the scheduled task reverting the time-limited diagnostic settings of the selected instance, if any.
+    #>
+    param ()
+
+    Unregister-ScheduledTask -TaskName (Get-ControlMDiagnosticRevertTaskName) -Confirm:$false -ErrorAction SilentlyContinue
+}
+
+Function Update-ControlMDiagnosticRevert {
+    <#
+    .SYNOPSIS
+    Arms, postpones or cancels the revert of the time-limited diagnostic settings of the selected instance.
+    .DESCRIPTION
+    With the diagnostic_duration option, the previous values of the diagnostic settings changed by the
+    module are recorded in the agent registry key and a scheduled task restores them once the duration
+    has elapsed. A setting already waiting for its revert keeps the value recorded first, and the revert
+    is postponed to the end of the new duration.
+    Without the option, a changed diagnostic setting keeps its new value and is removed from the revert,
+    which is cancelled once it has nothing left to restore.
+    .PARAMETER ChangeSet
+    Specifies the changes written in the registry.
+    #>
+    param (
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyCollection()]
+        [array]
+        $ChangeSet
+    )
+
+    $Changes = @($ChangeSet | Where-Object { $_.Option -in $DiagnosticSettings })
+    $Revert = Get-ControlMDiagnosticRevert
+    if (($Changes.Count -eq 0) -or (-not $Revert -and -not $module.Params.diagnostic_duration)) {
+        return
+    }
+
+    $Values = [ordered]@{ }
+    if ($Revert) {
+        $Revert.Restore | ForEach-Object { $Values[$_.option] = $_ }
+    }
+    foreach ($Change in $Changes) {
+        if (-not $module.Params.diagnostic_duration) {
+            $Values.Remove($Change.Option)
+        }
+        elseif (-not $Values.Contains($Change.Option)) {
+            $Values[$Change.Option] = [PSCustomObject]@{
+                option = $Change.Option
+                path   = $Change.Path
+                name   = $Change.Name
+                value  = if ($Change.Exists) { [string]$Change.PreviousValue } else { $null }
+            }
+        }
+    }
+
+    if ($Values.Count -eq 0) {
+        Set-ControlMDiagnosticRevert -Revert $null
+        Unregister-ControlMDiagnosticRevertTask
+        return
+    }
+
+    $Expires = if ($module.Params.diagnostic_duration) { [DateTime]::UtcNow.AddMinutes($module.Params.diagnostic_duration) } else { $Revert.Expires }
+    Set-ControlMDiagnosticRevert -Revert @{
+        expires = $Expires.ToString('o')
+        restart = [bool]@($Values.Keys | Where-Object { $settings[$_].Restart }).Count
+        values  = @($Values.Values)
+    }
+    if ($module.Params.diagnostic_duration) {
+        Register-ControlMDiagnosticRevertTask -Expires $Expires
+    }
+}
+
+Function Get-ControlMHash {
+    <#
+    .SYNOPSIS
+    Computes a stable SHA-256 hash of a set of entries.
+    .PARAMETER Entries
+    Specifies the entries to hash. The entries are sorted so that the hash does not depend on their order.
+    #>
+    [OutputType([System.String])]
+    param (
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyCollection()]
+        [string[]]
+        $Entries
+    )
+
+    $Text = ($Entries | Sort-Object) -join "`n"
+    $Algorithm = [System.Security.Cryptography.SHA256]::Create()
+    try {
+        $Hash = $Algorithm.ComputeHash([System.Text.Encoding]::UTF8.GetBytes($Text))
+    }
+    finally {
+        $Algorithm.Dispose()
+    }
+    return [System.BitConverter]::ToString($Hash).Replace('-', '')
+}
+
+Function Get-ControlMFingerprint {
+    <#
+    .SYNOPSIS
+    Returns the fingerprint of the desired settings and of the registry values of the selected instance.
+    .DESCRIPTION
+    The registry part of the fingerprint covers all the values of the CONFIG and WIN keys in the snapshot.
+    .PARAMETER Parameters
+    Specifies the desired settings indexed by setting name.
+    .OUTPUTS
+    A hashtable with the Desired and Registry hashes.
+    #>
+    [OutputType('System.Collections.Hashtable')]
+    param (
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyCollection()]
+        [Hashtable]
+        $Parameters
+    )
+
+    $RegistryEntries = foreach ($Path in @($script:Snapshot.Keys | Where-Object { $_ -ne $InstanceRegistryPath })) {
+        $script:Snapshot[$Path].Keys | ForEach-Object { "$Path\$_=$($script:Snapshot[$Path][$_])" }
+    }
+    return @{
+        Desired  = Get-ControlMHash -Entries @($Parameters.Keys | ForEach-Object { "$_=$($Parameters[$_])" })
+        Registry = Get-ControlMHash -Entries @($RegistryEntries)
+    }
+}
+
+Function Get-ControlMFingerprintMarker {
+    <#
+    .SYNOPSIS
+    Reads the fingerprint marker of the selected instance from the snapshot.
+    .DESCRIPTION
+    The marker holds the hash of the registry values followed by the hashes of the desired settings
+    already verified against these values, so that several tasks managing different settings of the
+    same agent do not overwrite each other's fingerprint.
+    .OUTPUTS
+    A hashtable with the Registry hash and the array of Desired hashes.
+    #>
+    [OutputType('System.Collections.Hashtable')]
+    param ()
+
+    $Registry, $Desired = "$($script:Snapshot[$InstanceRegistryPath][$FingerprintName])" -split ';', 2
+    return @{
+        Registry = $Registry
+        Desired  = @("$Desired" -split ',' | Where-Object { $_ })
+    }
+}
+
+Function Test-ControlMFingerprint {
+    <#
+    .SYNOPSIS
+    Tests if the selected instance is known to be in the desired state without comparing each setting.
+    .DESCRIPTION
+    The fingerprint matches when the same desired settings have already been verified and the CONFIG
+    and WIN registry values have not changed since. The snapshot already holds the registry values,
+    so the test does not read the registry again. A pending restart always requires a full run.
+    .PARAMETER Parameters
+    Specifies the desired settings indexed by setting name.
+    #>
+    [OutputType([System.Boolean])]
+    param (
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyCollection()]
+        [Hashtable]
+        $Parameters
+    )
+
+    if ($module.Params.verify -eq 'full') {
+        return $false
+    }
+    $AgentValues = $script:Snapshot[$InstanceRegistryPath]
+    if ($AgentValues.ContainsKey($RestartPendingName) -or -not $AgentValues.ContainsKey($FingerprintName)) {
+        return $false
+    }
+    $Marker = Get-ControlMFingerprintMarker
+    $Fingerprint = Get-ControlMFingerprint -Parameters $Parameters
+    return ($Marker.Registry -eq $Fingerprint.Registry) -and ($Marker.Desired -contains $Fingerprint.Desired)
+}
+
+Function Set-ControlMFingerprint {
+    <#
+    .SYNOPSIS
+    Records the fingerprint of the selected instance in the agent registry key, unless it is already up to date.
+    .DESCRIPTION
+    The desired settings hashes are kept while the registry values do not change, up to $FingerprintLimit hashes.
+    .PARAMETER Parameters
+    Specifies the desired settings indexed by setting name.
+    #>
+    param (
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyCollection()]
+        [Hashtable]
+        $Parameters
+    )
+
+    $Marker = Get-ControlMFingerprintMarker
+    $Fingerprint = Get-ControlMFingerprint -Parameters $Parameters
+    if ($Marker.Registry -ne $Fingerprint.Registry) {
+        $Desired = @($Fingerprint.Desired)
+    }
+    elseif ($Marker.Desired -contains $Fingerprint.Desired) {
+        return
+    }
+    else {
+        $Desired = @($Marker.Desired) + $Fingerprint.Desired | Select-Object -Last $FingerprintLimit
+    }
+
+    $Value = "$($Fingerprint.Registry);$($Desired -join ',')"
+    $RegistryKey = Open-ControlMRegistryKey -Path $InstanceRegistryPath
+    try {
+        $RegistryKey.SetValue($FingerprintName, $Value, [Microsoft.Win32.RegistryValueKind]::String)
+        $script:Timings['registry_writes'] += 1
+        $script:Snapshot[$InstanceRegistryPath][$FingerprintName] = $Value
+    }
+    finally {
+        $RegistryKey.Dispose()
+    }
+}
+
+Function Add-ControlMDiff {
+    <#
+    .SYNOPSIS
+    Reports a change set in the diff of the module.
+    .PARAMETER ChangeSet
+    Specifies the changes built by Get-ControlMChangeSet.
+    #>
+    param (
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyCollection()]
+        [array]
+        $ChangeSet
+    )
+
+    $ChangeSet | ForEach-Object {
+        $module.Diff.before.$($_.Option) = $_.BeforeValue
+        $module.Diff.after.$($_.Option) = $_.AfterValue
+        $module.Result.changed = $true
+    }
+}
+
+Function Add-ControlMFirewallDiff {
+    <#
+    .SYNOPSIS
+    Reports the port changes of the firewall rules in the diff of the module, indexed by rule.
+    .PARAMETER FirewallChanges
+    Specifies the changes built by Get-ControlMFirewallChange.
+    #>
+    param (
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyCollection()]
+        [array]
+        $FirewallChanges
+    )
+
+    if ($FirewallChanges.Count -eq 0) {
+        return
+    }
+    $module.Diff.before.firewall_rules = @{ }
+    $module.Diff.after.firewall_rules = @{ }
+    $FirewallChanges | ForEach-Object {
+        $PortName = if ($_.Property -eq 'LocalPort') { 'local_port' } else { 'remote_port' }
+        if (-not $module.Diff.before.firewall_rules.ContainsKey($_.Rule)) {
+            $module.Diff.before.firewall_rules[$_.Rule] = @{ }
+            $module.Diff.after.firewall_rules[$_.Rule] = @{ }
+        }
+        $module.Diff.before.firewall_rules[$_.Rule][$PortName] = $_.Before
+        $module.Diff.after.firewall_rules[$_.Rule][$PortName] = $_.After
+    }
+}
+
+Function Get-TargetResource {
+    <#
+    .SYNOPSIS
+    Retrieves the settings of the configuration from the snapshot.
+    .PARAMETER Parameters
+    Specifies the names of the settings to retrieve.
+    .PARAMETER ParametersToAdd
+    Accepts an array of any additional setting names to retrieve.
+    #>
+    [OutputType('System.Collections.Hashtable')]
+    param (
+        [parameter(Position = 0, ValueFromPipeline = $true)]
+        [array]$Parameters = (Get-ControlMSettingName),
+        [array]
+        $ParametersToAdd = @()
+    )
+
+    $TargetResource = @{ }
+
+    $Parameters + $ParametersToAdd | ForEach-Object {
+        $ControlMValue = Get-ControlMParameter -Name $_
+        $Value = ConvertFrom-ControlMParameter -Name $_ -Value $ControlMValue
+        $targetResource[$_] = $Value
+    }
+
+    return $targetResource
+}
+
+Function Test-TargetResource {
+    <#
+    .SYNOPSIS
+    Tests if the settings of the configuration are in the desired state.
+    .PARAMETER Parameters
+    Specifies the desired settings indexed by setting name.
+    #>
+    [OutputType([System.Boolean])]
+    param (
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyCollection()]
+        [Hashtable]
+        $Parameters
+    )
+
+    $resources = Get-TargetResource
+
+    if ($resources.Count -eq 0) {
+        return $false
+    }
+
+    $difference = $Parameters.Keys | ForEach-Object { if ($resources.ContainsKey($_)) { if ($resources[$_] -ne $Parameters[$_] ) { $_ } } }
+    $isCompliant = ($null -eq $difference)
+
+    return $isCompliant
+}
+
+function Set-TargetResource {
+    <#
+    .SYNOPSIS
+    Sets the settings of the configuration in the desired state.
+    .PARAMETER Parameters
+    Specifies the desired settings indexed by setting name.
+    #>
+    [OutputType([System.Boolean])]
+    param (
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyCollection()]
+        [Hashtable]
+        $Parameters
+    )
+
+    $Stopwatch = [System.Diagnostics.Stopwatch]::StartNew()
+    $module.Result.changed = $false
+    $resources = Get-TargetResource
+
+    $ChangeSet = Get-ControlMChangeSet -Parameters $Parameters -Resources $resources
+    Add-ControlMDiff -ChangeSet $ChangeSet
+    Add-ControlMTiming -Phase 'compare' -Stopwatch $Stopwatch
+
+    if (-not (Test-ControlMReadOnly) -and $ChangeSet.Count -gt 0) {
+        Invoke-ControlMChangeSet -ChangeSet $ChangeSet
+    }
+    Add-ControlMTiming -Phase 'write' -Stopwatch $Stopwatch
+
+    $FirewallChanges = Get-ControlMFirewallChange -ChangeSet $ChangeSet
+    Add-ControlMFirewallDiff -FirewallChanges $FirewallChanges
+    if (-not (Test-ControlMReadOnly)) {
+        Invoke-ControlMFirewallChange -FirewallChanges $FirewallChanges
+    }
+
+    # Kept for the plan of the instance with mode=plan, see ConvertTo-ControlMPlan
+    $script:PlannedChangeSet = $ChangeSet
+    $script:PlannedFirewallChanges = $FirewallChanges
+    Add-ControlMTiming -Phase 'firewall' -Stopwatch $Stopwatch
+    return $module.Result.changed
+}
+
+Function Get-ControlMConfigReport {
+    <#
+    .SYNOPSIS
+    Returns the configuration to report according to the return_config option.
+    .DESCRIPTION
+    With full, all the settings are reported. With changed, only the settings in the diff are reported.
+    With none, nothing is reported.
+    .OUTPUTS
+    A hashtable of the settings indexed by setting name, or $null with none.
+    #>
+    [OutputType('System.Collections.Hashtable')]
+    param ()
+
+    switch ($module.Params.return_config) {
+        'full' {
+            return Get-TargetResource -Parameters (Get-ControlMSettingName -All)
+        }
+        'changed' {
+            return Get-TargetResource -Parameters @($module.Diff.after.Keys | Where-Object { $settings.Contains($_) })
+        }
+    }
+    return $null
+}
+
+Function Get-ControlMDesiredSetting {
+    <#
+    .SYNOPSIS
+    Returns the settings defined in a set of module parameters.
+    .PARAMETER Parameters
+    Specifies the module parameters, or the parameters of an entry of the instances option.
+    .OUTPUTS
+    A hashtable of the settings with a value, indexed by setting name.
+    #>
+    [OutputType('System.Collections.Hashtable')]
+    param (
+        [Parameter(Mandatory = $true)]
+        $Parameters
+    )
+
+    $DesiredSettings = @{ }
+    Get-ControlMSettingName | ForEach-Object {
+        if ($Parameters.ContainsKey($_) -and -not ($null -eq $Parameters.$_)) {
+            $DesiredSettings.$($_) = $Parameters.$_
+        }
+    }
+    return $DesiredSettings
+}
+
+Function Get-ControlMTuningProfile {
+    <#
+    .SYNOPSIS
+    Returns the settings of the tuning profile selected with the tuning_profile option.
+    .DESCRIPTION
+    A profile of the tuning_profiles option extends the preset of the same name, if any, its settings taking precedence.
+    .OUTPUTS
+    A hashtable of the settings of the profile, indexed by setting name.
+    #>
+    [OutputType('System.Collections.Hashtable')]
+    param ()
+
+    $Name = $module.Params.tuning_profile
+    $UserProfiles = @($module.Params.tuning_profiles | Where-Object { $_ })
+    $ProfileSettings = @{ }
+    $Found = $false
+    if ($TuningProfiles.Contains($Name)) {
+        $TuningProfiles[$Name].GetEnumerator() | ForEach-Object { $ProfileSettings[$_.Key] = $_.Value }
+        $Found = $true
+    }
+    foreach ($UserProfile in @($UserProfiles | Where-Object { $_.name -eq $Name })) {
+        $UserSettings = Get-ControlMDesiredSetting -Parameters $UserProfile
+        $UserSettings.Keys | ForEach-Object { $ProfileSettings[$_] = $UserSettings[$_] }
+        $Found = $true
+    }
+    if (-not $Found) {
+        $Names = @($TuningProfiles.Keys) + @($UserProfiles | ForEach-Object { $_.name }) | Select-Object -Unique
+        $module.FailJson("The tuning profile `"$Name`" does not exist, the profiles are $($Names -join ', ')")
+    }
+    return $ProfileSettings
+}
+
+Function Select-ControlMInstance {
+    <#
+    .SYNOPSIS
+    Selects the agent instance used by the other functions of the module.
+    .PARAMETER Instance
+    Specifies the instance returned by Get-ControlMInstance.
+    #>
+    param (
+        [Parameter(Mandatory = $true)]
+        [Hashtable]
+        $Instance
+    )
+
+    $script:InstanceRegistryPath = $Instance.Path
+    $script:ServiceName = $Instance.ServiceName
+    $script:Snapshot = $Instance.Snapshot
+}
+
+Function Get-ControlMInstance {
+    <#
+    .SYNOPSIS
+    Finds the agent instances and the settings to apply to each of them.
+    .DESCRIPTION
+    Without the instances option, only the agent stored in the agent registry key is configured.
+    Otherwise, the instances are found with a single listing of the agent registry key: the agent key
+    itself, named after its default agent name, and each subkey holding a CONFIG key.
+    The settings of the module apply to every targeted instance, the settings of an entry of
+    the instances option override them. An entry named all targets every instance. The instances
+    which are not targeted get no settings, they keep their stored values.
+    .PARAMETER Parameters
+    Specifies the settings defined at the module level.
+    .OUTPUTS
+    An array of hashtables with the name, registry path, service name, snapshot, settings of the instance
+    and whether it is targeted.
+    #>
+    [OutputType('System.Array')]
+    param (
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyCollection()]
+        [Hashtable]
+        $Parameters
+    )
+
+    $Instances = [System.Collections.ArrayList]@()
+    if (-not $module.Params.instances) {
+        $Instances.Add(@{ Path = $AgentRegistryPath; ServiceName = 'ctmag' }) | Out-Null
+    }
+    else {
+        $SubKeys = @(Get-ChildItem -Path $AgentRegistryPath -ErrorAction SilentlyContinue)
+        if ($SubKeys | Where-Object { $_.PSChildName -eq 'CONFIG' }) {
+            $Instances.Add(@{ Path = $AgentRegistryPath; ServiceName = 'ctmag' }) | Out-Null
+        }
+        $SubKeys | Where-Object { ($_.PSChildName -notin @('CONFIG', 'WIN')) -and (@($_.GetSubKeyNames()) -contains 'CONFIG') } | ForEach-Object {
+            $Instances.Add(@{ Name = $_.PSChildName; Path = "$AgentRegistryPath\$($_.PSChildName)"; ServiceName = "ctmag_$($_.PSChildName)" }) | Out-Null
+        }
+    }
+
+    foreach ($Instance in $Instances) {
+        Select-ControlMInstance -Instance $Instance
+        $Instance.Snapshot = Get-ControlMSnapshot -Root $script:InstanceRegistryPath
+        $script:Timings['registry_reads'] += $Instance.Snapshot.Count
+        if (-not $Instance.Name) {
+            $DefaultAgentName = Get-ControlMParameter -Name 'default_agent_name'
+            $Instance.Name = if ($DefaultAgentName) { $DefaultAgentName } else { 'Default' }
+        }
+        $Instance.Target = -not $module.Params.instances
+        $Instance.Parameters = if ($Instance.Target) { $Parameters.Clone() } else { @{ } }
+    }
+
+    foreach ($Requested in @($module.Params.instances | Where-Object { $_ })) {
+        $Matching = @($Instances | Where-Object { ($Requested.name -eq 'all') -or ($_.Name -eq $Requested.name) })
+        if ($Matching.Count -eq 0) {
+            $module.FailJson("The Control-M Agent instance `"$($Requested.name)`" is not installed. Installed instances: $(($Instances | ForEach-Object { $_.Name }) -join ', ')")
+        }
+        $InstanceSettings = Get-ControlMDesiredSetting -Parameters $Requested
+        foreach ($Instance in $Matching) {
+            if (-not $Instance.Target) {
+                $Instance.Target = $true
+                $Instance.Parameters = $Parameters.Clone()
+            }
+            $InstanceSettings.Keys | ForEach-Object { $Instance.Parameters[$_] = $InstanceSettings[$_] }
+            if ($Requested.service_name) { $Instance.ServiceName = $Requested.service_name }
+        }
+    }
+    return , $Instances.ToArray()
+}
+
+Function Assert-ControlMSettingRequirement {
+    <#
+    .SYNOPSIS
+    Fails the module if a setting is set while the setting it requires has another value.
+    .DESCRIPTION
+    The Requires field of the settings table holds the name and the value of the required setting. The desired
+    value of the required setting is used, or its stored value when it is not set.
+    .PARAMETER Instances
+    Specifies the instances returned by Get-ControlMInstance.
+    #>
+    param (
+        [Parameter(Mandatory = $true)]
+        [array]
+        $Instances
+    )
+
+    foreach ($Instance in @($Instances | Where-Object { $_.Target })) {
+        Select-ControlMInstance -Instance $Instance
+        foreach ($Setting in $settings.GetEnumerator()) {
+            if (-not $Setting.Value.Requires -or -not $Instance.Parameters.ContainsKey($Setting.Key) -or ("$($Instance.Parameters[$Setting.Key])" -eq '')) { continue }
+            $RequiredName, $RequiredValue = $Setting.Value.Requires -split '=', 2
+            $Value = if ($Instance.Parameters.ContainsKey($RequiredName)) { $Instance.Parameters[$RequiredName] } else { ConvertFrom-ControlMParameter -Name $RequiredName -Value (Get-ControlMParameter -Name $RequiredName) }
+            if ("$Value" -ne $RequiredValue) {
+                $module.FailJson("value of $($Setting.Key) requires $RequiredName to be $RequiredValue, got: $Value")
+            }
+        }
+    }
+}
+
+Function Assert-ControlMInstancePort {
+    <#
+    .SYNOPSIS
+    Fails the module if two agent instances, or the two ports of an instance, would use the same port.
+    .DESCRIPTION
+    The desired ports of the targeted instances are compared with each other and with the stored ports of
+    the other instances.
+    .PARAMETER Instances
+    Specifies the instances returned by Get-ControlMInstance.
+    #>
+    param (
+        [Parameter(Mandatory = $true)]
+        [array]
+        $Instances
+    )
+
+    $Ports = @{ }
+    foreach ($Instance in $Instances) {
+        Select-ControlMInstance -Instance $Instance
+        foreach ($Name in @('server_to_agent_port', 'tracker_event_port')) {
+            $Port = if ($Instance.Parameters.ContainsKey($Name)) { [string]$Instance.Parameters[$Name] } else { [string](Get-ControlMParameter -Name $Name) }
+            $Owner = $Ports[$Port]
+            if ($Owner -and ($Owner.Instance -eq $Instance.Name)) {
+                $module.FailJson("The $Name $Port of the Control-M Agent instance `"$($Instance.Name)`" clashes with its $($Owner.Name)")
+            }
+            if ($Owner) {
+                $module.FailJson("The $Name $Port of the Control-M Agent instance `"$($Instance.Name)`" clashes with the $($Owner.Name) of the instance `"$($Owner.Instance)`"")
+            }
+            $Ports[$Port] = @{ Instance = $Instance.Name; Name = $Name }
+        }
+    }
+}
+
+Function Get-ControlMInstanceResult {
+    <#
+    .SYNOPSIS
+    Returns the result of the agent instance selected with Select-ControlMInstance.
+    .DESCRIPTION
+    The full configuration of the instance is also recorded in the controlm_agent fact, with the time it
+    was collected and whether the run wrote to the registry. The action plugin does not trust a cached
+    entry written by the run which collected it, see the trust_cached_facts_for option.
+    .PARAMETER Name
+    Specifies the name of the instance.
+    .OUTPUTS
+    A hashtable with the changed flag, the restart_required flag, the diff, the pending revert of the
+    time-limited diagnostic settings if any and, unless return_config is none, the configuration of the instance.
+    #>
+    [OutputType('System.Collections.Hashtable')]
+    param (
+        [Parameter(Mandatory = $true)]
+        [string]
+        $Name
+    )
+
+    $InstanceResult = @{
+        changed          = $module.Result.changed
+        restart_required = $module.Result.restart_required
+        diff             = @{ before = $module.Diff.before; after = $module.Diff.after }
+    }
+    $Revert = Get-ControlMDiagnosticRevert
+    if ($Revert) {
+        $InstanceResult.diagnostic_revert = Get-ControlMDiagnosticReport -Revert $Revert
+    }
+    $Config = Get-ControlMConfigReport
+    if ($null -ne $Config) {
+        $InstanceResult.config = $Config
+    }
+
+    $script:Facts[$Name] = @{
+        config           = if ($module.Params.return_config -eq 'full') { $Config } else { Get-TargetResource -Parameters (Get-ControlMSettingName -All) }
+        collected        = [DateTime]::UtcNow.ToString('o')
+        written          = $InstanceResult.changed -and -not (Test-ControlMReadOnly)
+        restart_required = $InstanceResult.restart_required
+        default_instance = $script:InstanceRegistryPath -eq $AgentRegistryPath
+        expires          = if ($Revert) { $InstanceResult.diagnostic_revert.expires } else { $null }
+    }
+    return $InstanceResult
+}
+
+Function Test-ControlMServerConnectivity {
+    <#
+    .SYNOPSIS
+    Resolves and probes Control-M Server hosts concurrently within a single timeout.
+    .DESCRIPTION
+    All the host names are resolved at once, and the port of each host is probed as soon as the host
+    is resolved, so that the whole check takes at most the timeout however many hosts are listed.
+    .PARAMETER Targets
+    Specifies hashtables with the Host and the Port to probe.
+    .PARAMETER Timeout
+    Specifies the maximum time in milliseconds of the whole check.
+    .OUTPUTS
+    An array of dictionaries with the host, the port, the resolved addresses, whether the port accepts
+    connections, the connection latency in milliseconds and the error of each target.
+    #>
+    [OutputType('System.Array')]
+    param (
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyCollection()]
+        [array]
+        $Targets,
+        [Parameter(Mandatory = $true)]
+        [int]
+        $Timeout
+    )
+
+    $Stopwatch = [System.Diagnostics.Stopwatch]::StartNew()
+    $Probes = @(foreach ($Target in $Targets) {
+            $Probe = @{
+                Result       = [ordered]@{ host = $Target.Host; port = $Target.Port; addresses = @(); reachable = $false; latency_ms = $null; error = $null }
+                Task         = $null
+                Client       = $null
+                ConnectStart = 0
+            }
+            try {
+                $Probe.Task = [System.Net.Dns]::GetHostAddressesAsync($Target.Host)
+            }
+            catch {
+                $Probe.Result.error = $_.Exception.Message
+            }
+            $Probe
+        })
+
+    try {
+        while ($true) {
+            $Pending = @($Probes | Where-Object { $_.Task })
+            $Remaining = $Timeout - $Stopwatch.ElapsedMilliseconds
+            if (($Pending.Count -eq 0) -or ($Remaining -le 0)) {
+                break
+            }
+            $Index = [System.Threading.Tasks.Task]::WaitAny([System.Threading.Tasks.Task[]]@($Pending | ForEach-Object { $_.Task }), [int]$Remaining)
+            if ($Index -lt 0) {
+                break
+            }
+
+            $Probe = $Pending[$Index]
+            $Task = $Probe.Task
+            $Probe.Task = $null
+            if ($Task.Status -ne 'RanToCompletion') {
+                $Probe.Result.error = if ($Task.Exception) { $Task.Exception.GetBaseException().Message } else { "$($Task.Status)" }
+                continue
+            }
+
+            if ($null -eq $Probe.Client) {
+                # The host is resolved, IPv4 addresses are probed first
+                $Addresses = @($Task.Result | Sort-Object -Property { $_.AddressFamily -ne 'InterNetwork' })
+                $Probe.Result.addresses = @($Addresses | ForEach-Object { $_.IPAddressToString })
+                if ($Addresses.Count -eq 0) {
+                    $Probe.Result.error = "The host name does not resolve to any address"
+                    continue
+                }
+                $Probe.Client = New-Object -TypeName System.Net.Sockets.TcpClient -ArgumentList $Addresses[0].AddressFamily
+                $Probe.ConnectStart = $Stopwatch.ElapsedMilliseconds
+                $Probe.Task = $Probe.Client.ConnectAsync($Addresses[0], [int]$Probe.Result.port)
+            }
+            else {
+                $Probe.Result.reachable = $Probe.Client.Connected
+                $Probe.Result.latency_ms = $Stopwatch.ElapsedMilliseconds - $Probe.ConnectStart
+            }
+        }
+    }
+    finally {
+        $Probes | Where-Object { $_.Client } | ForEach-Object { $_.Client.Close() }
+    }
+
+    $Probes | Where-Object { $_.Task } | ForEach-Object {
+        $_.Result.error = "No answer within the connectivity timeout"
+    }
+    return , @($Probes | ForEach-Object { $_.Result })
+}
+
+Function Invoke-ControlMConnectivityCheck {
+    <#
+    .SYNOPSIS
+    Checks that the Control-M Server hosts of the instances accept connections on the agent-to-server port.
+    .DESCRIPTION
+    The primary and authorized hosts and the agent-to-server port of each targeted instance are taken from
+    the desired settings, or from the registry when they are not set. The hosts of all the instances are
+    probed at once, before anything is written. With verify_connectivity=fail, the module fails if a host
+    is not reachable.
+    .PARAMETER Instances
+    Specifies the instances returned by Get-ControlMInstance.
+    #>
+    param (
+        [Parameter(Mandatory = $true)]
+        [array]
+        $Instances
+    )
+
+    $Targets = [ordered]@{ }
+    foreach ($Instance in @($Instances | Where-Object { $_.Target })) {
+        Select-ControlMInstance -Instance $Instance
+        $Values = @{ }
+        foreach ($Name in @('agent_to_server_port', 'primary_controlm_server_host', 'authorized_controlm_server_hosts')) {
+            $Values[$Name] = if ($Instance.Parameters.ContainsKey($Name)) { $Instance.Parameters[$Name] } else { Get-ControlMParameter -Name $Name }
+        }
+        $Port = [int]$Values.agent_to_server_port
+        @("$($Values.primary_controlm_server_host)") + @("$($Values.authorized_controlm_server_hosts)" -split '\|') | ForEach-Object { $_.Trim() } | Where-Object { $_ } | ForEach-Object {
+            $Key = "$($_.ToLowerInvariant()):$Port"
+            if (-not $Targets.Contains($Key)) {
+                $Targets[$Key] = @{ Host = $_; Port = $Port }
+            }
+        }
+    }
+
+    $Results = Test-ControlMServerConnectivity -Targets @($Targets.Values) -Timeout ($module.Params.connectivity_timeout * 1000)
+    $module.Result.connectivity = $Results
+
+    $Unreachable = @($Results | Where-Object { -not $_.reachable } | ForEach-Object { "$($_.host):$($_.port)" })
+    if (($module.Params.verify_connectivity -eq 'fail') -and ($Unreachable.Count -gt 0)) {
+        $module.FailJson("The Control-M Server hosts $($Unreachable -join ', ') are not reachable, nothing has been changed")
+    }
+}
+
+Function Get-ControlMLogUsage {
+    <#
+    .SYNOPSIS
+    Reports the disk space used by the logs of the selected instance, and estimates it under the retention settings.
+    .DESCRIPTION
+    The log directories under the agent directory are enumerated file by file, without building the list
+    of their files, and each directory of the $LogCategories table is enumerated only once. Only the counts
+    of each category are kept. The scan stops once log_usage_timeout seconds have elapsed and the usage is
+    then reported as truncated.
+    The estimate counts the files which the retention would keep, each up to the size limit of its category
+    and only the most recent versions of each log file, and nothing for a category whose files are no longer
+    written. The estimate is a running total: only the limit_log_version + 1 most recent versions of each log
+    file are kept during the scan, a more recent version replacing the oldest kept one, so that the memory
+    used does not grow with the number of files. The file name patterns of the categories are built once,
+    before the scan.
+    .PARAMETER Parameters
+    Specifies the desired settings indexed by setting name. The stored settings are used for the others.
+    .OUTPUTS
+    An ordered dictionary with the agent directory, the truncated flag, the scan time and the usage of each category.
+    #>
+    [OutputType('System.Collections.Specialized.OrderedDictionary')]
+    param (
+        [Parameter(Mandatory = $true)]
+        [AllowEmptyCollection()]
+        [Hashtable]
+        $Parameters
+    )
+
+    $Stopwatch = [System.Diagnostics.Stopwatch]::StartNew()
+    $TimeLimit = $module.Params.log_usage_timeout * 1000
+    $Now = [DateTime]::UtcNow
+    $AgentDirectory = Get-ControlMParameter -Name 'agent_directory'
+    $Usage = [ordered]@{
+        path      = $AgentDirectory
+        truncated = $false
+        scan_ms   = 0
+    }
+
+    $Counters = @{ }
+    foreach ($Category in $LogCategories.GetEnumerator()) {
+        $Values = @{ }
+        foreach ($Name in @($Category.Value.Retention, $Category.Value.SizeLimit, $Category.Value.Versions, $Category.Value.Enabled) | Where-Object { $_ }) {
+            $Values[$Name] = if ($Parameters.ContainsKey($Name)) { $Parameters[$Name] } else { ConvertFrom-ControlMParameter -Name $Name -Value (Get-ControlMParameter -Name $Name) }
+        }
+        $Counters[$Category.Key] = @{
+            Files         = 0
+            Bytes         = [long]0
+            EstimatedBytes = [long]0
+            Oldest        = $null
+            RetentionDays = $Values[$Category.Value.Retention]
+            SizeLimit     = if ($Category.Value.SizeLimit) { [long]$Values[$Category.Value.SizeLimit] * 1MB } else { [long]::MaxValue }
+            Written       = (-not $Category.Value.Enabled) -or $Values[$Category.Value.Enabled]
+            Patterns      = @($Category.Value.Filter | Where-Object { $_ } | ForEach-Object {
+                    New-Object -TypeName System.Management.Automation.WildcardPattern -ArgumentList $_, ([System.Management.Automation.WildcardOptions]::IgnoreCase)
+                })
+            # Last write time and size of the most recent versions of each log file, when the versions are limited
+            Versions      = if ($Category.Value.Versions) { [int]$Values[$Category.Value.Versions] } else { $null }
+            Logs          = @{ }
+        }
+    }
+    $VersionSuffix = [Regex]'\.\d+$'
+
+    # The categories with a filter take the matching files of their directory, the other category takes the rest
+    foreach ($Group in ($LogCategories.GetEnumerator() | Group-Object -Property { $_.Value.Path })) {
+        $Root = Join-Path -Path $AgentDirectory -ChildPath $Group.Name
+        if (-not $AgentDirectory -or -not [System.IO.Directory]::Exists($Root)) { continue }
+        $Filtered = @($Group.Group | Where-Object { $_.Value.Filter } | ForEach-Object { $Counters[$_.Key] })
+        $Default = @($Group.Group | Where-Object { -not $_.Value.Filter } | ForEach-Object { $Counters[$_.Key] })[0]
+
+        $Pending = New-Object -TypeName System.Collections.Stack
+        $Pending.Push([System.IO.DirectoryInfo]$Root)
+        while (($Pending.Count -gt 0) -and -not $Usage.truncated) {
+            $Directory = $Pending.Pop()
+            try {
+                $Directory.EnumerateDirectories() | ForEach-Object { $Pending.Push($_) }
+                $Files = $Directory.EnumerateFiles().GetEnumerator()
+            }
+            catch {
+                continue
+            }
+            while ($true) {
+                if ($Stopwatch.ElapsedMilliseconds -ge $TimeLimit) {
+                    $Usage.truncated = $true
+                    break
+                }
+                try {
+                    if (-not $Files.MoveNext()) { break }
+                }
+                catch {
+                    break
+                }
+                $File = $Files.Current
+                $Counter = $Default
+                :Candidates foreach ($Candidate in $Filtered) {
+                    foreach ($Pattern in $Candidate.Patterns) {
+                        if ($Pattern.IsMatch($File.Name)) {
+                            $Counter = $Candidate
+                            break Candidates
+                        }
+                    }
+                }
+                if ($null -eq $Counter) { continue }
+
+                $Counter.Files += 1
+                $Counter.Bytes += $File.Length
+                $LastWrite = $File.LastWriteTimeUtc
+                if (($null -eq $Counter.Oldest) -or ($LastWrite -lt $Counter.Oldest)) {
+                    $Counter.Oldest = $LastWrite
+                }
+                if ($Counter.Written -and (($Now - $LastWrite).TotalDays -le $Counter.RetentionDays)) {
+                    $KeptBytes = [Math]::Min($File.Length, $Counter.SizeLimit)
+                    if ($null -eq $Counter.Versions) {
+                        $Counter.EstimatedBytes += $KeptBytes
+                    }
+                    else {
+                        # The current file of a log and its most recent older versions are kept
+                        $LogName = $VersionSuffix.Replace($File.Name, '')
+                        $Kept = $Counter.Logs[$LogName]
+                        if ($null -eq $Kept) {
+                            $Kept = New-Object -TypeName System.Collections.ArrayList
+                            $Counter.Logs[$LogName] = $Kept
+                        }
+                        if ($Kept.Count -le $Counter.Versions) {
+                            $Kept.Add(@{ LastWrite = $LastWrite; Bytes = $KeptBytes }) | Out-Null
+                            $Counter.EstimatedBytes += $KeptBytes
+                        }
+                        else {
+                            $Oldest = $Kept[0]
+                            foreach ($Version in $Kept) {
+                                if ($Version.LastWrite -lt $Oldest.LastWrite) { $Oldest = $Version }
+                            }
+                            if ($LastWrite -gt $Oldest.LastWrite) {
+                                $Counter.EstimatedBytes += $KeptBytes - $Oldest.Bytes
+                                $Oldest.LastWrite = $LastWrite
+                                $Oldest.Bytes = $KeptBytes
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+    foreach ($Name in $LogCategories.Keys) {
+        $Counter = $Counters[$Name]
+        $Usage[$Name] = [ordered]@{
+            path                 = Join-Path -Path $AgentDirectory -ChildPath $LogCategories[$Name].Path
+            files                = $Counter.Files
+            bytes                = $Counter.Bytes
+            oldest_file_age_days = if ($Counter.Oldest) { [Math]::Round(($Now - $Counter.Oldest).TotalDays, 1) } else { $null }
+            retention_days       = $Counter.RetentionDays
+            estimated_bytes      = $Counter.EstimatedBytes
+        }
+    }
+    $Usage.scan_ms = $Stopwatch.ElapsedMilliseconds
+    return $Usage
+}
+
+Function Invoke-ControlMInstance {
+    <#
+    .SYNOPSIS
+    Applies the settings of an agent instance.
+    .DESCRIPTION
+    With mode=plan, nothing is changed and the plan of the instance is stored in its Plan entry.
+    .PARAMETER Instance
+    Specifies the instance returned by Get-ControlMInstance.
+    .OUTPUTS
+    The result of the instance, see Get-ControlMInstanceResult.
+    #>
+    [OutputType('System.Collections.Hashtable')]
+    param (
+        [Parameter(Mandatory = $true)]
+        [Hashtable]
+        $Instance
+    )
+
+    Select-ControlMInstance -Instance $Instance
+
+    $module.Result.changed = $false
+    $module.Result.restart_required = $false
+    $module.Diff.before = @{ }
+    $module.Diff.after = @{ }
+    $script:PlannedChangeSet = @()
+    $script:PlannedFirewallChanges = @()
+
+    $Stopwatch = [System.Diagnostics.Stopwatch]::StartNew()
+    if (Test-ControlMFingerprint -Parameters $Instance.Parameters) {
+        Add-ControlMTiming -Phase 'compare' -Stopwatch $Stopwatch
+    }
+    else {
+        Get-Service -Name $ServiceName -ErrorAction SilentlyContinue -ErrorVariable ProcessError | Out-Null
+        If ($ProcessError) {
+            $module.FailJson("The Control/M Agent Windows service is not installed. $ProcessError")
+        }
+
+        $IsCompliant = Test-TargetResource -Parameters $Instance.Parameters
+        Add-ControlMTiming -Phase 'compare' -Stopwatch $Stopwatch
+        if (-not $IsCompliant) {
+            Set-TargetResource -Parameters $Instance.Parameters | Out-Null
+            $Stopwatch.Restart()
+        }
+        if (-not (Test-ControlMReadOnly)) {
+            Update-ControlMDiagnosticRevert -ChangeSet $script:PlannedChangeSet
+        }
+        Add-ControlMTiming -Phase 'write' -Stopwatch $Stopwatch
+
+        Invoke-ControlMRestartPolicy
+        Add-ControlMTiming -Phase 'restart' -Stopwatch $Stopwatch
+
+        if (-not (Test-ControlMReadOnly)) {
+            Set-ControlMFingerprint -Parameters $Instance.Parameters
+        }
+        Add-ControlMTiming -Phase 'write' -Stopwatch $Stopwatch
+    }
+
+    if ($module.Params.mode -eq 'plan') {
+        $Instance.Plan = ConvertTo-ControlMPlan -Instance $Instance
+    }
+    $InstanceResult = Get-ControlMInstanceResult -Name $Instance.Name
+    Add-ControlMTiming -Phase 'report' -Stopwatch $Stopwatch
+
+    if ($module.Params.report_log_usage) {
+        $InstanceResult.log_usage = Get-ControlMLogUsage -Parameters $Instance.Parameters
+        Add-ControlMTiming -Phase 'log_usage' -Stopwatch $Stopwatch
+    }
+    return $InstanceResult
+}
+
+Function ConvertTo-ControlMPlan {
+    <#
+    .SYNOPSIS
+    Serializes the changes worked out for an agent instance into an entry of the plan.
+    .DESCRIPTION
+    Each setting records the raw registry value expected before the change, $null if the value
+    does not exist, and the raw registry value to write. Each firewall rule records the ports
+    expected before the change and the ports to set.
+    .PARAMETER Instance
+    Specifies the instance returned by Get-ControlMInstance.
+    .OUTPUTS
+    A hashtable with the name, registry path and service name of the instance, the settings and
+    firewall rules to change and whether a restart is required.
+    #>
+    [OutputType('System.Collections.Hashtable')]
+    param (
+        [Parameter(Mandatory = $true)]
+        [Hashtable]
+        $Instance
+    )
+
+    return @{
+        name             = $Instance.Name
+        path             = $Instance.Path
+        service_name     = $Instance.ServiceName
+        settings         = @($script:PlannedChangeSet | ForEach-Object {
+                @{
+                    option   = $_.Option
+                    expected = if ($_.Exists) { [string]$_.PreviousValue } else { $null }
+                    value    = $_.Value
+                }
+            })
+        firewall_rules   = @($script:PlannedFirewallChanges | ForEach-Object {
+                @{ rule = $_.Rule; property = $_.Property; before = $_.Before; after = $_.After }
+            })
+        restart_required = $module.Result.restart_required
+    }
+}
+
+Function Invoke-ControlMPlan {
+    <#
+    .SYNOPSIS
+    Applies a plan made with mode=plan.
+    .DESCRIPTION
+    The registry values and the firewall ports recorded in the plan are checked against their expected
+    values on every instance before anything is written, and the module fails if the host has drifted
+    since the plan was made. The planned values are then written as they are, the desired settings are
+    not compared again.
+    .PARAMETER Plan
+    Specifies the plan returned by mode=plan.
+    .OUTPUTS
+    An ordered dictionary of the results of the instances, indexed by instance name.
+    #>
+    [OutputType('System.Collections.Specialized.OrderedDictionary')]
+    param (
+        [Parameter(Mandatory = $true)]
+        $Plan
+    )
+
+    if ($Plan.version -ne $PlanVersion) {
+        $module.FailJson("The version $($Plan.version) of the plan is not supported, make the plan again with mode=plan")
+    }
+    $Entries = if ($Plan.ContainsKey('instances')) { $Plan.instances } else { $Plan.agent }
+    $Entries = @($Entries | Where-Object { $_ })
+    if ($Entries.Count -eq 0) {
+        $module.FailJson("The plan does not contain any Control-M Agent instance")
+    }
+
+    $Stopwatch = [System.Diagnostics.Stopwatch]::StartNew()
+    $Drift = [System.Collections.ArrayList]@()
+    $Instances = [System.Collections.ArrayList]@()
+    foreach ($Entry in $Entries) {
+        if (($Entry.path -ne $AgentRegistryPath) -and -not "$($Entry.path)".StartsWith("$AgentRegistryPath\")) {
+            $module.FailJson("The registry key `"$($Entry.path)`" of the plan is not a Control-M Agent key")
+        }
+        $Instance = @{ Name = $Entry.name; Path = $Entry.path; ServiceName = $Entry.service_name; Entry = $Entry }
+        Select-ControlMInstance -Instance $Instance
+        $Instance.Snapshot = Get-ControlMSnapshot -Root $script:InstanceRegistryPath
+        $script:Timings['registry_reads'] += $Instance.Snapshot.Count
+        foreach ($Planned in @($Entry.settings | Where-Object { $_ })) {
+            if (-not $settings.Contains([string]$Planned.option) -or $settings[$Planned.option].ReadOnly) {
+                $module.FailJson("The plan contains the unknown setting `"$($Planned.option)`"")
+            }
+            $RegistryValues = $Instance.Snapshot[(Get-ControlMRegistryPath -Name $Planned.option -Root $script:InstanceRegistryPath)]
+            $Name = $settings[$Planned.option].Name
+            $Current = if ($RegistryValues.ContainsKey($Name)) { [string]$RegistryValues[$Name] } else { $null }
+            if ($Current -cne $Planned.expected) {
+                $Drift.Add("the `"$($Planned.option)`" setting of the instance `"$($Instance.Name)`" is `"$Current`" instead of `"$($Planned.expected)`"") | Out-Null
+            }
+        }
+        $Instances.Add($Instance) | Out-Null
+    }
+
+    # The port filters of all the planned rules are listed at once
+    $PlannedRules = @($Instances | ForEach-Object { $_.Entry.firewall_rules } | Where-Object { $_ })
+    $Filters = @{ }
+    if ($PlannedRules.Count -gt 0) {
+        $RuleNames = @($PlannedRules | ForEach-Object { [string]$_.rule } | Select-Object -Unique)
+        Get-NetFirewallRule -Name $RuleNames -ErrorAction SilentlyContinue | Get-NetFirewallPortFilter | ForEach-Object {
+            $script:Timings['firewall_filters_scanned'] += 1
+            $Filters[$_.InstanceID] = $_
+        }
+    }
+    foreach ($Instance in $Instances) {
+        $FirewallChanges = [System.Collections.ArrayList]@()
+        foreach ($Planned in @($Instance.Entry.firewall_rules | Where-Object { $_ })) {
+            if ($Planned.property -notin @('LocalPort', 'RemotePort')) {
+                $module.FailJson("The plan contains the unknown port property `"$($Planned.property)`" for the firewall rule `"$($Planned.rule)`"")
+            }
+            $Filter = $Filters[[string]$Planned.rule]
+            if (-not $Filter) {
+                $Drift.Add("the firewall rule `"$($Planned.rule)`" does not exist") | Out-Null
+                continue
+            }
+            $Ports = @($Filter.($Planned.property) | ForEach-Object { [string]$_ })
+            if (($Ports -join ',') -cne (@($Planned.before) -join ',')) {
+                $Drift.Add("the $($Planned.property) of the firewall rule `"$($Planned.rule)`" is $($Ports -join ',') instead of $(@($Planned.before) -join ',')") | Out-Null
+            }
+            $FirewallChanges.Add(@{
+                    Filter   = $Filter
+                    Rule     = $Filter.InstanceID
+                    Property = $Planned.property
+                    Before   = $Ports
+                    After    = @($Planned.after | ForEach-Object { [string]$_ })
+                }) | Out-Null
+        }
+        $Instance.FirewallChanges = $FirewallChanges.ToArray()
+    }
+
+    if ($Drift.Count -gt 0) {
+        $module.Result.drift = $Drift.ToArray()
+        $module.FailJson("The host has drifted since the plan was made, nothing has been changed: $($Drift -join '; ')")
+    }
+    Add-ControlMTiming -Phase 'compare' -Stopwatch $Stopwatch
+
+    $InstanceResults = [ordered]@{ }
+    foreach ($Instance in $Instances) {
+        Select-ControlMInstance -Instance $Instance
+        $module.Result.changed = $false
+        $module.Result.restart_required = $false
+        $module.Diff.before = @{ }
+        $module.Diff.after = @{ }
+
+        $ChangeSet = @(foreach ($Planned in @($Instance.Entry.settings | Where-Object { $_ })) {
+                $BeforeValue = ConvertFrom-ControlMParameter -Name $Planned.option -Value (Get-ControlMParameter -Name $Planned.option)
+                $AfterValue = ConvertFrom-ControlMParameter -Name $Planned.option -Value $Planned.value
+                $Change = New-ControlMChange -Name $Planned.option -Value $Planned.value -BeforeValue $BeforeValue -AfterValue $AfterValue
+                if ($Change) { $Change }
+            })
+        Add-ControlMDiff -ChangeSet $ChangeSet
+        if (-not (Test-ControlMReadOnly) -and $ChangeSet.Count -gt 0) {
+            Invoke-ControlMChangeSet -ChangeSet $ChangeSet
+            Update-ControlMDiagnosticRevert -ChangeSet $ChangeSet
+        }
+        Add-ControlMTiming -Phase 'write' -Stopwatch $Stopwatch
+
+        Add-ControlMFirewallDiff -FirewallChanges $Instance.FirewallChanges
+        if (-not (Test-ControlMReadOnly)) {
+            Invoke-ControlMFirewallChange -FirewallChanges $Instance.FirewallChanges
+        }
+        Add-ControlMTiming -Phase 'firewall' -Stopwatch $Stopwatch
+
+        Invoke-ControlMRestartPolicy
+        Add-ControlMTiming -Phase 'restart' -Stopwatch $Stopwatch
+
+        $InstanceResults[$Instance.Name] = Get-ControlMInstanceResult -Name $Instance.Name
+        Add-ControlMTiming -Phase 'report' -Stopwatch $Stopwatch
+
+        if ($module.Params.report_log_usage) {
+            $InstanceResults[$Instance.Name].log_usage = Get-ControlMLogUsage -Parameters @{ }
+            Add-ControlMTiming -Phase 'log_usage' -Stopwatch $Stopwatch
+        }
+    }
+    return $InstanceResults
+}
+
+$module = [Ansible.Basic.AnsibleModule]::Create($args, $spec)
+Assert-ControlMSettingRange -Parameters $module.Params
+@($module.Params.instances | Where-Object { $_ }) | ForEach-Object { Assert-ControlMSettingRange -Parameters $_ }
+if ($module.Params.settings) {
+    Assert-ControlMSettingRange -Parameters $module.Params.settings
+}
+@($module.Params.tuning_profiles | Where-Object { $_ }) | ForEach-Object { Assert-ControlMSettingRange -Parameters $_ }
+if (($null -ne $module.Params.diagnostic_duration) -and ($module.Params.diagnostic_duration -lt 1)) {
+    $module.FailJson("The diagnostic_duration option must be at least 1 minute")
+}
+if ($module.Params.log_usage_timeout -lt 1) {
+    $module.FailJson("The log_usage_timeout option must be at least 1 second")
+}
+
+# The settings passed as options take precedence over the settings dictionary, which takes
+# precedence over the tuning profile
+$params = @{ }
+if ($module.Params.tuning_profile) {
+    $params = Get-ControlMTuningProfile
+}
+if ($module.Params.settings) {
+    $DictionarySettings = Get-ControlMDesiredSetting -Parameters $module.Params.settings
+    $DictionarySettings.Keys | ForEach-Object { $params[$_] = $DictionarySettings[$_] }
+}
+$OptionSettings = Get-ControlMDesiredSetting -Parameters $module.Params
+$OptionSettings.Keys | ForEach-Object { $params[$_] = $OptionSettings[$_] }
+Add-ControlMTiming -Phase 'spec' -Stopwatch $PhaseStopwatch
+
+if ($module.Params.mode -eq 'apply') {
+    # The settings and the instances come from the plan
+    if (($params.Count -gt 0) -or $module.Params.instances) {
+        $module.FailJson("The settings and the instances cannot be defined with mode=apply, they come from the plan")
+    }
+    $InstancesMode = $module.Params.plan.ContainsKey('instances')
+    $InstanceResults = Invoke-ControlMPlan -Plan $module.Params.plan
+}
+else {
+    $InstancesMode = [bool]$module.Params.instances
+    $Instances = Get-ControlMInstance -Parameters $params
+    Assert-ControlMInstancePort -Instances $Instances
+    Assert-ControlMSettingRequirement -Instances $Instances
+    Add-ControlMTiming -Phase 'snapshot' -Stopwatch $PhaseStopwatch
+
+    if ($module.Params.verify_connectivity -ne 'none') {
+        Invoke-ControlMConnectivityCheck -Instances $Instances
+        Add-ControlMTiming -Phase 'connectivity' -Stopwatch $PhaseStopwatch
+    }
+
+    $InstanceResults = [ordered]@{ }
+    $Instances | Where-Object { $_.Target } | ForEach-Object {
+        $InstanceResults[$_.Name] = Invoke-ControlMInstance -Instance $_
+    }
+
+    if ($module.Params.mode -eq 'plan') {
+        $PlanEntries = @($Instances | Where-Object { $_.Target } | ForEach-Object { $_.Plan })
+        $module.Result.plan = @{ version = $PlanVersion }
+        if ($InstancesMode) { $module.Result.plan.instances = $PlanEntries } else { $module.Result.plan.agent = $PlanEntries[0] }
     }
 }
 
-if (!(Test-TargetResource @params)) {
-    Set-TargetResource @params | Out-Null
+if ($InstancesMode) {
+    $module.Result.changed = [bool]($InstanceResults.Values | Where-Object { $_.changed })
+    $module.Result.restart_required = [bool]($InstanceResults.Values | Where-Object { $_.restart_required })
+    $module.Diff.before = @{ }
+    $module.Diff.after = @{ }
+    $InstanceResults.Keys | ForEach-Object {
+        $module.Diff.before[$_] = $InstanceResults[$_].diff.before
+        $module.Diff.after[$_] = $InstanceResults[$_].diff.after
+    }
+    $module.Result.instances = $InstanceResults
+}
+else {
+    $InstanceResult = @($InstanceResults.Values)[0]
+    if ($InstanceResult.ContainsKey('config')) {
+        $module.Result.Config = $InstanceResult.config
+    }
+    if ($InstanceResult.ContainsKey('diagnostic_revert')) {
+        $module.Result.diagnostic_revert = $InstanceResult.diagnostic_revert
+    }
+    if ($InstanceResult.ContainsKey('log_usage')) {
+        $module.Result.log_usage = $InstanceResult.log_usage
+    }
 }
 
-$resources = Get-TargetResource -ParametersToAdd @('default_agent_name', 'cm_type', 'cm_name', 'agent_version', 'fd_number', 'fix_number', 'agent_directory')
-$module.result.Config = @{ }
-$resources.Keys | Foreach-Object { $module.result.Config.Add($(Convert-StringToSnakeCase -String $_), $resources[$_]) }
+$module.Result.ansible_facts = @{ controlm_agent = $script:Facts }
+
+if ($module.Params.profile) {
+    $script:Timings['total_ms'] = $ModuleStopwatch.ElapsedMilliseconds
+    $module.Result.timings = $script:Timings
+}
 
 $module.ExitJson()
@@ -36,11 +36,13 @@ description:
     - This Ansible module allows to change the Control-M Agent configuration on Windows-based systems.
     - Control-M Agent configurations use both C(CTMWINCFG) or C(CTMAGCFG)command for setting configuration.
     - This module provides an implementation for working with Agent configuration in a deterministic way. Commands are not used. This module makes changes in registry locations.
+    - The action plugin of the role checks the arguments against the types, choices, ranges, lengths and requirements documented below before the host is contacted, so an invalid argument fails the task at once.
 options:
     agent_to_server_port:
         description:
             - Defines the port number in the Control-M Agent computer where data is received from the Control-M Server computer.
             - The value assigned to this parameter must correspond to the value assigned to the Server-to-Agent Port Number field in the configuration file on the corresponding Control-M Agent computer.
+            - Range 1024-65535.
         default: 7005
         type: int
         required: no
@@ -48,6 +50,7 @@ options:
         description:
             - Defines the port number between 1024 and 65535 that receives data from the Control-M Agent computer.
             - This value must match the Agent-to-Server Port Number in Control-M Server. The value is the I(COMTIMOUT) communication job-tracking timeout in seconds.
+            - Range 1024-65535.
         default: 7006
         type: int
     primary_controlm_server_host:
@@ -63,7 +66,8 @@ options:
     diagnostic_level:
         description:
             - Defines the debug level.
-            - Range 0-4 where 0 indicates no diagnostic activity, and 4 indicates the highest level of diagnostic functionality.
+            - C(0) indicates no diagnostic activity, and C(4) indicates the highest level of diagnostic functionality.
+            - Range 0-4.
         default: 0
         type: int
     communication_trace:
@@ -87,6 +91,8 @@ options:
     tracker_event_port:
         description:
             - Number of the port for sending messages to the Tracker process when jobs end.
+            - Range 1024-65535.
+            - Must differ from the I(server_to_agent_port) of the instance.
         default: 7035
         type: int
     logical_agent_name:
@@ -96,6 +102,11 @@ options:
             - The logical name is used when the agent initiates the communication to Control-M Server with the output from agent utilities and in messages sent by the agent to the server.
             - The default value is the C(Agent host name).
         type: str
+    java_new_ar:
+        description:
+            - Flag indicating whether the new Java Application Runner is used by the agent.
+        default: No
+        type: bool
     persistent_connection:
         description:
             - Indicates the persistent connection setting. Set the I(persistent_connection) parameter to connect to a specific agent with either a persistent or transient connection.
@@ -122,7 +133,7 @@ options:
     server_agent_protocol_version:
         description:
             - Server-Agent communication protocol version.
-            - Valid values range to 12 or lower.
+            - Range 1-12.
         default: 12
         type: int
     autoedit_inline:
@@ -182,6 +193,7 @@ options:
         description:
             - Determines the number of days to retain the files in the dailylog directory.
             - These files contain the information about jobs that is used to calculate the metrics for the usage measurement report.
+            - Range 1-99.
         default: 7
         type: int
     logon_as_user:
@@ -212,6 +224,7 @@ options:
             - If this parameter is set to C(Yes), statistics are added to the end of the OUTPUT file.
             - If this parameter is set to C(No), statistics are not added to the OUTPUT file.
         type: bool
+        aliases: [ job_statistics_to_sysout ]
         default: Yes
     job_output_name:
         description:
@@ -228,6 +241,7 @@ options:
             - If this parameter is set to C(2), parameter values are always passed to the operating system without quotes. If quotes were specified in the job definition, they are removed before the parameter is passed onward by the agent. This option is compatible with the way that these parameters were managed in version 6.0.0x, or 6.1.01 with Fix Pack 1, 2, 3, or 4 installed. In this case, if a parameter value contains a blank, the operating system may consider each string as a separate parameter.
             - If this parameter is set to C(3), this parameter is no longer relevant.
             - If this parameter is set to C(4), parameters are passed to the operating system in exactly the same way that they were specified in the job definition. No quotes are added or removed in this case. This option is compatible with the way that parameters were managed by version 2.24.0x.
+            - Range 1-4.
         type: int
         default: 4
     run_user_logon_script:
@@ -240,7 +254,8 @@ options:
     cjk_encoding:
         description:
             - Determines the CJK encoding used by Control-M Agent to run jobs.
-        choices: [ UTF-8, JAPANESE EUC, JAPANESE SHIFT-JIS, KOREAN EUC, SIMPLIFIED CHINESE GBK, SIMPLIFIED CHINESE GB, TRADITIONAL CHINESE EUC, TRADITIONAL CHINESE BIG5 ]
+            - Requires I(foreign_language_support=CJK).
+        choices: [ "", UTF-8, JAPANESE EUC, JAPANESE SHIFT-JIS, KOREAN EUC, SIMPLIFIED CHINESE GBK, SIMPLIFIED CHINESE GB, TRADITIONAL CHINESE EUC, TRADITIONAL CHINESE BIG5 ]
         type: str
         default: UTF-8
     default_printer:
@@ -280,6 +295,175 @@ options:
             - The e-mail address to which to send replies.
             - If this field is left empty, the sender e-mail address is used.
         type: str
+    instances:
+        description:
+            - List of the Control-M Agent instances to configure in a single execution.
+            - The instances are found in the registry. The agent stored in the C(Control-M/Agent) key is named after its default agent name, the other instances after their registry subkey.
+            - The settings defined at the module level apply to every instance of the list. The settings defined in an entry of the list override them for the matching instances.
+            - The module fails if two instances would use the same I(server_to_agent_port) or I(tracker_event_port). The instances which are not targeted keep their stored ports.
+            - If not set, only the agent stored in the C(Control-M/Agent) key is configured.
+        type: list
+        elements: dict
+        suboptions:
+            name:
+                description:
+                    - Name of the instance, or C(all) to target every installed instance.
+                type: str
+                required: yes
+            service_name:
+                description:
+                    - Name of the Windows service of the instance.
+                    - Defaults to C(ctmag) for the agent stored in the C(Control-M/Agent) key, and to C(ctmag_<name>) for the other instances.
+                type: str
+    firewall_rule_name:
+        description:
+            - Display name of the firewall rules opening the Control-M Agent ports. Wildcards are supported.
+            - When a port changes, only the port filters of these rules are updated instead of searching all the port filters of the host.
+        type: str
+    firewall_rule_group:
+        description:
+            - Display group of the firewall rules opening the Control-M Agent ports. Wildcards are supported.
+            - When a port changes, only the port filters of the rules of this group are updated instead of searching all the port filters of the host.
+        type: str
+    restart:
+        description:
+            - Defines how the Control-M Agent is restarted when a changed setting requires it, such as a port, I(ssl), I(listen_to_network_interface), I(limit_log_file_size) or I(limit_log_version).
+            - If set to C(auto), the agent is restarted once at the end of the task and the module waits until the service is running and the I(server_to_agent_port) accepts connections.
+            - If set to C(deferred), the agent is not restarted. The pending restart is recorded in the registry and reported by I(restart_required) until the agent is restarted, either by a handler of the play or by a later task with C(auto).
+            - If set to C(never), the agent is not restarted and the restart is only reported by I(restart_required).
+        type: str
+        choices: [ auto, never, deferred ]
+        default: auto
+    restart_timeout:
+        description:
+            - Maximum time in seconds to wait for the agent to accept connections after a restart.
+        type: int
+        default: 120
+    return_config:
+        description:
+            - Defines which settings are returned in I(config).
+            - If set to C(full), all the settings are returned.
+            - If set to C(changed), only the changed settings are returned.
+            - If set to C(none), I(config) is not returned. Use M(win_controlm_agent_config_info) to retrieve the configuration.
+        type: str
+        choices: [ full, changed, none ]
+        default: full
+    profile:
+        description:
+            - Adds the I(timings) of the run to the result.
+        type: bool
+        default: no
+    verify:
+        description:
+            - Defines how the module checks that the agent is in the desired state.
+            - If set to C(fingerprint), each run records in the agent registry key a hash of the desired settings and of the C(CONFIG) and C(WIN) registry values. When the next run has the same desired settings and the registry values still match the recorded hash, the module returns without comparing each setting.
+            - The fingerprint is ignored while a deferred restart is pending.
+            - If set to C(full), each setting is compared with its registry value.
+        type: str
+        choices: [ fingerprint, full ]
+        default: fingerprint
+    verify_connectivity:
+        description:
+            - Checks that the Control-M Server hosts accept connections before anything is changed.
+            - The I(primary_controlm_server_host) and each host of I(authorized_controlm_server_hosts) are resolved and probed on the I(agent_to_server_port) concurrently, using the desired settings or the stored ones when they are not set. The result of each host is returned in I(connectivity).
+            - If set to C(none), the hosts are not checked.
+            - If set to C(report), the hosts are checked and the result is only reported.
+            - If set to C(fail), the module fails without changing anything when a host is not reachable.
+            - Not used with I(mode=apply).
+        type: str
+        choices: [ none, report, fail ]
+        default: none
+    connectivity_timeout:
+        description:
+            - Maximum time in seconds of the whole connectivity check, however many hosts are checked.
+            - A host which does not answer within this time is reported as not reachable.
+        type: int
+        default: 5
+    mode:
+        description:
+            - Defines whether the settings are applied at once or in two steps.
+            - If set to C(enforce), the settings are compared with the registry values and applied.
+            - If set to C(plan), nothing is changed and the changes to make are returned in I(plan), with the current registry value expected for each setting, the ports of the firewall rules to update and whether a restart is required.
+            - If set to C(apply), the I(plan) is applied without comparing the settings again. Only the registry values and firewall ports of the plan are checked, and the module fails without changing anything if one of them differs from the plan.
+            - The settings, I(instances) and the firewall options are not used with C(apply), they come from the plan.
+        type: str
+        choices: [ enforce, plan, apply ]
+        default: enforce
+    plan:
+        description:
+            - Plan returned by a previous run with I(mode=plan).
+            - Required when I(mode=apply).
+        type: dict
+    diagnostic_duration:
+        description:
+            - Time in minutes after which the I(diagnostic_level) and I(communication_trace) changed by the task are restored to their previous values.
+            - The previous values are recorded in the agent registry key and a one-shot scheduled task, running as C(SYSTEM), restores them once the time has elapsed, or at the next start of the host if it was stopped at that time. The agent is restarted by the task only if a restored setting requires it.
+            - A setting changed again with I(diagnostic_duration) before the end keeps the value recorded first, and the restore is postponed to the end of the new duration. A setting changed without I(diagnostic_duration) keeps its new value, and the restore is cancelled once no setting is left to restore.
+            - Each run reports the pending restore and the remaining time in I(diagnostic_revert).
+            - The task sets the diagnostic settings again on each run where they differ, so use it in a task run on demand rather than in a playbook enforcing the configuration.
+        type: int
+    report_log_usage:
+        description:
+            - Adds the disk space used by the logs of the agent to the result, in I(log_usage).
+            - The C(proclog) and C(dailylog) directories under the I(agent_directory) are scanned file by file. The files of the C(proclog) directory whose name ends with C(.trc) or contains C(trace) are reported as the communication trace.
+            - For each category, the number of files, their total size and the age of the oldest file are returned, with an estimate of the size kept under the desired retention settings, or the stored ones when they are not set.
+            - The estimate counts the files younger than I(days_to_retain_log_files) for the proclog and the trace. For the proclog, each file counts up to I(limit_log_file_size) and only the current file of a log and its I(limit_log_version) most recent older versions are counted, the versions of a log file sharing its name up to a trailing C(.<number>). For the daily log, the estimate counts the files younger than I(measure_usage_day), which is the retention of the dailylog directory, the agent has no other retention setting for it. A category whose files are no longer written, because I(communication_trace) or I(daily_log_file_enabled) is disabled, is estimated to C(0).
+            - Only the counts of each category and the most recent versions of each proclog log file are kept during the scan, the memory used does not grow with the number of files.
+        type: bool
+        default: no
+    log_usage_timeout:
+        description:
+            - Maximum time in seconds of the scan of the log directories of each instance.
+            - When the time has elapsed, the files scanned so far are reported and I(log_usage) is flagged as C(truncated).
+        type: int
+        default: 30
+    settings:
+        description:
+            - Dictionary of settings to apply, using the option names of this module as keys.
+            - The settings passed as options take precedence over the settings of this dictionary.
+        type: dict
+    tuning_profile:
+        description:
+            - Name of a tuning profile, expanded into the settings driving the throughput and the overhead of the agent.
+            - C(high_throughput) keeps a persistent connection which the agent can open, polls the tracker every 30 seconds, waits up to 120 seconds for TCP/IP, and disables the diagnostics, the communication trace, the echo of the job commands and the job statistics in the output.
+            - C(low_overhead) disables the persistent connection, polls the tracker every 300 seconds, keeps the diagnostic logs to 2 files of 5 MB and the proclog files for 1 day, and disables the diagnostics, the communication trace, the echo of the job commands and the job statistics in the output.
+            - C(troubleshooting) enables the highest diagnostic level and the communication trace, keeps 20 diagnostic log files of 100 MB and the proclog files for 7 days, and enables the echo of the job commands and the job statistics in the output.
+            - Any profile of I(tuning_profiles) can also be used.
+            - The settings of the I(settings) dictionary take precedence over the profile, and the settings passed as options take precedence over both. The resolved values are reported in the diff like any other setting.
+            - A changed log size or number of log files requires a restart, see I(restart).
+        type: str
+    tuning_profiles:
+        description:
+            - List of user-defined tuning profiles, selected by name with I(tuning_profile).
+            - Each entry holds the C(name) of the profile and any setting of this module.
+            - A profile named after a preset extends it, its settings taking precedence over the ones of the preset.
+        type: list
+        elements: dict
+        suboptions:
+            name:
+                description:
+                    - Name of the profile.
+                type: str
+                required: yes
+    merge_tasks:
+        description:
+            - Merges the consecutive C(win_controlm_agent_config) tasks of the same block into a single execution on the host.
+            - The first task applies the settings of all the merged tasks, then each task reports the diff and the C(changed) status of its own settings.
+            - A task is not merged if it uses I(instances), a condition, a loop, task variables, other C(become), C(environment), C(delegate_to), C(notify), C(no_log), C(async), C(poll), C(timeout), C(check_mode) or C(ignore_errors) values or other control options than the first task, I(settings) in the C(key=value) form, or sets a setting already set to another value by a previous merged task.
+            - The settings of the tasks are compared once their aliases, case and types are converted like the module does.
+            - The results of the merged tasks are handed to them in the C(_win_controlm_agent_config_batch) host fact, which is emptied once the last merged task has returned.
+            - This option is handled by the action plugin of the role on the controller.
+        type: bool
+        default: yes
+    trust_cached_facts_for:
+        description:
+            - Time in seconds during which the I(controlm_agent) fact cached for the host is trusted.
+            - While the cached configuration of each targeted instance is more recent and holds the desired settings, the task returns C(changed=false) without contacting the host.
+            - An entry collected by a run which wrote to the registry is not trusted, nor an entry with a pending restart or past the restore of the settings changed with I(diagnostic_duration). The next run contacts the host and caches its configuration again.
+            - The host is always contacted with I(mode=plan) or I(mode=apply), I(tuning_profile), I(diagnostic_duration), I(report_log_usage), I(verify_connectivity), or an entry of I(instances) named C(all).
+            - The facts are kept between the plays only if a fact cache is enabled, see C(fact_caching) in the Ansible configuration.
+            - This option is handled by the action plugin of the role on the controller.
+        type: int
 '''
 
 EXAMPLES = r'''
@@ -310,12 +494,232 @@ EXAMPLES = r'''
     - name: Change the job ouput name
       win_controlm_agent_config:
         job_output_name: JOBNAME
+
+    - name: Change the logs settings and restart the agent once in a handler
+      win_controlm_agent_config:
+        limit_log_file_size: 100
+        limit_log_version: 20
+        restart: deferred
+      register: agent_config
+      notify: restart the Control-M Agent
+
+    - name: Change the output name of every instance and the ports of the second one
+      win_controlm_agent_config:
+        job_output_name: JOBNAME
+        instances:
+          - name: all
+          - name: Agent2
+            server_to_agent_port: 7016
+            tracker_event_port: 7045
+
+    - name: Change the SMTP settings from a dictionary
+      win_controlm_agent_config:
+        settings: "{{ controlm_agent_smtp_settings }}"
+
+    - name: Change the Control-M Server hosts once all of them accept connections
+      win_controlm_agent_config:
+        primary_controlm_server_host: "server1"
+        authorized_controlm_server_hosts: "server1|server2|server3|server4|server5"
+        verify_connectivity: fail
+        connectivity_timeout: 3
+
+    - name: Tune the agent for throughput, keeping the site log retention
+      win_controlm_agent_config:
+        tuning_profile: high_throughput
+        tuning_profiles:
+          - name: high_throughput
+            days_to_retain_log_files: 3
+        tracker_polling_interval: 15
+
+    - name: Enable the full diagnostics for two hours
+      win_controlm_agent_config:
+        diagnostic_level: 4
+        communication_trace: yes
+        diagnostic_duration: 120
+
+    - name: Check the disk space used by the logs before lowering the retention
+      win_controlm_agent_config:
+        days_to_retain_log_files: 2
+        report_log_usage: yes
+      check_mode: yes
+      register: agent_logs
+
+    - name: Plan the change of the ports
+      win_controlm_agent_config:
+        agent_to_server_port: 8000
+        server_to_agent_port: 8001
+        mode: plan
+      register: agent_plan
+
+    - name: Apply the planned change unless the agent has changed since
+      win_controlm_agent_config:
+        mode: apply
+        plan: "{{ agent_plan.plan }}"
+
+    - name: Confirm the configuration, contacting only the hosts not known to comply within the last hour
+      win_controlm_agent_config:
+        job_output_name: JOBNAME
+        ssl: yes
+        trust_cached_facts_for: 3600
+
+  handlers:
+    - name: restart the Control-M Agent
+      win_service:
+        name: ctmag
+        state: restarted
 '''
 
 RETURN = r'''
+instances:
+    description:
+        - Result of each configured instance, indexed by instance name.
+        - Each entry contains the C(changed) and C(restart_required) flags, the C(diff), the C(diagnostic_revert) when a restore is pending, the C(log_usage) when I(report_log_usage) is C(yes) and, unless I(return_config) is C(none), the C(config) of the instance.
+    returned: when I(instances) is defined, or when I(mode=apply) and the plan was made with I(instances)
+    type: dict
+    sample: {"Default": {"changed": false, "restart_required": false, "diff": {"before": {}, "after": {}}, "config": {"job_output_name": "JOBNAME"}}}
+restart_required:
+    description: Indicates whether the agent must be restarted for the changed settings to take effect.
+    returned: success
+    type: bool
+    sample: false
+timings:
+    description:
+        - Elapsed milliseconds of each phase of the run and counts of the costly calls.
+        - The phases are C(spec) for the argument spec and validation, C(snapshot) for reading the registry, C(connectivity) for checking the Control-M Server hosts, C(compare) for comparing the settings, C(write) for writing the registry, C(firewall) for updating the firewall rules, C(restart) for restarting the agent and waiting until it accepts connections, C(report) for building I(config), and C(log_usage) for scanning the log directories.
+        - When tasks are merged, only the first task returns the timings.
+    returned: when I(profile) is C(yes)
+    type: dict
+    contains:
+        spec_ms:
+            description: Time spent building the argument spec and validating the options.
+            type: int
+        snapshot_ms:
+            description: Time spent finding the instances and reading their registry keys.
+            type: int
+        connectivity_ms:
+            description: Time spent checking the connectivity of the Control-M Server hosts.
+            type: int
+        compare_ms:
+            description: Time spent comparing the desired settings with the registry values.
+            type: int
+        write_ms:
+            description: Time spent writing the registry values.
+            type: int
+        firewall_ms:
+            description: Time spent updating the firewall rules.
+            type: int
+        restart_ms:
+            description: Time spent restarting the agent and waiting until it accepts connections.
+            type: int
+        report_ms:
+            description: Time spent building the returned configuration.
+            type: int
+        log_usage_ms:
+            description: Time spent scanning the log directories.
+            type: int
+        total_ms:
+            description: Total time of the run.
+            type: int
+        registry_reads:
+            description: Number of registry keys read.
+            type: int
+        registry_writes:
+            description: Number of registry values written or deleted.
+            type: int
+        firewall_filters_scanned:
+            description: Number of firewall port filters scanned.
+            type: int
+    sample: {"spec_ms": 12, "snapshot_ms": 8, "connectivity_ms": 0, "compare_ms": 25, "write_ms": 0, "firewall_ms": 0, "restart_ms": 0, "report_ms": 21, "log_usage_ms": 0, "total_ms": 66, "registry_reads": 3, "registry_writes": 0, "firewall_filters_scanned": 0}
+connectivity:
+    description:
+        - Result of the connectivity check of each Control-M Server host.
+        - Each entry contains the C(host), the C(port), the resolved C(addresses), whether the port is C(reachable), the connection C(latency_ms) and the C(error) when the host is not reachable.
+    returned: when I(verify_connectivity) is not C(none)
+    type: list
+    elements: dict
+    sample: [{"host": "server1", "port": 7005, "addresses": ["10.0.0.1"], "reachable": true, "latency_ms": 2, "error": null},
+             {"host": "server3.cloud", "port": 7005, "addresses": [], "reachable": false, "latency_ms": null, "error": "No such host is known"}]
+plan:
+    description:
+        - Changes to make, to pass to a later run with I(mode=apply).
+        - The plan holds the plan of the agent in C(agent), or of each targeted instance in C(instances) when I(instances) is defined.
+        - The plan of an instance lists the C(settings) to change with the C(expected) current registry value, C(null) if the value does not exist, and the registry C(value) to write, the C(firewall_rules) to update with the ports C(before) and C(after) the change, and whether a restart is required.
+    returned: when I(mode=plan)
+    type: dict
+    sample: {"version": 1, "agent": {"name": "Default", "path": "HKLM:\\SOFTWARE\\BMC Software\\Control-M/Agent", "service_name": "ctmag",
+             "settings": [{"option": "agent_to_server_port", "expected": "7005", "value": "8000"}],
+             "firewall_rules": [{"rule": "Control-M Server", "property": "RemotePort", "before": ["7005"], "after": ["8000"]}],
+             "restart_required": true}}
+drift:
+    description: Differences found between the host and the plan with I(mode=apply).
+    returned: when I(mode=apply) and the host has drifted since the plan was made
+    type: list
+    elements: str
+    sample: ["the \"agent_to_server_port\" setting of the instance \"Default\" is \"7010\" instead of \"7005\""]
+diagnostic_revert:
+    description: Pending restore of the diagnostic settings changed with I(diagnostic_duration).
+    returned: when I(instances) is not defined and a restore is pending
+    type: dict
+    contains:
+        expires:
+            description: Date and time in UTC when the settings are restored.
+            type: str
+        remaining_minutes:
+            description: Minutes left before the settings are restored, C(0) when the restore is overdue.
+            type: int
+        settings:
+            description: Values restored, indexed by setting name.
+            type: dict
+    sample: {"expires": "2020-06-02T14:30:00.0000000Z", "remaining_minutes": 95, "settings": {"diagnostic_level": 0, "communication_trace": false}}
+log_usage:
+    description:
+        - Disk space used by the logs of the agent, and its estimate under the retention settings.
+        - Each of the C(proclog), C(trace) and C(dailylog) categories contains the scanned C(path), the number of C(files), their total size in C(bytes), the C(oldest_file_age_days), the C(retention_days) used for the estimate and the C(estimated_bytes).
+    returned: when I(instances) is not defined and I(report_log_usage) is C(yes)
+    type: dict
+    contains:
+        path:
+            description: Agent directory under which the logs are scanned.
+            type: str
+        truncated:
+            description: Whether the scan was stopped after I(log_usage_timeout) seconds, the counts then covering only the files scanned so far.
+            type: bool
+        scan_ms:
+            description: Time spent scanning the log directories.
+            type: int
+    sample: {"path": "C:\\Program Files\\BMC Software\\Control-M Agent\\Default", "truncated": false, "scan_ms": 42,
+             "proclog": {"path": "C:\\Program Files\\BMC Software\\Control-M Agent\\Default\\proclog", "files": 1250, "bytes": 524288000,
+                         "oldest_file_age_days": 6.4, "retention_days": 2, "estimated_bytes": 157286400},
+             "trace": {"path": "C:\\Program Files\\BMC Software\\Control-M Agent\\Default\\proclog", "files": 0, "bytes": 0,
+                       "oldest_file_age_days": null, "retention_days": 2, "estimated_bytes": 0},
+             "dailylog": {"path": "C:\\Program Files\\BMC Software\\Control-M Agent\\Default\\dailylog", "files": 7, "bytes": 3145728,
+                          "oldest_file_age_days": 6.9, "retention_days": 7, "estimated_bytes": 3145728}}
+ansible_facts:
+    description: Facts about the configured Control-M Agent instances.
+    returned: success
+    type: dict
+    contains:
+        controlm_agent:
+            description:
+                - Configuration of each configured instance, indexed by instance name, merged with the entries cached for the other instances.
+                - Each entry contains the full C(config) of the instance after the run, the C(collected) date and time in UTC, whether the run wrote to the registry in C(written), the C(restart_required) flag, whether it is the C(default_instance) stored in the C(Control-M/Agent) key, and the end of the pending restore of the diagnostic settings in C(expires).
+            type: dict
+            sample: {"Default": {"config": {"agent_to_server_port": 7005, "ssl": true}, "collected": "2020-06-02T12:30:00.0000000Z",
+                                 "written": false, "restart_required": false, "default_instance": true, "expires": null}}
+from_cached_facts:
+    description: Indicates that the result comes from the I(controlm_agent) fact cached for the host, which was not contacted.
+    returned: when the cached facts are trusted, see I(trust_cached_facts_for)
+    type: bool
+    sample: true
+merged_tasks:
+    description: Names of the following tasks merged into this task and applied by the same execution.
+    returned: when tasks are merged
+    type: list
+    elements: str
+    sample: ["Change Control-M Server hosts", "Change job children inside job object"]
 config:
     description: Detailed information about stored the configuration.
-    returned: success
+    returned: when I(instances) is not defined and I(return_config) is not C(none)
     type: dict
     contains:
         agent_to_server_port:
@@ -327,6 +731,10 @@ config:
             description: Indicates whether the agent can open a connection to the server when working in persistent connection mode.
             returned: success
             type: bool
+        add_job_statistics_to_sysout:
+            description: Indicates how to manage job object processing statistics.
+            returned: success
+            type: bool
         authorized_controlm_server_hosts:
             description: List of backup servers which can replace the primary server if it fails.
             returned: success
@@ -375,6 +783,10 @@ config:
             returned: success
             type: str
             sample: LATIN-1
+        java_new_ar:
+            description: Indicates whether the new Java Application Runner is used by the agent.
+            returned: success
+            type: bool
         job_children_inside_job_object:
             description: Indicates whether procedures invoked by a job can be run outside the Job Object.
             returned: success
@@ -0,0 +1,52 @@
+#!powershell
+
+#AnsibleRequires -CSharpUtil Ansible.Basic
+#Requires -Module Ansible.ModuleUtils.ControlMAgent
+
+$AgentRegistryPath = Get-ControlMRegistryPath
+
+# Settings of the Control-M Agent, see Ansible.ModuleUtils.ControlMAgent
+$settings = Get-ControlMSettingTable
+
+$spec = @{
+    options             = @{
+        keys = @{ type = "list"; elements = "str"; choices = @($settings.Keys) }
+    }
+    supports_check_mode = $true
+}
+
+Function Get-TargetResource {
+    <#
+    .SYNOPSIS
+    Retrieves the settings of the configuration.
+    .DESCRIPTION
+    Only the registry keys holding the requested settings are read, each of them once.
+    .PARAMETER Parameters
+    Specifies the names of the settings to retrieve.
+    #>
+    [OutputType('System.Collections.Hashtable')]
+    param (
+        [Parameter(Mandatory = $true)]
+        [array]
+        $Parameters
+    )
+
+    $Snapshot = Get-ControlMSnapshot -Name $Parameters
+    if (-not ($Snapshot.Values | Where-Object { $_.Count })) {
+        $module.FailJson("The Control-M Agent is not installed, the registry key $AgentRegistryPath does not exist")
+    }
+
+    $TargetResource = @{ }
+    $Parameters | ForEach-Object {
+        $TargetResource[$_] = ConvertFrom-ControlMParameter -Name $_ -Value (Get-ControlMSnapshotValue -Snapshot $Snapshot -Name $_)
+    }
+    return $TargetResource
+}
+
+$module = [Ansible.Basic.AnsibleModule]::Create($args, $spec)
+
+# The keys option is read with the indexer, the Keys property of the dictionary would take precedence
+$Keys = if ($module.Params['keys']) { @($module.Params['keys'] | Select-Object -Unique) } else { @($settings.Keys) }
+$module.Result.config = Get-TargetResource -Parameters $Keys
+
+$module.ExitJson()
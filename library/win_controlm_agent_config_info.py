@@ -0,0 +1,125 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This is a windows documentation stub.  Actual code lives in the .ps1
+# file of the same name.
+
+# Copyright 2020 Informatique CDC. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+
+ANSIBLE_METADATA = {'metadata_version': '1.1',
+                    'status': ['preview'],
+                    'supported_by': 'community'}
+
+DOCUMENTATION = r'''
+---
+module: win_controlm_agent_config_info
+short_description: Retrieve the configuration of a Control-M Agent on a Windows host
+author:
+    - Stéphane Bilqué (@sbilque) Informatique CDC
+description:
+    - This Ansible module retrieves the Control-M Agent configuration on Windows-based systems without changing it.
+    - Only the registry keys holding the requested settings are read.
+    - Use M(win_controlm_agent_config) to change the configuration.
+options:
+    keys:
+        description:
+            - Names of the settings to retrieve.
+            - If not set, all the settings are retrieved.
+        type: list
+        elements: str
+        choices:
+            - agent_to_server_port
+            - server_to_agent_port
+            - primary_controlm_server_host
+            - authorized_controlm_server_hosts
+            - diagnostic_level
+            - communication_trace
+            - days_to_retain_log_files
+            - daily_log_file_enabled
+            - tracker_event_port
+            - logical_agent_name
+            - java_new_ar
+            - persistent_connection
+            - allow_comm_init
+            - foreign_language_support
+            - ssl
+            - server_agent_protocol_version
+            - autoedit_inline
+            - listen_to_network_interface
+            - ctms_address_mode
+            - timeout_for_agent_utilities
+            - tcpip_timeout
+            - tracker_polling_interval
+            - limit_log_file_size
+            - limit_log_version
+            - measure_usage_day
+            - logon_as_user
+            - logon_domain
+            - job_children_inside_job_object
+            - add_job_statistics_to_sysout
+            - job_output_name
+            - wrap_parameters_with_double_quotes
+            - run_user_logon_script
+            - cjk_encoding
+            - default_printer
+            - echo_job_commands_into_sysout
+            - smtp_server_relay_name
+            - smtp_port
+            - smtp_sender_mail
+            - smtp_sender_friendly_name
+            - smtp_reply_to_mail
+            - default_agent_name
+            - cm_type
+            - cm_name
+            - agent_version
+            - fd_number
+            - fix_number
+            - agent_directory
+seealso:
+    - module: win_controlm_agent_config
+'''
+
+EXAMPLES = r'''
+---
+- name: Inventory the Control-M Agents
+  hosts: all
+  gather_facts: false
+
+  roles:
+    - win_controlm_agent_config
+
+  tasks:
+    - name: Get the version of the agent and its server
+      win_controlm_agent_config_info:
+        keys:
+          - agent_version
+          - fix_number
+          - primary_controlm_server_host
+      register: agent_info
+'''
+
+RETURN = r'''
+config:
+    description:
+        - The requested settings, indexed by setting name.
+        - The settings have the type and meaning of the I(config) value returned by M(win_controlm_agent_config).
+    returned: success
+    type: dict
+    sample: {"agent_version": "9.0.19.200", "fix_number": "", "primary_controlm_server_host": "server1"}
+'''
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Informatique CDC. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""Options of the win_controlm_agent_config module, read from the documentation of its stub.
+
+The ranges, lengths and requirements of the settings are read from the settings table of
+the Ansible.ModuleUtils.ControlMAgent module util, which the module checks them against,
+rather than from the sentences describing them. The table is read strictly: an entry or a
+field which cannot be read, or a setting returned by the module without an entry, fails
+instead of being skipped. The action plugin and the compliance tool
+of the role both load this file from the module_utils directory of the role, so that they
+check the same types, choices and constraints. It requires PyYAML only.
+"""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import ast
+import io
+import os
+import re
+
+import yaml
+
+MODULE_NAME = 'win_controlm_agent_config'
+
+# Stub holding the documentation of the module, next to the PowerShell module in the role
+STUB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'library', MODULE_NAME + '.py')
+
+# Module util holding the settings table of the agent, shared by the PowerShell modules
+SETTINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Ansible.ModuleUtils.ControlMAgent.psm1')
+
+# Entries of the settings table, one per line, and their fields separated by semicolons
+SETTINGS_START = '$settings = [ordered]@{'
+SETTING_PATTERN = re.compile(r'^\s{4}(?P<name>[a-z0-9_]+)\s+= @\{ (?P<fields>.*) \}(\s+#.*)?$')
+FIELD_PATTERN = re.compile(r"(?P<key>[A-Za-z]+) = (?P<value>@\([^)]*\)|'[^']*'|\"[^\"]*\"|\$\w+|-?\d+)")
+FIELD_SEPARATOR = '; '
+
+
+class DocumentationError(ValueError):
+    """Raised when the documentation of the module cannot be read."""
+
+
+def load_stub_variable(name, path=STUB_PATH):
+    """Returns a YAML variable of the module documentation stub, without importing the stub."""
+    with io.open(path, 'r', encoding='utf-8') as stub_file:
+        tree = ast.parse(stub_file.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and getattr(node.targets[0], 'id', None) == name:
+            return yaml.safe_load(ast.literal_eval(node.value))
+    raise DocumentationError('%s does not define the %s of the module' % (path, name))
+
+
+def parse_value(value):
+    """Converts a value of the settings table to Python."""
+    if value.startswith('@('):
+        return [parse_value(item.strip()) for item in value[2:-1].split(',') if item.strip()]
+    if value.startswith("'") or value.startswith('"'):
+        return value[1:-1]
+    if value == '$true':
+        return True
+    if value == '$false':
+        return False
+    if value.startswith('$'):
+        return value
+    return int(value)
+
+
+def parse_fields(name, fields, path):
+    """Returns the fields of an entry of the settings table, raising a DocumentationError if a field cannot be read."""
+    parsed = {}
+    for text in fields.split(FIELD_SEPARATOR):
+        match = FIELD_PATTERN.match(text)
+        if match is None or match.end() != len(text):
+            raise DocumentationError('%s: the field "%s" of the setting %s cannot be read' % (path, text, name))
+        if match.group('key') in parsed:
+            raise DocumentationError('%s: the field %s of the setting %s is defined twice' % (path, match.group('key'), name))
+        parsed[match.group('key')] = parse_value(match.group('value'))
+    if ('Min' in parsed) != ('Max' in parsed):
+        raise DocumentationError('%s: the setting %s must define both Min and Max' % (path, name))
+    return parsed
+
+
+def load_settings_table(path=SETTINGS_PATH, documented=None):
+    """Returns the fields of each setting of the settings table, indexed by setting name.
+
+    Raises a DocumentationError if a line of the table is not an entry, a field of an entry
+    cannot be read, or one of the documented setting names has no entry.
+    """
+    with io.open(path, 'r', encoding='utf-8') as module_util:
+        source = module_util.read()
+    if SETTINGS_START not in source:
+        raise DocumentationError('%s does not define the settings table' % path)
+    table = source[source.index(SETTINGS_START):]
+    table = table[:table.index('\n}\n')]
+    settings = {}
+    for line in table.splitlines()[1:]:
+        if not line.strip() or line.strip().startswith('#'):
+            continue
+        match = SETTING_PATTERN.match(line)
+        if match is None:
+            raise DocumentationError('%s: the line "%s" of the settings table is not an entry on a single line' % (path, line.strip()))
+        if match.group('name') in settings:
+            raise DocumentationError('%s: the setting %s is defined twice' % (path, match.group('name')))
+        settings[match.group('name')] = parse_fields(match.group('name'), match.group('fields'), path)
+    if not settings:
+        raise DocumentationError('The settings table of %s is empty' % path)
+    missing = sorted(set(documented or []) - set(settings))
+    if missing:
+        raise DocumentationError('The settings table of %s does not define the settings %s' % (path, ', '.join(missing)))
+    return settings
+
+
+def parse_options(documented, table):
+    """Returns the documented options with the constraints of the settings table.
+
+    Each option holds its type, elements, choices, aliases and required flag and, when
+    defined by the settings table, its range (min and max), its max_length and the setting
+    it requires as a (name, value) tuple, and its suboptions.
+    """
+    options = {}
+    for name, documented_option in documented.items():
+        option = {
+            'type': documented_option.get('type', 'str'),
+            'elements': documented_option.get('elements'),
+            'choices': documented_option.get('choices'),
+            'aliases': documented_option.get('aliases') or [],
+            'required': documented_option.get('required', False),
+        }
+        setting = table.get(name, {})
+        if 'Min' in setting:
+            option['min'], option['max'] = setting['Min'], setting['Max']
+        if 'MaxLength' in setting:
+            option['max_length'] = setting['MaxLength']
+        if 'Requires' in setting:
+            option['requires'] = tuple(setting['Requires'].split('=', 1))
+        if 'suboptions' in documented_option:
+            option['suboptions'] = parse_options(documented_option['suboptions'], table)
+        options[name] = option
+    return options
+
+
+def load_documented_settings(path=STUB_PATH):
+    """Returns the names of the settings returned in config, as documented in the RETURN of the module stub."""
+    return list(load_stub_variable('RETURN', path)['config']['contains'])
+
+
+def load_options(path=STUB_PATH, settings_path=SETTINGS_PATH):
+    """Reads the options from the DOCUMENTATION of the module stub and their constraints from the settings table."""
+    return parse_options(load_stub_variable('DOCUMENTATION', path)['options'], load_settings_table(settings_path, load_documented_settings(path)))
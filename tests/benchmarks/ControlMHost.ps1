@@ -0,0 +1,374 @@
+# In-memory stand-ins for the registry, firewall and services used by the win_controlm_agent_config
+# module, so that the module runs under pwsh on any platform without a Control-M Agent.
+#
+# The stand-ins are global aliases. Aliases take precedence over the cmdlets and over the functions
+# defined by the module, as Pester mocks do. Each call is counted in $ControlMHost.Calls.
+
+$ControlMHostRegistryPath = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent'
+
+$ControlMHostAliases = [ordered]@{
+    'Get-ItemProperty'          = 'Get-ControlMHostItemProperty'
+    'Get-ChildItem'             = 'Get-ControlMHostChildItem'
+    'Open-ControlMRegistryKey'  = 'Open-ControlMHostRegistryKey'
+    'Get-NetFirewallPortFilter' = 'Get-ControlMHostFirewallPortFilter'
+    'Get-NetFirewallRule'       = 'Get-ControlMHostFirewallRule'
+    'Set-NetFirewallPortFilter' = 'Set-ControlMHostFirewallPortFilter'
+    'Get-Service'               = 'Get-ControlMHostService'
+    'Restart-Service'           = 'Restart-ControlMHostService'
+    'Get-CimInstance'           = 'Get-ControlMHostCimInstance'
+    'Test-ControlMAgentPort'    = 'Test-ControlMHostAgentPort'
+}
+
+function New-ControlMHost {
+    <#
+    .SYNOPSIS
+    Creates the in-memory host used by the stand-ins.
+    .DESCRIPTION
+    The first instance is stored in the agent registry key, the others in the Agent2, Agent3... subkeys,
+    each with its own ports and Windows service. The firewall holds the rules opening the ports of the
+    first instance, followed by unrelated rules up to the requested number of port filters.
+    .PARAMETER Instances
+    Specifies the number of agent instances.
+    .PARAMETER FirewallFilters
+    Specifies the number of firewall port filters.
+    #>
+    param (
+        [int]
+        $Instances = 1,
+        [int]
+        $FirewallFilters = 3
+    )
+
+    $Registry = @{ }
+    $Services = @{ }
+    for ($Index = 0; $Index -lt $Instances; $Index++) {
+        if ($Index -eq 0) {
+            $Path = $ControlMHostRegistryPath
+            $Registry[$Path] = @{ DEFAULT_AGENT = 'Default' }
+            $Services['ctmag'] = 'Running'
+        }
+        else {
+            $Path = "$ControlMHostRegistryPath\Agent$($Index + 1)"
+            $Registry[$Path] = @{ }
+            $Services["ctmag_Agent$($Index + 1)"] = 'Running'
+        }
+        $Registry["$Path\CONFIG"] = @{
+            ATCMNDATA          = '7005'
+            AGCMNDATA          = [string](7006 + 10 * $Index)
+            TRACKER_EVENT_PORT = [string](7035 + 10 * $Index)
+            CTMSHOST           = 'server2'
+            CTMPERMHOSTS       = 'server2'
+            DBGLVL             = '0'
+            COMMOPT            = 'SSL=N'
+            CODE_VERSION       = '9.0.19.200'
+        }
+        $Registry["$Path\WIN"] = @{
+            OUTPUT_NAME = 'MEMNAME'
+            JOB_WAIT    = 'Y'
+        }
+    }
+
+    $Filters = [System.Collections.ArrayList]@(
+        [PSCustomObject]@{ InstanceID = 'Control-M Agent'; DisplayGroup = 'Control-M'; LocalPort = @('7006', '7035'); RemotePort = 'Any' }
+        [PSCustomObject]@{ InstanceID = 'Control-M Server'; DisplayGroup = 'Control-M'; LocalPort = 'Any'; RemotePort = '7005' }
+    )
+    for ($Index = $Filters.Count; $Index -lt $FirewallFilters; $Index++) {
+        $Filters.Add([PSCustomObject]@{ InstanceID = "Rule $Index"; DisplayGroup = 'Other'; LocalPort = [string](20000 + $Index); RemotePort = 'Any' }) | Out-Null
+    }
+
+    $global:ControlMHost = @{
+        Registry = $Registry
+        Services = $Services
+        Filters  = $Filters
+        Calls    = @{ }
+    }
+    Reset-ControlMHostCall
+}
+
+function Reset-ControlMHostCall {
+    <#
+    .SYNOPSIS
+    Resets the call counters of the stand-ins.
+    #>
+    $global:ControlMHost.Calls = [ordered]@{
+        registry_read   = 0
+        registry_list   = 0
+        registry_open   = 0
+        registry_write  = 0
+        firewall_list   = 0
+        firewall_rule   = 0
+        firewall_set    = 0
+        service_get     = 0
+        service_restart = 0
+        service_cim     = 0
+        port_probe      = 0
+    }
+}
+
+function Enable-ControlMHost {
+    <#
+    .SYNOPSIS
+    Replaces the registry, firewall and service commands with the stand-ins.
+    #>
+    foreach ($Alias in $ControlMHostAliases.Keys) {
+        Set-Alias -Name $Alias -Value $ControlMHostAliases[$Alias] -Scope Global -Force
+    }
+}
+
+function Disable-ControlMHost {
+    <#
+    .SYNOPSIS
+    Restores the registry, firewall and service commands.
+    #>
+    foreach ($Alias in $ControlMHostAliases.Keys) {
+        Remove-Item -Path "Alias:\$Alias" -Force -ErrorAction SilentlyContinue
+    }
+}
+
+function global:Get-ControlMHostItemProperty {
+    [CmdletBinding()]
+    param (
+        [Parameter(Mandatory = $true, Position = 0)]
+        [string]
+        $Path
+    )
+
+    $global:ControlMHost.Calls.registry_read += 1
+    $Values = $global:ControlMHost.Registry[$Path]
+    if ($null -eq $Values) {
+        Write-Error -Message "Cannot find path '$Path' because it does not exist." -Category ObjectNotFound
+        return
+    }
+    return $Values.Clone()
+}
+
+function global:Get-ControlMHostChildItem {
+    [CmdletBinding()]
+    param (
+        [Parameter(Position = 0)]
+        [string]
+        $Path = '.'
+    )
+
+    if (-not $Path.StartsWith('HKLM:')) {
+        return Microsoft.PowerShell.Management\Get-ChildItem -Path $Path
+    }
+
+    $global:ControlMHost.Calls.registry_list += 1
+    $Pattern = "^$([Regex]::Escape($Path))\\[^\\]+$"
+    $global:ControlMHost.Registry.Keys | Where-Object { $_ -match $Pattern } | ForEach-Object {
+        $SubKeyPattern = "^$([Regex]::Escape($_))\\[^\\]+$"
+        $SubKey = [PSCustomObject]@{
+            PSChildName = $_.Substring($Path.Length + 1)
+            SubKeyNames = @($global:ControlMHost.Registry.Keys | Where-Object { $_ -match $SubKeyPattern } | ForEach-Object { $_.Substring($_.LastIndexOf('\') + 1) })
+        }
+        $SubKey | Add-Member -MemberType ScriptMethod -Name GetSubKeyNames -Value { $this.SubKeyNames } -PassThru
+    }
+}
+
+function global:Open-ControlMHostRegistryKey {
+    param (
+        [Parameter(Mandatory = $true)]
+        [string]
+        $Path
+    )
+
+    $global:ControlMHost.Calls.registry_open += 1
+    $Values = $global:ControlMHost.Registry[$Path]
+    if ($null -eq $Values) {
+        throw "The registry key $Path does not exist"
+    }
+    $RegistryKey = [PSCustomObject]@{ Values = $Values }
+    $RegistryKey | Add-Member -MemberType ScriptMethod -Name SetValue -Value {
+        param ($Name, $Value, $Kind)
+        $global:ControlMHost.Calls.registry_write += 1
+        $this.Values[$Name] = [string]$Value
+    }
+    $RegistryKey | Add-Member -MemberType ScriptMethod -Name DeleteValue -Value {
+        param ($Name, $ThrowOnMissingValue)
+        $global:ControlMHost.Calls.registry_write += 1
+        $this.Values.Remove($Name)
+    }
+    $RegistryKey | Add-Member -MemberType ScriptMethod -Name Dispose -Value { }
+    return $RegistryKey
+}
+
+function global:Get-ControlMHostFirewallRule {
+    [CmdletBinding()]
+    param (
+        [string[]]
+        $Name,
+        [string]
+        $DisplayName,
+        [string]
+        $DisplayGroup
+    )
+
+    $global:ControlMHost.Calls.firewall_rule += 1
+    $global:ControlMHost.Filters | Where-Object {
+        (-not $Name -or $_.InstanceID -in $Name) -and
+        (-not $DisplayName -or $_.InstanceID -like $DisplayName) -and (-not $DisplayGroup -or $_.DisplayGroup -like $DisplayGroup)
+    } | ForEach-Object {
+        [PSCustomObject]@{ InstanceID = $_.InstanceID; DisplayName = $_.InstanceID; DisplayGroup = $_.DisplayGroup }
+    }
+}
+
+function global:Get-ControlMHostFirewallPortFilter {
+    [CmdletBinding()]
+    param (
+        [Parameter(ValueFromPipeline = $true)]
+        $AssociatedNetFirewallRule
+    )
+
+    begin {
+        $global:ControlMHost.Calls.firewall_list += 1
+        $Piped = $false
+    }
+    process {
+        if ($null -ne $AssociatedNetFirewallRule) {
+            $Piped = $true
+            $RuleID = $AssociatedNetFirewallRule.InstanceID
+            $global:ControlMHost.Filters | Where-Object { $_.InstanceID -eq $RuleID }
+        }
+    }
+    end {
+        if (-not $Piped) {
+            $global:ControlMHost.Filters
+        }
+    }
+}
+
+function global:Set-ControlMHostFirewallPortFilter {
+    [CmdletBinding()]
+    param (
+        [Parameter(ValueFromPipeline = $true)]
+        $InputObject,
+        $LocalPort,
+        $RemotePort
+    )
+
+    process {
+        $global:ControlMHost.Calls.firewall_set += 1
+        if ($PSBoundParameters.ContainsKey('LocalPort')) { $InputObject.LocalPort = $LocalPort }
+        if ($PSBoundParameters.ContainsKey('RemotePort')) { $InputObject.RemotePort = $RemotePort }
+    }
+}
+
+function global:Get-ControlMHostService {
+    [CmdletBinding()]
+    param (
+        [Parameter(Position = 0)]
+        [string]
+        $Name
+    )
+
+    $global:ControlMHost.Calls.service_get += 1
+    if (-not $global:ControlMHost.Services.ContainsKey($Name)) {
+        Write-Error -Message "Cannot find any service with service name '$Name'." -Category ObjectNotFound
+        return
+    }
+    return [PSCustomObject]@{ Name = $Name; Status = $global:ControlMHost.Services[$Name] }
+}
+
+function global:Restart-ControlMHostService {
+    [CmdletBinding()]
+    param (
+        [Parameter(Position = 0)]
+        [string]
+        $Name,
+        [switch]
+        $Force
+    )
+
+    $global:ControlMHost.Calls.service_restart += 1
+    $global:ControlMHost.Services[$Name] = 'Running'
+}
+
+function global:Get-ControlMHostCimInstance {
+    [CmdletBinding()]
+    param (
+        [string]
+        $ClassName,
+        [string]
+        $Filter
+    )
+
+    $global:ControlMHost.Calls.service_cim += 1
+}
+
+function global:Test-ControlMHostAgentPort {
+    param (
+        [string]
+        $ComputerName,
+        [int]
+        $Port,
+        [int]
+        $Timeout
+    )
+
+    $global:ControlMHost.Calls.port_probe += 1
+    return $true
+}
+
+function Invoke-ControlMHostModule {
+    <#
+    .SYNOPSIS
+    Runs a module against the in-memory host.
+    .DESCRIPTION
+    The exit and output handlers of Ansible.Basic are replaced for the run, so that the module
+    returns to the caller instead of ending the process, and its JSON output is captured.
+    .PARAMETER ModulePath
+    Specifies the path of the module script.
+    .PARAMETER Params
+    Specifies the module options.
+    .OUTPUTS
+    A hashtable with the return code, the parsed result, the size of the JSON output, the elapsed
+    milliseconds and the calls made to the stand-ins.
+    #>
+    param (
+        [Parameter(Mandatory = $true)]
+        [string]
+        $ModulePath,
+        [hashtable]
+        $Params = @{ }
+    )
+
+    $global:complex_args = @{
+        '_ansible_check_mode' = $false
+        '_ansible_diff'       = $true
+    } + $Params
+
+    $Output = [System.Collections.Generic.List[string]]::new()
+    $ExitHandler = [Ansible.Basic.AnsibleModule]::Exit
+    $WriteLineHandler = [Ansible.Basic.AnsibleModule]::WriteLine
+    [Ansible.Basic.AnsibleModule]::Exit = { param([Int32]$rc) throw "ControlMHostExit:$rc" }
+    [Ansible.Basic.AnsibleModule]::WriteLine = { param([string]$line) $Output.Add($line) }.GetNewClosure()
+
+    $ReturnCode = $null
+    $Stopwatch = [System.Diagnostics.Stopwatch]::StartNew()
+    try {
+        . $ModulePath
+    }
+    catch {
+        if ("$($_.Exception)" -notmatch 'ControlMHostExit:(\d+)') {
+            throw
+        }
+        $ReturnCode = [int]$Matches[1]
+    }
+    finally {
+        $Stopwatch.Stop()
+        [Ansible.Basic.AnsibleModule]::Exit = $ExitHandler
+        [Ansible.Basic.AnsibleModule]::WriteLine = $WriteLineHandler
+    }
+
+    $Json = $Output -join "`n"
+    $Calls = [ordered]@{ }
+    $global:ControlMHost.Calls.Keys | ForEach-Object { $Calls[$_] = $global:ControlMHost.Calls[$_] }
+    return @{
+        rc            = $ReturnCode
+        result        = ConvertFrom-Json -InputObject $Json -AsHashtable
+        payload_bytes = [System.Text.Encoding]::UTF8.GetByteCount($Json)
+        elapsed_ms    = $Stopwatch.Elapsed.TotalMilliseconds
+        calls         = $Calls
+    }
+}
@@ -0,0 +1,153 @@
+#Requires -Version 6
+<#
+.SYNOPSIS
+Benchmarks the win_controlm_agent_config module against an in-memory host.
+.DESCRIPTION
+Runs the module under pwsh on any platform, without network access, against the stand-ins of
+ControlMHost.ps1. Each scenario runs on a fresh host; the no-op scenarios run the module once
+before the measured run, the apply scenarios make the plan before the measured run. The wall time and the calls made to the registry, firewall and service
+stand-ins are reported for each scenario.
+
+The calls are compared with the baseline: the script fails if a scenario makes more calls than
+recorded, or if the baseline or the baseline of a scenario is missing, so that a regression in the
+number of provider calls fails the build. Run it with -UpdateBaseline to record a change of the
+calls on purpose, and commit the baseline with the change. The wall time is reported but not
+compared, as it depends on the machine.
+.PARAMETER Iterations
+Specifies the number of measured runs of each scenario. The median wall time is reported.
+.PARAMETER UpdateBaseline
+Records the measured calls as the new baseline instead of comparing them.
+.PARAMETER OutputPath
+Specifies a file where the measures are written as JSON.
+#>
+param (
+    [int]
+    $Iterations = 5,
+    [switch]
+    $UpdateBaseline,
+    [string]
+    $OutputPath
+)
+
+$ErrorActionPreference = "Stop"
+
+# The vendored C# utils live next to the unit tests, see test_utils.ps1
+$Here = Join-Path -Path $PSScriptRoot -ChildPath '../units'
+. $(Join-Path -Path $Here -ChildPath 'test_utils.ps1')
+. $(Join-Path -Path $PSScriptRoot -ChildPath 'ControlMHost.ps1')
+
+$moduleName = (Split-Path -Leaf $MyInvocation.MyCommand.Path) -Replace ".bench.ps1"
+$ansibleModulePath = Join-Path -Path $PSScriptRoot -ChildPath "../../library/$moduleName.ps1"
+$BaselinePath = Join-Path -Path $PSScriptRoot -ChildPath "$moduleName.baseline.json"
+
+Invoke-TestSetup
+
+$FullChange = @{
+    agent_to_server_port             = 8005
+    server_to_agent_port             = 8006
+    tracker_event_port               = 8035
+    primary_controlm_server_host     = 'server1'
+    authorized_controlm_server_hosts = 'server1|server2'
+    diagnostic_level                 = 1
+    job_output_name                  = 'JOBNAME'
+}
+
+$Scenarios = [ordered]@{
+    noop                     = @{ Warmup = $true; Params = @{ job_output_name = 'MEMNAME' } }
+    noop_verify_full         = @{ Warmup = $true; Params = @{ job_output_name = 'MEMNAME'; verify = 'full' } }
+    noop_return_config_none  = @{ Warmup = $true; Params = @{ job_output_name = 'MEMNAME'; return_config = 'none' } }
+    single_change            = @{ Params = @{ job_output_name = 'JOBNAME' } }
+    full_change              = @{ Params = $FullChange }
+    full_change_5000_filters = @{ Host = @{ FirewallFilters = 5000 }; Params = $FullChange }
+    instances_8              = @{ Host = @{ Instances = 8 }; Params = @{ job_output_name = 'JOBNAME'; instances = @(@{ name = 'all' }) } }
+    apply_full_change        = @{ Plan = $true; Params = $FullChange }
+}
+
+$Measures = [ordered]@{ }
+Enable-ControlMHost
+try {
+    foreach ($Name in $Scenarios.Keys) {
+        $Scenario = $Scenarios[$Name]
+        $HostOptions = if ($Scenario.Host) { $Scenario.Host } else { @{ } }
+        $Params = $Scenario.Params + @{ profile = $true }
+        $Runs = foreach ($Iteration in 1..$Iterations) {
+            New-ControlMHost @HostOptions
+            $RunParams = $Params
+            if ($Scenario.Warmup) {
+                Invoke-ControlMHostModule -ModulePath $ansibleModulePath -Params $Params | Out-Null
+                Reset-ControlMHostCall
+            }
+            if ($Scenario.Plan) {
+                $PlanRun = Invoke-ControlMHostModule -ModulePath $ansibleModulePath -Params ($Params + @{ mode = 'plan' })
+                $RunParams = @{ mode = 'apply'; plan = $PlanRun.result.plan; profile = $true }
+                Reset-ControlMHostCall
+            }
+            $Run = Invoke-ControlMHostModule -ModulePath $ansibleModulePath -Params $RunParams
+            if ($Run.rc -ne 0) {
+                throw "The scenario $Name failed: $($Run.result.msg)"
+            }
+            $Run
+        }
+
+        $Run = @($Runs)[-1]
+        $Calls = $Run.calls
+        $Calls['filters_scanned'] = $Run.result.timings.firewall_filters_scanned
+        $ElapsedTimes = @($Runs | ForEach-Object { $_.elapsed_ms } | Sort-Object)
+        $Measures[$Name] = [ordered]@{
+            median_ms     = [Math]::Round($ElapsedTimes[[int][Math]::Floor($ElapsedTimes.Count / 2)], 1)
+            payload_bytes = $Run.payload_bytes
+            calls         = $Calls
+        }
+    }
+}
+finally {
+    Disable-ControlMHost
+}
+
+$Rows = foreach ($Name in $Measures.Keys) {
+    $Row = [ordered]@{ scenario = $Name; median_ms = $Measures[$Name].median_ms; payload_bytes = $Measures[$Name].payload_bytes }
+    foreach ($Call in $Measures[$Name].calls.Keys) { $Row[$Call] = $Measures[$Name].calls[$Call] }
+    [PSCustomObject]$Row
+}
+$Rows | Format-Table -AutoSize | Out-String | Write-Host
+
+if ($OutputPath) {
+    $Measures | ConvertTo-Json -Depth 4 | Set-Content -Path $OutputPath -Encoding UTF8
+}
+
+if ($UpdateBaseline) {
+    $Baseline = [ordered]@{ }
+    $Measures.Keys | ForEach-Object { $Baseline[$_] = $Measures[$_].calls }
+    $Baseline | ConvertTo-Json -Depth 3 | Set-Content -Path $BaselinePath -Encoding UTF8
+    Write-Host "The baseline $BaselinePath has been updated."
+    exit 0
+}
+
+if (-not (Test-Path -Path $BaselinePath)) {
+    Write-Error -Message "No baseline at $BaselinePath, run with -UpdateBaseline to record the calls" -ErrorAction Continue
+    exit 1
+}
+$Baseline = Get-Content -Path $BaselinePath -Raw | ConvertFrom-Json -AsHashtable
+$Regressions = [System.Collections.ArrayList]@()
+foreach ($Name in $Measures.Keys) {
+    if (-not $Baseline.ContainsKey($Name)) {
+        $Regressions.Add("${Name}: no baseline, run with -UpdateBaseline to record it") | Out-Null
+        continue
+    }
+    foreach ($Call in $Measures[$Name].calls.Keys) {
+        $Expected = $Baseline[$Name][$Call]
+        $Actual = $Measures[$Name].calls[$Call]
+        if ($Actual -gt $Expected) {
+            $Regressions.Add("${Name}: $Call went from $Expected to $Actual") | Out-Null
+        }
+        elseif ($Actual -lt $Expected) {
+            Write-Host "${Name}: $Call went from $Expected to $Actual, run with -UpdateBaseline to record the improvement"
+        }
+    }
+}
+
+if ($Regressions.Count -gt 0) {
+    $Regressions | ForEach-Object { Write-Error -Message $_ -ErrorAction Continue }
+    exit 1
+}
+Write-Host "No regression of the provider calls against $BaselinePath."
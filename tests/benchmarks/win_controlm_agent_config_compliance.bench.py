@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Informatique CDC. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""Benchmarks the compliance tool on generated configurations.
+
+Writes a JSON lines file of full configurations, one per agent, then checks it against a
+baseline covering a dozen settings, some of them scoped to data centers. The wall time and the
+throughput of the check are reported for each iteration.
+
+The peak memory of the check is measured on the full file and on a tenth of it: the script
+fails if the memory grows with the number of records, so that the single streaming pass is
+kept. The wall time is reported but not compared, as it depends on the machine, unless a
+maximum is given with --max-seconds.
+
+Usage: win_controlm_agent_config_compliance.bench.py [--records 100000] [--iterations 3] [--max-seconds N]
+"""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tools'))
+
+import win_controlm_agent_config_compliance as compliance  # noqa: E402
+
+BASELINE = [
+    {'setting': 'ssl', 'equals': True},
+    {'setting': 'limit_log_version', 'max': 10},
+    {'setting': 'limit_log_file_size', 'max': 100},
+    {'setting': 'tcpip_timeout', 'min': 30, 'max': 120},
+    {'setting': 'diagnostic_level', 'equals': 0},
+    {'setting': 'communication_trace', 'equals': False},
+    {'setting': 'job_output_name', 'in': ['JOBNAME', 'MEMNAME']},
+    {'setting': 'primary_controlm_server_host', 'pattern': r'^ctms\d+\.'},
+    {'setting': 'persistent_connection', 'equals': True, 'hosts': ['dc1-*']},
+    {'setting': 'persistent_connection', 'equals': False, 'hosts': ['dc2-*', 'dc3-*']},
+    {'setting': 'allow_comm_init', 'equals': True, 'hosts': ['dc1-*']},
+    {'setting': 'days_to_retain_log_files', 'min': 1, 'max': 7},
+]
+
+# Values meeting the baseline, given to most of the generated agents
+COMPLIANT = {
+    'ssl': True,
+    'limit_log_version': 10,
+    'limit_log_file_size': 10,
+    'tcpip_timeout': 60,
+    'diagnostic_level': 0,
+    'communication_trace': False,
+    'job_output_name': 'JOBNAME',
+    'primary_controlm_server_host': 'ctms1.example.com',
+    'allow_comm_init': True,
+    'days_to_retain_log_files': 1,
+}
+
+SAMPLES = {
+    'int': lambda rand, setting: rand.randint(setting.get('min', 0), min(setting.get('max', 999), setting.get('min', 0) + 200)),
+    'bool': lambda rand, setting: rand.random() < 0.9,
+    'str': lambda rand, setting: rand.choice(setting['choices']) if 'choices' in setting else 'ctms%d.example.com' % rand.randint(1, 4),
+}
+
+
+def write_configs(path, records, settings):
+    """Writes records like the ones of the win_controlm_agent_config_report callback plugin."""
+    rand = random.Random(records)
+    with io.open(path, 'w', encoding='utf-8') as configs:
+        for index in range(records):
+            data_center = index % 4 + 1
+            config = dict((name, SAMPLES[setting['type']](rand, setting)) for name, setting in settings.items())
+            for name, value in COMPLIANT.items():
+                if rand.random() < 0.99:
+                    config[name] = value
+            if rand.random() < 0.99:
+                config['persistent_connection'] = data_center == 1
+            record = {
+                'host': 'dc%d-agent%d' % (data_center, index),
+                'instance': None,
+                'task': 'Configure',
+                'changed': False,
+                'config': config,
+                'diff': None,
+            }
+            configs.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def check(path, settings, records=None):
+    """Checks the first records of a file, writing the violations to a null device."""
+    evaluation = compliance.Evaluation(compliance.compile_rules(BASELINE, settings))
+    with io.open(path, 'r', encoding='utf-8') as lines, io.open(os.devnull, 'w', encoding='utf-8') as output:
+        if records is not None:
+            lines = (line for index, line in zip(range(records), lines))
+        return evaluation.run(lines, output)
+
+
+def measure_peak(path, settings, records):
+    tracemalloc.start()
+    try:
+        check(path, settings, records)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the compliance tool on generated configurations.')
+    parser.add_argument('--records', type=int, default=100000, help='number of generated configurations')
+    parser.add_argument('--iterations', type=int, default=3, help='number of measured checks, the median is reported')
+    parser.add_argument('--max-seconds', type=float, help='fails if the median check takes longer')
+    args = parser.parse_args()
+
+    settings = compliance.load_settings()
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'configs.jsonl')
+        write_configs(path, args.records, settings)
+
+        elapsed_times = []
+        for iteration in range(args.iterations):
+            started = time.time()
+            summary = check(path, settings)
+            elapsed_times.append(time.time() - started)
+        median = sorted(elapsed_times)[len(elapsed_times) // 2]
+        print('%d records, %d violating, %d rules: median %.2f s, %d records/s'
+              % (summary['records'], summary['violating_records'], len(summary['rules']), median, summary['records'] / median))
+
+        small_peak = measure_peak(path, settings, args.records // 10)
+        full_peak = measure_peak(path, settings, args.records)
+        print('peak memory: %d KiB for %d records, %d KiB for %d records'
+              % (small_peak // 1024, args.records // 10, full_peak // 1024, args.records))
+    finally:
+        shutil.rmtree(directory)
+
+    failures = []
+    if full_peak > 2 * small_peak:
+        failures.append('the peak memory grows with the number of records')
+    if args.max_seconds is not None and median > args.max_seconds:
+        failures.append('the median check took %.2f s, more than %.2f s' % (median, args.max_seconds))
+    for failure in failures:
+        sys.stderr.write(failure + '\n')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
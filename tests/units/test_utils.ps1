@@ -17,6 +17,41 @@ function Get-HostAddresses {
     return $IPAddresses
 }
 
+function New-RegistryKeyMock {
+    <#
+    .SYNOPSIS
+    Returns an object which behaves like an opened Microsoft.Win32.RegistryKey.
+    .PARAMETER Values
+    The hashtable holding the values of the registry key.
+    .PARAMETER FailOn
+    The name of a value which cannot be written.
+    #>
+    param (
+        [Parameter(Mandatory = $true)]
+        [Hashtable]
+        $Values,
+        [string]
+        $FailOn
+    )
+    $RegistryKey = [PSCustomObject]@{
+        Values = $Values
+        FailOn = $FailOn
+    }
+    $RegistryKey | Add-Member -MemberType ScriptMethod -Name SetValue -Value {
+        param ($Name, $Value, $Kind)
+        if ($Name -eq $this.FailOn) {
+            throw "Access to the registry value $Name is denied"
+        }
+        $this.Values[$Name] = $Value
+    }
+    $RegistryKey | Add-Member -MemberType ScriptMethod -Name DeleteValue -Value {
+        param ($Name, $ThrowOnMissingValue)
+        $this.Values.Remove($Name)
+    }
+    $RegistryKey | Add-Member -MemberType ScriptMethod -Name Dispose -Value { }
+    return $RegistryKey
+}
+
 function Get-AnsibleCSharpUtils {
     param (
         [parameter(ValueFromPipeline)]
@@ -35,18 +70,12 @@ function Import-AnsibleCSharpUtils {
         [parameter(ValueFromPipeline)]
         [string[]]$name
     )
-    begin {
-        [Net.ServicePointManager]::SecurityProtocol = [Net.SecurityProtocolType]::Tls12
-    }
-
     process {
         $moduleName = $_
-        $ModulePath = "$Here\$moduleName.cs"
+        $ModulePath = Join-Path -Path $Here -ChildPath "$moduleName.cs"
+        # The tests never download the Ansible utils, they must be vendored next to the tests
         if (!(Test-Path -Path $ModulePath)) {
-            $url = "https://raw.githubusercontent.com/ansible/ansible/stable-2.8/lib/ansible/module_utils/csharp/$moduleName.cs"
-            $output = "$Here\$moduleName.cs"
-            $wc = New-Object System.Net.WebClient
-            $wc.DownloadFile($url, $output)
+            throw "The C# util $moduleName.cs is not vendored in $Here, copy it from lib/ansible/module_utils/csharp of the Ansible sources"
         }
         $_csharp_utils = @(
             [System.IO.File]::ReadAllText($ModulePath)
@@ -63,7 +92,7 @@ function Get-AnsibleModuleUtils {
         [string]$Path
     )
     $content = get-content -path $Path
-    $module_pattern = [Regex]"(?im)#Requires -Module (?<module>[a-z.]*)"
+    $module_pattern = [Regex]"(?im)#(Requires -Module|AnsibleRequires -PowerShell) (?<module>[a-z.]*)"
     $modules_matches = $module_pattern.Matches($content)
     foreach ($match in $modules_matches) {
         $match.Groups["module"].Value
@@ -75,18 +104,16 @@ function Import-AnsibleModuleUtils {
         [parameter(ValueFromPipeline)]
         [string[]]$name
     )
-    begin {
-        [Net.ServicePointManager]::SecurityProtocol = [Net.SecurityProtocolType]::Tls12
-    }
-
     process {
         $moduleName = $_
-        $ModulePath = "$Here\$moduleName.psm1"
+        # The module utils of the role are loaded from its module_utils directory
+        $ModulePath = Join-Path -Path $Here -ChildPath "../../module_utils/$moduleName.psm1"
+        if (!(Test-Path -Path $ModulePath)) {
+            $ModulePath = Join-Path -Path $Here -ChildPath "$moduleName.psm1"
+        }
+        # The tests never download the Ansible utils, they must be vendored next to the tests
         if (!(Test-Path -Path $ModulePath)) {
-            $url = "https://raw.githubusercontent.com/ansible/ansible/stable-2.8/lib/ansible/module_utils/powershell/$moduleName.psm1"
-            $output = "$Here\$moduleName.psm1"
-            $wc = New-Object System.Net.WebClient
-            $wc.DownloadFile($url, $output)
+            throw "The module util $moduleName.psm1 is not vendored in $Here, copy it from lib/ansible/module_utils/powershell of the Ansible sources"
         }
         if (-not (Get-Module -Name $moduleName -ErrorAction SilentlyContinue)) {
             Import-Module -Name $ModulePath
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Informatique CDC. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""Checks how the action plugin merges the tasks and splits the result of the merged execution."""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import copy
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('ansible')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'action_plugins'))
+
+import win_controlm_agent_config as action  # noqa: E402
+
+
+def test_task_settings_options_take_precedence():
+    args = {'job_output_name': 'JOBNAME', 'restart': 'never', 'settings': {'job_output_name': 'MEMNAME', 'ssl': True}}
+    assert action.get_task_settings(args) == {'job_output_name': 'JOBNAME', 'ssl': True}
+    assert action.get_control_options(args) == {'restart': 'never'}
+
+
+def test_plan_is_not_a_setting():
+    args = {'mode': 'apply', 'plan': {'version': 1, 'agent': {'settings': []}}}
+    assert action.get_task_settings(args) == {}
+    assert action.get_control_options(args) == args
+
+
+def test_merge_task_settings():
+    assert action.merge_task_settings([{'ssl': True}, {'ssl': True, 'job_output_name': 'JOBNAME'}]) == {'ssl': True, 'job_output_name': 'JOBNAME'}
+    assert action.merge_task_settings([{'ssl': True}, {'ssl': False}]) is None
+
+
+def test_split_result():
+    result = {
+        'changed': True,
+        'restart_required': True,
+        'config': {'ssl': True},
+        'diff': {
+            'before': {'ssl': False, 'firewall_rules': {'rule': {'local_port': '9001'}}},
+            'after': {'ssl': True, 'firewall_rules': {'rule': {'local_port': '8001'}}},
+        },
+    }
+    first, second, third = action.split_result(result, [{'server_to_agent_port': 8001}, {'ssl': True}, {'job_output_name': 'JOBNAME'}], True)
+    assert first['changed'] and second['changed'] and not third['changed']
+    assert list(first['diff']['after']) == ['firewall_rules']
+    assert second['diff'] == {'before': {'ssl': False}, 'after': {'ssl': True}}
+    assert third['config'] == {'ssl': True} and third['restart_required']
+
+
+def test_split_result_without_diff():
+    result = {'changed': True, 'diff': {'before': {}, 'after': {}}}
+    first, second = action.split_result(result, [{'ssl': True}, {'job_output_name': 'JOBNAME'}], False)
+    assert first['changed'] and not second['changed']
+    assert 'diff' not in first and 'diff' not in second
+
+
+def test_split_result_reports_timings_once():
+    result = {'changed': False, 'timings': {'total_ms': 42}}
+    first, second = action.split_result(result, [{'ssl': True}, {'job_output_name': 'JOBNAME'}], False)
+    assert first['timings'] == {'total_ms': 42}
+    assert 'timings' not in second
+
+
+def test_batch_is_emptied_by_the_last_merged_task():
+    batch = {'task2': {'changed': True}, 'task3': {'changed': False}}
+    assert action.split_batch(batch, 'task2') == ({'changed': True}, {'task3': {'changed': False}})
+    assert action.split_batch({'task3': {'changed': False}}, 'task3') == ({'changed': False}, {})
+    assert batch == {'task2': {'changed': True}, 'task3': {'changed': False}}
+
+
+def test_stale_batch_is_dropped():
+    assert action.split_batch({'task2': {'changed': True}}, 'task4') == (None, {})
+    assert action.split_batch(None, 'task4') == (None, {})
+
+
+class Task:
+
+    def __init__(self, **attributes):
+        for name in action.EXECUTION_ATTRIBUTES:
+            setattr(self, name, None)
+        self.__dict__.update(attributes)
+
+
+@pytest.mark.parametrize('attributes', [
+    {'become': True},
+    {'become_user': 'Administrator'},
+    {'environment': [{'HTTPS_PROXY': 'proxy:3128'}]},
+    {'delegate_to': 'jumphost'},
+    {'notify': ['Restart the agent']},
+    {'ignore_errors': True},
+    {'no_log': True},
+    {'async_val': 60},
+    {'timeout': 30},
+])
+def test_tasks_of_another_execution_context(attributes):
+    assert action.get_execution_context(Task(**attributes)) != action.get_execution_context(Task())
+    assert action.get_execution_context(Task(**attributes)) == action.get_execution_context(Task(**attributes))
+
+
+def test_options_are_read_from_the_documentation():
+    options = action.get_options()
+    assert options['agent_to_server_port']['min'] == 1024 and options['agent_to_server_port']['max'] == 65535
+    assert options['smtp_sender_mail']['max_length'] == 99
+    assert options['cjk_encoding']['requires'] == ('foreign_language_support', 'CJK')
+    assert options['smtp_server_relay_name']['type'] == 'str'
+    assert 'ssl' in options['instances']['suboptions'] and options['instances']['suboptions']['name']['required']
+
+
+def test_constraints_do_not_depend_on_the_description(tmp_path):
+    stub = tmp_path / 'win_controlm_agent_config.py'
+    stub.write_text(u'DOCUMENTATION = """\noptions:\n    tcpip_timeout:\n        description:\n            - Allowed from 0 to 999999.\n        type: int\n"""\n'
+                    u'RETURN = """\nconfig:\n    contains:\n        tcpip_timeout:\n            type: int\n"""\n')
+    options = action.load_options(str(stub))
+    assert (options['tcpip_timeout']['min'], options['tcpip_timeout']['max']) == (0, 999999)
+
+
+def test_missing_settings_table_fails(tmp_path):
+    with pytest.raises(action.ArgumentError, match='does not define the settings table'):
+        action.load_options(settings_path=action.documentation.STUB_PATH)
+
+
+@pytest.mark.parametrize('entry, message', [
+    (u"    tcpip_timeout = @{ Key = 'CONFIG'; Name = 'TCP_IP_TIMEOUT'; Type = 'int'; Min = 0; Max = 999999; Default = '60' }\n",
+     'does not define the settings ssl'),
+    (u"    tcpip_timeout = @{ Key = 'CONFIG'; Name = 'TCP_IP_TIMEOUT' }\n    tcpip_timeout = @{ Key = 'CONFIG'; Name = 'TCP_IP_TIMEOUT' }\n",
+     'the setting tcpip_timeout is defined twice'),
+    (u"    tcpip_timeout = @{\n        Key = 'CONFIG'; Name = 'TCP_IP_TIMEOUT'; Type = 'int'; Min = 0; Max = 999999 }\n",
+     'is not an entry on a single line'),
+    (u"    tcpip_timeout = @{ Key = 'CONFIG'; Name = 'TCP_IP_TIMEOUT'; Type = 'int'; Min = 0x0; Max = 999999 }\n",
+     'the field "Min = 0x0" of the setting tcpip_timeout cannot be read'),
+    (u"    tcpip_timeout = @{ Key = 'CONFIG'; Name = 'TCP_IP_TIMEOUT'; Type = 'int'; Min = 0 }\n",
+     'the setting tcpip_timeout must define both Min and Max'),
+])
+def test_unreadable_settings_table_fails(tmp_path, entry, message):
+    module_util = tmp_path / 'Ansible.ModuleUtils.ControlMAgent.psm1'
+    module_util.write_text(u"$settings = [ordered]@{\n" + entry + u"}\n")
+    with pytest.raises(action.documentation.DocumentationError, match=message):
+        action.documentation.load_settings_table(str(module_util), ['tcpip_timeout', 'ssl'])
+
+
+def test_valid_arguments_are_converted():
+    args = {
+        'agent_to_server_port': '8000',
+        'SSL': 'yes',
+        'smtp_server_relay_name': 'smtp.example.com',
+        'job_statistics_to_sysout': 0,
+        'settings': {'cjk_encoding': 'UTF-8', 'foreign_language_support': 'cjk'},
+        'instances': [{'name': 'Agent2', 'tracker_event_port': 7036}],
+    }
+    assert action.check_arguments(args, action.get_options()) == {
+        'agent_to_server_port': 8000,
+        'ssl': True,
+        'smtp_server_relay_name': 'smtp.example.com',
+        'add_job_statistics_to_sysout': False,
+        'settings': {'cjk_encoding': 'UTF-8', 'foreign_language_support': 'cjk'},
+        'instances': [{'name': 'Agent2', 'tracker_event_port': 7036}],
+    }
+    action.validate_arguments(args, action.get_options())
+
+
+@pytest.mark.parametrize('args, message', [
+    ({'agent_to_server_port': 80}, 'value of agent_to_server_port must be between 1024 and 65535, got: 80'),
+    ({'agent_to_server_port': 'port'}, 'unable to convert to int'),
+    ({'ssl': 'maybe'}, "The value 'maybe' is not a valid boolean"),
+    ({'cjk_encoding': 'UTF-16'}, 'value of cjk_encoding must be one of: , UTF-8,'),
+    ({'smtp_sender_mail': 'x' * 100}, 'value of smtp_sender_mail must not exceed 99 characters, got: 100'),
+    ({'job_ouptut_name': 'JOBNAME'}, 'Unsupported parameters for (win_controlm_agent_config) module: job_ouptut_name'),
+    ({'instances': [{'name': 'Agent2', 'ssl': 'maybe'}]}, 'not a valid boolean. Valid booleans include: 1, 1.0'),
+    ({'instances': [{'service_name': 'ctmag_Agent2'}]}, 'missing required arguments: name found in instances'),
+    ({'settings': {'diagnostic_level': 5}}, 'value of diagnostic_level must be between 0 and 4, got: 5 found in settings'),
+    ({'cjk_encoding': 'UTF-8', 'foreign_language_support': 'LATIN-1'},
+     'value of cjk_encoding requires foreign_language_support to be CJK, got: LATIN-1'),
+    ({'cjk_encoding': 'UTF-8', 'instances': [{'name': 'Agent2', 'foreign_language_support': 'LATIN-1'}]},
+     'value of cjk_encoding requires foreign_language_support to be CJK, got: LATIN-1 found in instances -> Agent2'),
+])
+def test_invalid_arguments(args, message):
+    with pytest.raises(action.ArgumentError) as error:
+        action.validate_arguments(args, action.get_options())
+    assert message in str(error.value)
+
+
+def test_requirement_is_left_to_the_module_when_not_set():
+    # The stored value of foreign_language_support is only known on the host
+    action.validate_arguments({'cjk_encoding': 'UTF-8'}, action.get_options())
+    action.validate_arguments({'cjk_encoding': '', 'foreign_language_support': 'LATIN-1'}, action.get_options())
+
+
+def get_entry(**fields):
+    entry = {'config': {'ssl': True, 'job_output_name': 'JOBNAME', 'tracker_event_port': 7035}, 'collected': '2020-06-02T12:00:00.1234567Z',
+             'written': False, 'restart_required': False, 'default_instance': True, 'expires': None}
+    entry.update(fields)
+    return entry
+
+
+NOW = action.parse_timestamp('2020-06-02T12:30:00Z')
+
+
+def test_parse_timestamp():
+    assert action.parse_timestamp('2020-06-02T12:00:00.1234567Z') - action.parse_timestamp('2020-06-02T11:00:00Z') == pytest.approx(3600.1234567)
+    assert action.parse_timestamp('2020-06-02 12:00') is None
+
+
+def test_cached_result_of_a_compliant_host():
+    args = {'ssl': True, 'settings': {'job_output_name': 'jobname'}, 'trust_cached_facts_for': 3600}
+    result = action.get_cached_result(args, {'Default': get_entry(), 'Agent2': get_entry(default_instance=False)}, NOW, True)
+    assert result == {'changed': False, 'restart_required': False, 'diff': {'before': {}, 'after': {}},
+                      'config': get_entry()['config'], 'from_cached_facts': True}
+
+    args = {'ssl': True, 'instances': [{'name': 'Agent2', 'tracker_event_port': 7035}], 'return_config': 'none', 'trust_cached_facts_for': 3600}
+    result = action.get_cached_result(args, {'Default': get_entry(config=dict(get_entry()['config'], ssl=False)), 'Agent2': get_entry(default_instance=False)}, NOW, False)
+    assert result == {'changed': False, 'restart_required': False, 'instances': {'Agent2': {'changed': False, 'restart_required': False}},
+                      'from_cached_facts': True}
+
+
+@pytest.mark.parametrize('args, entry', [
+    ({'ssl': True}, get_entry()),
+    ({'ssl': False, 'trust_cached_facts_for': 3600}, get_entry()),
+    ({'diagnostic_level': 0, 'trust_cached_facts_for': 3600}, get_entry()),
+    ({'ssl': True, 'trust_cached_facts_for': 600}, get_entry()),
+    ({'ssl': True, 'trust_cached_facts_for': 3600}, get_entry(written=True)),
+    ({'ssl': True, 'trust_cached_facts_for': 3600}, get_entry(restart_required=True)),
+    ({'ssl': True, 'trust_cached_facts_for': 3600}, get_entry(expires='2020-06-02T12:15:00.0000000Z')),
+    ({'ssl': True, 'trust_cached_facts_for': 3600, 'report_log_usage': True}, get_entry()),
+    ({'ssl': True, 'trust_cached_facts_for': 3600, 'mode': 'plan'}, get_entry()),
+    ({'ssl': True, 'trust_cached_facts_for': 3600, 'instances': [{'name': 'all'}]}, get_entry()),
+    ({'ssl': True, 'trust_cached_facts_for': 3600, 'instances': [{'name': 'Agent3'}]}, get_entry()),
+])
+def test_host_is_contacted(args, entry):
+    assert action.get_cached_result(args, {'Default': entry}, NOW, False) is None
+
+
+def test_merge_facts():
+    cached = {'Default': get_entry(), 'Agent2': get_entry(default_instance=False)}
+    returned = {'Agent2': get_entry(default_instance=False, written=True)}
+    assert action.merge_facts({'ansible_facts': {'controlm_agent': returned}}, cached) == dict(cached, **returned)
+    assert action.merge_facts({'ansible_facts': {'controlm_agent': returned}}, None) == returned
+    assert action.merge_facts({'failed': True}, cached) is None
+
+
+class Block:
+
+    def __init__(self, *tasks):
+        self.block = list(tasks)
+        for task in tasks:
+            task._parent = self
+
+
+class PlayTask(Task):
+
+    def __init__(self, uuid, args, **attributes):
+        super(PlayTask, self).__init__(**attributes)
+        self._uuid = uuid
+        self.args = args
+        self.action = 'win_controlm_agent_config'
+        self.when = []
+        self.loop = None
+        self.loop_with = None
+        self.until = []
+        self.vars = {}
+        self.run_once = False
+        self.diff = True
+
+    def get_name(self):
+        return 'Configure %s' % self._uuid
+
+
+class Templar:
+
+    def template(self, value):
+        return copy.deepcopy(value)
+
+
+class Connection:
+
+    class _shell:
+        tmpdir = 'C:\\Windows\\Temp'
+
+
+def run_task(task, facts=None):
+    """Runs the action plugin for a task, returning its result and the arguments of the module executions."""
+    executions = []
+
+    def execute_module(module_name, module_args, task_vars):
+        executions.append(module_args)
+        settings = dict(module_args.get('settings') or {}, **action.get_task_settings(module_args))
+        return {'changed': True, 'diff': {'before': dict((name, None) for name in settings), 'after': settings}}
+
+    plugin = action.ActionModule(task, Connection(), None, None, Templar())
+    plugin._execute_module = execute_module
+    return plugin.run(task_vars={'ansible_facts': facts or {}}), executions
+
+
+def test_compatible_tasks_are_merged():
+    first = PlayTask('task1', {'SSL': 'yes'})
+    second = PlayTask('task2', {'job_statistics_to_sysout': 'true', 'settings': '{"job_output_name": "JOBNAME"}'})
+    Block(first, second)
+
+    result, executions = run_task(first)
+    assert executions == [{'settings': {'ssl': True, 'add_job_statistics_to_sysout': True, 'job_output_name': 'JOBNAME'}}]
+    assert result['merged_tasks'] == ['Configure task2']
+    assert result['changed'] and result['diff']['after'] == {'ssl': True}
+    batch = result['ansible_facts'][action.BATCH_FACT]
+    assert batch['task2']['diff']['after'] == {'add_job_statistics_to_sysout': True, 'job_output_name': 'JOBNAME'}
+
+    result, executions = run_task(second, {action.BATCH_FACT: batch})
+    assert executions == []
+    assert result['changed'] and result['ansible_facts'] == {action.BATCH_FACT: {}}
+
+
+@pytest.mark.parametrize('first_args, second_args', [
+    ({'job_statistics_to_sysout': True}, {'add_job_statistics_to_sysout': False}),
+    ({'SSL': True}, {'ssl': 'no'}),
+    ({'ssl': True}, {'settings': {'SSL': False}}),
+])
+def test_conflicting_tasks_are_not_merged(first_args, second_args):
+    first = PlayTask('task1', first_args)
+    Block(first, PlayTask('task2', second_args))
+
+    result, executions = run_task(first)
+    assert executions == [first_args]
+    assert 'merged_tasks' not in result
+
+
+def test_stale_batch_is_reset():
+    task = PlayTask('task1', {'ssl': True})
+    Block(task)
+
+    result, executions = run_task(task, {action.BATCH_FACT: {'task9': {'changed': True}}})
+    assert executions == [{'ssl': True}]
+    assert result['ansible_facts'] == {action.BATCH_FACT: {}}
+
+
+def test_no_log_task_is_not_merged():
+    first = PlayTask('task1', {'ssl': True})
+    Block(first, PlayTask('task2', {'smtp_sender_mail': 'agent@example.com'}, no_log=True))
+
+    result, executions = run_task(first)
+    assert executions == [{'ssl': True}]
+    assert 'merged_tasks' not in result
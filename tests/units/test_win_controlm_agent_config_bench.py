@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Informatique CDC. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""Checks that the call baseline of the module benchmark covers every scenario and every counted call."""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import io
+import json
+import os
+import re
+
+BENCHMARKS_PATH = os.path.join(os.path.dirname(__file__), '..', 'benchmarks')
+
+
+def read(name):
+    with io.open(os.path.join(BENCHMARKS_PATH, name), encoding='utf-8') as bench_file:
+        return bench_file.read()
+
+
+BASELINE = json.loads(read('win_controlm_agent_config.baseline.json'))
+BENCH = read('win_controlm_agent_config.bench.ps1')
+HOST = read('ControlMHost.ps1')
+
+
+def test_every_scenario_has_a_baseline():
+    scenarios = BENCH[BENCH.index('$Scenarios = [ordered]@{'):]
+    scenarios = scenarios[:scenarios.index('\n}\n')]
+    assert re.findall(r'^    (\w+)\s+= @\{', scenarios, re.MULTILINE) == list(BASELINE)
+
+
+def test_every_call_has_a_baseline():
+    counters = HOST[HOST.index('$global:ControlMHost.Calls = [ordered]@{'):]
+    counters = counters[:counters.index('}')]
+    calls = re.findall(r'^\s+(\w+)\s+= 0$', counters, re.MULTILINE) + ['filters_scanned']
+    assert [sorted(baseline) for baseline in BASELINE.values()] == [sorted(calls)] * len(BASELINE)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Informatique CDC. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""Checks how the compliance tool compiles a baseline and checks the collected configurations."""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import io
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'tools'))
+
+import win_controlm_agent_config_compliance as compliance  # noqa: E402
+
+SETTINGS = compliance.load_settings()
+
+
+def evaluate(baseline, records):
+    evaluation = compliance.Evaluation(compliance.compile_rules(baseline, SETTINGS))
+    output = io.StringIO()
+    summary = evaluation.run([json.dumps(record) for record in records], output)
+    violations = [json.loads(line) for line in output.getvalue().splitlines()]
+    return summary, violations
+
+
+def test_settings_are_read_from_the_documentation():
+    assert SETTINGS['diagnostic_level'] == {'type': 'int', 'min': 0, 'max': 4}
+    assert SETTINGS['ssl'] == {'type': 'bool'}
+    assert SETTINGS['agent_directory'] == {'type': 'str'}
+    assert 'UTF-8' in SETTINGS['cjk_encoding']['choices']
+
+
+def test_violations_and_rule_counts():
+    baseline = {
+        'ssl': 'yes',
+        'limit_log_version': {'max': 10},
+        'tcpip_timeout': {'min': 30, 'max': 120},
+    }
+    summary, violations = evaluate(baseline, [
+        {'host': 'host1', 'config': {'ssl': True, 'limit_log_version': 10, 'tcpip_timeout': 60}},
+        {'host': 'host2', 'config': {'ssl': False, 'limit_log_version': 20, 'tcpip_timeout': 60}},
+        {'host': 'host3', 'instances': {'Agent2': {'config': {'ssl': True, 'limit_log_version': 5}}}},
+    ])
+
+    assert summary['records'] == 3
+    assert summary['violating_records'] == 1
+    counts = dict((rule['rule'], (rule['checked'], rule['violations'], rule['missing'])) for rule in summary['rules'])
+    assert counts == {'ssl': (3, 1, 0), 'limit_log_version': (3, 1, 0), 'tcpip_timeout': (3, 0, 1)}
+    assert violations == [
+        {'host': 'host2', 'instance': None, 'violations': [
+            {'rule': 'ssl', 'setting': 'ssl', 'value': False, 'expected': {'equals': 'yes'}},
+            {'rule': 'limit_log_version', 'setting': 'limit_log_version', 'value': 20, 'expected': {'max': 10}},
+        ]},
+    ]
+
+
+def test_partial_record_is_missing_not_violating():
+    baseline = {
+        'ssl': 'yes',
+        'tcpip_timeout': {'min': 30, 'max': 120},
+    }
+    # As returned by the info module for a subset of the settings
+    summary, violations = evaluate(baseline, [
+        {'host': 'host1', 'config': {'ssl': True}},
+    ])
+
+    assert summary['violating_records'] == 0
+    counts = dict((rule['rule'], (rule['checked'], rule['violations'], rule['missing'])) for rule in summary['rules'])
+    assert counts == {'ssl': (1, 0, 0), 'tcpip_timeout': (1, 0, 1)}
+    assert violations == []
+
+
+def test_rules_scoped_to_hosts():
+    baseline = [
+        {'setting': 'persistent_connection', 'equals': True, 'hosts': 'dc1-*'},
+        {'setting': 'persistent_connection', 'equals': False, 'hosts': ['dc2-*', 'dc3-*']},
+    ]
+    summary, violations = evaluate(baseline, [
+        {'host': 'dc1-agent1', 'config': {'persistent_connection': True}},
+        {'host': 'dc2-agent1', 'config': {'persistent_connection': True}},
+        {'host': 'dc4-agent1', 'config': {'persistent_connection': True}},
+    ])
+
+    assert [(rule['rule'], rule['checked'], rule['violations']) for rule in summary['rules']] == [
+        ('persistent_connection[dc1-*]', 1, 0), ('persistent_connection[dc2-*,dc3-*]', 1, 1)]
+    assert [violation['host'] for violation in violations] == ['dc2-agent1']
+
+
+@pytest.mark.parametrize('baseline, message', [
+    ({'unknown_setting': 1}, 'unknown setting'),
+    ({'diagnostic_level': 5}, 'not in the range 0-4'),
+    ({'cjk_encoding': 'UTF-16'}, 'not one of'),
+    ({'ssl': 'maybe'}, 'is not a bool'),
+    ({'ssl': {'min': 1}}, 'cannot be used with the bool setting'),
+    ({'tcpip_timeout': {'above': 1}}, 'unknown keys above'),
+    ([{'equals': 1}], 'does not define a setting'),
+])
+def test_invalid_baseline(baseline, message):
+    with pytest.raises(compliance.BaselineError, match=message):
+        compliance.compile_rules(baseline, SETTINGS)
+
+
+def test_command_line(tmp_path):
+    baseline = tmp_path / 'baseline.json'
+    baseline.write_text(u'{"job_output_name": {"in": ["JOBNAME", "MEMNAME"]}}')
+    configs = tmp_path / 'configs.jsonl'
+    configs.write_text(u'{"host": "host1", "config": {"job_output_name": "JOBNAME"}}\n'
+                       u'{"host": "host2", "config": {"job_output_name": "OTHER"}}\n')
+
+    exit_code = compliance.main(['--baseline', str(baseline), '--violations', str(tmp_path / 'violations.jsonl'),
+                                 '--summary', str(tmp_path / 'summary.json'), str(configs)])
+
+    assert exit_code == 1
+    assert json.loads((tmp_path / 'summary.json').read_text())['violating_records'] == 1
+    assert json.loads((tmp_path / 'violations.jsonl').read_text())['host'] == 'host2'
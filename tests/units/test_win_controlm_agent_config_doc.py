@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Informatique CDC. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""Checks that the documentation stubs match the settings table shared by the PowerShell modules."""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import ast
+import os
+import re
+import sys
+
+import pytest
+import yaml
+
+LIBRARY_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'library')
+MODULE_UTIL_NAME = 'Ansible.ModuleUtils.ControlMAgent'
+MODULE_NAME = 'win_controlm_agent_config'
+INFO_MODULE_NAME = 'win_controlm_agent_config_info'
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'module_utils'))
+
+from win_controlm_agent_config_options import FIELD_PATTERN, load_settings_table, parse_value  # noqa: E402
+
+# The description lines must state the constraints of the settings table
+RANGE_PATTERN = re.compile(r'^Range (?P<min>-?\d+)-(?P<max>\d+)\.$')
+LENGTH_PATTERN = re.compile(r'^Text up to (?P<length>\d+) characters\.$')
+REQUIRES_PATTERN = re.compile(r'^Requires I\((?P<requires>[a-z0-9_]+=[^)]*)\)\.$')
+SPEC_PATTERN = re.compile(r'^\$spec\.options\.(?P<name>[a-z0-9_]+) = (?:@\{ (?P<fields>.*) \}$)?', re.MULTILINE)
+
+
+def load_stub_variable(name, module_name=MODULE_NAME):
+    with open(os.path.join(LIBRARY_PATH, module_name + '.py')) as stub_file:
+        tree = ast.parse(stub_file.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and node.targets[0].id == name:
+            return yaml.safe_load(node.value.value)
+    raise KeyError(name)
+
+
+def load_spec_options():
+    """Returns the fields of the options added to the argument spec after the settings, None for the multi-line ones."""
+    with open(os.path.join(LIBRARY_PATH, MODULE_NAME + '.ps1')) as module_file:
+        source = module_file.read()
+    options = {}
+    for match in SPEC_PATTERN.finditer(source):
+        fields = match.group('fields')
+        options[match.group('name')] = None if fields is None else dict(
+            (field.group('key'), parse_value(field.group('value'))) for field in FIELD_PATTERN.finditer(fields)
+        )
+    return options
+
+
+SETTINGS = load_settings_table()
+SPEC_OPTIONS = load_spec_options()
+OPTIONS = load_stub_variable('DOCUMENTATION')['options']
+CONFIG = load_stub_variable('RETURN')['config']['contains']
+MANAGED = sorted(name for name, setting in SETTINGS.items() if not setting.get('ReadOnly'))
+
+
+def test_every_option_is_documented():
+    assert sorted(name for name in OPTIONS if name in SETTINGS) == MANAGED
+
+
+def test_every_setting_is_returned():
+    assert sorted(CONFIG) == sorted(SETTINGS)
+
+
+@pytest.mark.parametrize('name', MANAGED)
+def test_option_type(name):
+    assert OPTIONS[name]['type'] == SETTINGS[name]['Type']
+    assert CONFIG[name]['type'] == SETTINGS[name]['Type']
+
+
+@pytest.mark.parametrize('name', MANAGED)
+def test_option_choices(name):
+    assert OPTIONS[name].get('choices') == SETTINGS[name].get('Choices')
+
+
+@pytest.mark.parametrize('name', MANAGED)
+def test_option_aliases(name):
+    assert OPTIONS[name].get('aliases') == SETTINGS[name].get('Aliases')
+
+
+@pytest.mark.parametrize('name', MANAGED)
+def test_option_range(name):
+    ranges = [RANGE_PATTERN.match(line) for line in OPTIONS[name]['description']]
+    ranges = [(int(match.group('min')), int(match.group('max'))) for match in ranges if match]
+    if 'Min' in SETTINGS[name]:
+        assert ranges == [(SETTINGS[name]['Min'], SETTINGS[name]['Max'])]
+    else:
+        assert ranges == []
+
+
+@pytest.mark.parametrize('name', MANAGED)
+def test_option_length(name):
+    lengths = [LENGTH_PATTERN.match(line) for line in OPTIONS[name]['description']]
+    lengths = [int(match.group('length')) for match in lengths if match]
+    assert lengths == ([SETTINGS[name]['MaxLength']] if 'MaxLength' in SETTINGS[name] else [])
+
+
+@pytest.mark.parametrize('name', MANAGED)
+def test_option_requirement(name):
+    requirements = [REQUIRES_PATTERN.match(line) for line in OPTIONS[name]['description']]
+    requirements = [match.group('requires') for match in requirements if match]
+    assert requirements == ([SETTINGS[name]['Requires']] if 'Requires' in SETTINGS[name] else [])
+
+
+def test_every_control_option_is_in_the_spec():
+    assert sorted(SPEC_OPTIONS) == sorted(name for name in OPTIONS if name not in SETTINGS)
+
+
+@pytest.mark.parametrize('name', sorted(name for name, fields in SPEC_OPTIONS.items() if fields is not None))
+def test_control_option(name):
+    fields = SPEC_OPTIONS[name]
+    assert OPTIONS[name]['type'] == fields['type']
+    assert OPTIONS[name].get('choices') == fields.get('choices')
+    assert OPTIONS[name].get('default') == fields.get('default')
+
+
+def test_control_options_of_the_action_plugin():
+    pytest.importorskip('ansible')
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'action_plugins'))
+    import win_controlm_agent_config as action
+
+    assert sorted(action.CONTROL_OPTIONS) == sorted(SPEC_OPTIONS)
+
+
+def test_info_module_reads_every_setting():
+    assert load_stub_variable('DOCUMENTATION', INFO_MODULE_NAME)['options']['keys']['choices'] == list(SETTINGS)
+
+
+@pytest.mark.parametrize('module_name', [MODULE_NAME, INFO_MODULE_NAME])
+def test_module_imports_the_settings_table(module_name):
+    with open(os.path.join(LIBRARY_PATH, module_name + '.ps1')) as module_file:
+        source = module_file.read()
+    assert '#Requires -Module %s\n' % MODULE_UTIL_NAME in source
+    assert '$settings = Get-ControlMSettingTable\n' in source
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Informatique CDC. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""Checks how the callback plugin writes the configurations and summarizes them."""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import csv
+import io
+import json
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('ansible')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'callback_plugins'))
+
+import win_controlm_agent_config_report as report  # noqa: E402
+
+
+def read_lines(path):
+    with io.open(path, encoding='utf-8') as lines:
+        return [json.loads(line) for line in lines]
+
+
+def get_summary(lines):
+    return dict((line['setting'], line) for line in lines if 'records' in line)
+
+
+def get_deviations(lines):
+    return [line for line in lines if 'reason' in line]
+
+
+def test_jsonl_report(tmp_path):
+    config_report = report.ConfigReport(str(tmp_path / 'config.jsonl'), baseline={'diagnostic_level': 0})
+    config_report.add('host1', 'Configure', {'changed': True, 'config': {'diagnostic_level': 0, 'fix_number': 'FP1'},
+                                             'diff': {'before': {'diagnostic_level': 2}, 'after': {'diagnostic_level': 0}}})
+    config_report.add('host2', 'Configure', {'changed': False, 'config': {'diagnostic_level': 0, 'fix_number': 'FP1'}})
+    config_report.add('host3', 'Configure', {'changed': False, 'config': {'diagnostic_level': 4, 'fix_number': 'FP1'}})
+    config_report.close()
+
+    records = read_lines(config_report.path)
+    assert [record['host'] for record in records] == ['host1', 'host2', 'host3']
+    assert records[0]['diff']['after'] == {'diagnostic_level': 0}
+
+    lines = read_lines(config_report.summary_path)
+    summary = get_summary(lines)
+    assert summary['diagnostic_level']['values'] == [{'value': 0, 'count': 2}, {'value': 4, 'count': 1}]
+    assert summary['diagnostic_level']['majority'] == 0
+    assert summary['diagnostic_level']['changed'] == 1
+    assert summary['diagnostic_level']['deviating_from_baseline'] == 1
+    assert 'majority' not in summary['fix_number']
+    assert get_deviations(lines) == [
+        {'host': 'host3', 'instance': None, 'setting': 'diagnostic_level', 'value': 4, 'reason': 'majority', 'expected': 0},
+        {'host': 'host3', 'instance': None, 'setting': 'diagnostic_level', 'value': 4, 'reason': 'baseline', 'expected': 0},
+    ]
+
+
+def test_csv_report_with_instances(tmp_path):
+    config_report = report.ConfigReport(str(tmp_path / 'config.csv'), file_format='csv')
+    config_report.add('host1', 'Configure', {'instances': {
+        'Default': {'changed': False, 'config': {'job_output_name': 'JOBNAME'}},
+        'Agent2': {'changed': True, 'config': {'job_output_name': 'MEMNAME'},
+                   'diff': {'before': {'job_output_name': 'JOBNAME'}, 'after': {'job_output_name': 'MEMNAME'}}},
+    }})
+    config_report.add('host2', 'Configure', {'config': {'job_output_name': 'JOBNAME'}})
+    config_report.close()
+
+    with io.open(config_report.path, encoding='utf-8', newline='') as rows:
+        rows = list(csv.DictReader(rows))
+    assert [(row['host'], row['instance'], row['value']) for row in rows] == [
+        ('host1', 'Default', '"JOBNAME"'), ('host1', 'Agent2', '"MEMNAME"'), ('host2', '', '"JOBNAME"')]
+    assert rows[1]['before'] == '"JOBNAME"'
+
+    lines = read_lines(config_report.summary_path)
+    assert get_summary(lines)['job_output_name']['deviating_from_majority'] == 1
+    assert [(line['host'], line['instance']) for line in get_deviations(lines)] == [('host1', 'Agent2')]
+
+
+def test_report_memory_does_not_grow_with_hosts(tmp_path):
+    config_report = report.ConfigReport(str(tmp_path / 'config.jsonl'), max_values=10)
+    for index in range(10000):
+        config_report.add('host%d' % index, 'Configure', {'config': {'fix_number': 'FP%d' % index, 'diagnostic_level': index % 100 == 0}})
+    config_report.close()
+
+    summary = get_summary(read_lines(config_report.summary_path))
+    assert len(config_report.settings['fix_number'].values) == 10
+    assert summary['fix_number']['other_values'] == 9990
+    assert 'majority' not in summary['fix_number']
+    assert summary['diagnostic_level']['majority'] is False
+    assert summary['diagnostic_level']['deviating_from_majority'] == 100
+
+
+def test_looped_results_are_reported_per_item(tmp_path):
+    config_report = report.ConfigReport(str(tmp_path / 'config.jsonl'))
+    config_report.add('host1', 'Configure', {'changed': True, 'results': [
+        {'item': 'Default', 'changed': False, 'config': {'diagnostic_level': 0}},
+        {'item': 'Agent2', 'changed': True, 'instances': {'Agent2': {'changed': True, 'config': {'diagnostic_level': 4},
+                                                                     'diff': {'before': {'diagnostic_level': 0}, 'after': {'diagnostic_level': 4}}}}},
+        {'item': 'Agent3', 'failed': True, 'msg': 'Agent3 is not installed'},
+        {'item': 'Agent4', 'skipped': True, 'changed': False},
+    ]})
+    config_report.close()
+
+    records = read_lines(config_report.path)
+    assert [(record['instance'], record['changed'], record['config']) for record in records] == [
+        (None, False, {'diagnostic_level': 0}), ('Agent2', True, {'diagnostic_level': 4})]
+    summary = get_summary(read_lines(config_report.summary_path))
+    assert summary['diagnostic_level']['records'] == 2
+    assert summary['diagnostic_level']['changed'] == 1
+
+
+def test_no_report_without_configuration(tmp_path):
+    config_report = report.ConfigReport(str(tmp_path / 'config.jsonl'))
+    config_report.add('host1', 'Restart', {'changed': True})
+    config_report.close()
+    assert not os.path.exists(config_report.path)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Informatique CDC. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""Checks the health gate and the failure budget of the rolling tasks, and that their variables have a default value
+and are documented."""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import os
+import re
+
+import yaml
+from ansible.plugins.filter.mathstuff import difference
+from jinja2 import pass_environment
+from jinja2.nativetypes import NativeEnvironment
+
+ROLE_PATH = os.path.join(os.path.dirname(__file__), '..', '..')
+
+VARIABLE_PATTERN = re.compile(r'\bcontrolm_agent_[a-z_]+\b')
+# Variables registered or defined by the tasks themselves
+TASK_VARIABLE_PREFIX = 'controlm_agent_rolling_'
+
+
+def read(*path):
+    with open(os.path.join(ROLE_PATH, *path)) as role_file:
+        return role_file.read()
+
+
+DEFAULTS = yaml.safe_load(read('defaults', 'main.yml'))
+ROLLING_TASKS = read('tasks', 'rolling.yml')
+FAILURE_BUDGET_TASKS = read('tasks', 'rolling_failure_budget.yml')
+README = read('README.md')
+
+
+def task(tasks, module):
+    return [rolling_task for rolling_task in yaml.safe_load(tasks) if module in rolling_task][0]
+
+
+def render(expression, **variables):
+    environment = NativeEnvironment()
+    environment.filters['difference'] = pass_environment(difference)
+    return environment.from_string(expression).render(**dict(DEFAULTS, **variables))
+
+
+def render_checks(result, **variables):
+    expression = task(ROLLING_TASKS, 'set_fact')['set_fact']['controlm_agent_rolling_checks']
+    return render(expression, controlm_agent_rolling_result=result, **variables)
+
+
+def agent_fact(port, default_instance=False, interface='*ANY'):
+    return {'config': {'server_to_agent_port': port, 'listen_to_network_interface': interface},
+            'default_instance': default_instance}
+
+
+def test_rolling_tasks_are_valid_yaml():
+    assert [task['name'] for task in yaml.safe_load(ROLLING_TASKS)]
+    assert [task['name'] for task in yaml.safe_load(FAILURE_BUDGET_TASKS)]
+
+
+def test_failure_budget_is_checked_before_and_after_the_batch():
+    tasks = yaml.safe_load(ROLLING_TASKS)
+    assert tasks[0].get('import_tasks') == 'rolling_failure_budget.yml'
+    assert tasks[-1].get('import_tasks') == 'rolling_failure_budget.yml'
+
+
+def test_every_variable_has_a_default():
+    variables = set(VARIABLE_PATTERN.findall(ROLLING_TASKS + FAILURE_BUDGET_TASKS))
+    missing = [name for name in variables if not name.startswith(TASK_VARIABLE_PREFIX) and name not in DEFAULTS]
+    assert not missing
+
+
+def test_every_default_is_documented():
+    assert [name for name in DEFAULTS if '__%s__' % name not in README] == []
+
+
+def test_health_gate_checks_every_configured_instance():
+    result = {
+        'instances': {'Default': {'changed': True}, 'Agent2': {'changed': False}, 'Agent3': {'changed': True}},
+        'ansible_facts': {'controlm_agent': {
+            'Default': agent_fact(7006, default_instance=True),
+            'Agent2': agent_fact(7106, interface='10.0.0.2'),
+            'Agent3': agent_fact(7206),
+            'Other': agent_fact(7306),
+        }},
+    }
+    instances = [{'name': 'Default'}, {'name': 'Agent2'}, {'name': 'Agent3', 'service_name': 'ctmag_custom'}]
+    checks = render_checks(result, controlm_agent_instances=instances)
+    assert sorted(checks, key=lambda check: check['port']) == [
+        {'service': 'ctmag', 'host': '127.0.0.1', 'port': 7006},
+        {'service': 'ctmag_Agent2', 'host': '10.0.0.2', 'port': 7106},
+        {'service': 'ctmag_custom', 'host': '127.0.0.1', 'port': 7206},
+    ]
+
+
+def test_health_gate_checks_the_default_instance_without_instances():
+    result = {'ansible_facts': {'controlm_agent': {
+        'Default': agent_fact(7006, default_instance=True, interface=''),
+        'Agent2': agent_fact(7106),
+    }}}
+    assert render_checks(result) == [{'service': 'ctmag', 'host': '127.0.0.1', 'port': 7006}]
+
+
+def test_health_gate_is_replaced_by_the_health_checks():
+    assert task(ROLLING_TASKS, 'set_fact')['when'] == 'not controlm_agent_health_checks'
+    for module in ('win_service', 'win_wait_for'):
+        loop = task(ROLLING_TASKS, module)['loop']
+        assert render(loop, controlm_agent_health_checks=[{'service': 'ctmag', 'port': 7006}],
+                      controlm_agent_rolling_checks=[]) == [{'service': 'ctmag', 'port': 7006}]
+        assert render(loop, controlm_agent_rolling_checks=[{'service': 'ctmag_Agent2', 'port': 7106}]) == \
+            [{'service': 'ctmag_Agent2', 'port': 7106}]
+
+
+def test_failure_budget_stops_the_rollout_beyond_the_budget():
+    condition = '{{ %s }}' % task(FAILURE_BUDGET_TASKS, 'fail')['when']
+    hosts = {'ansible_play_hosts_all': ['agent1', 'agent2', 'agent3', 'agent4'],
+             'ansible_play_hosts': ['agent1', 'agent3']}
+    assert render(condition, controlm_agent_failure_budget=1, **hosts) is True
+    assert render(condition, controlm_agent_failure_budget='2', **hosts) is False
+    assert render(condition, controlm_agent_failure_budget=3, **hosts) is False
+    assert render(condition, ansible_play_hosts_all=['agent1'], ansible_play_hosts=['agent1']) is False
+    assert render(condition, ansible_play_hosts_all=['agent1'], ansible_play_hosts=[]) is True
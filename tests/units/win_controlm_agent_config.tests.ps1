@@ -36,6 +36,14 @@ Function Invoke-AnsibleModule {
 }
 
 $RegistryPath = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent'
+$ModuleUtilName = 'Ansible.ModuleUtils.ControlMAgent'
+
+# Placeholder for the module functions mocked before the module is loaded
+function Open-ControlMRegistryKey { param ([string]$Path) }
+function Test-ControlMAgentPort { param ([string]$ComputerName, [int]$Port, [int]$Timeout) }
+function Test-ControlMServerConnectivity { param ([array]$Targets, [int]$Timeout) }
+function Register-ControlMDiagnosticRevertTask { param ([DateTime]$Expires) }
+function Unregister-ControlMDiagnosticRevertTask { }
 
 try {
 
@@ -45,38 +53,86 @@ try {
 
             BeforeAll {
 
-                Mock -CommandName Get-ItemProperty -ParameterFilter { $Path.StartsWith($RegistryPath) } -MockWith {
+                # The registry is read by the module util, the mock runs in its scope and only sees the global variables
+                Mock -CommandName Get-ItemProperty -ModuleName $ModuleUtilName -ParameterFilter { $Path.StartsWith('HKLM:\SOFTWARE\BMC Software\Control-M/Agent') } -MockWith {
+                    $RegistryValues = $global:Registry["$Path"]
+                    if ($RegistryValues) {
+                        return $RegistryValues.Clone()
+                    }
+                }
+
+                Mock -CommandName Open-ControlMRegistryKey -MockWith {
+                    return New-RegistryKeyMock -Values $global:Registry["$Path"] -FailOn $script:RegistryWriteError
+                }
+
+                Mock -CommandName Get-ChildItem -ParameterFilter { "$Path" -eq $RegistryPath } -MockWith {
+                    return $global:Registry.Keys | Where-Object { $_ -match "^$([Regex]::Escape($RegistryPath))\\[^\\]+$" } | ForEach-Object {
+                        $SubKeyPath = $_
+                        $SubKey = [PSCustomObject]@{
+                            PSChildName = Split-Path -Path $SubKeyPath -Leaf
+                            SubKeyNames = @($global:Registry.Keys | Where-Object { $_ -match "^$([Regex]::Escape($SubKeyPath))\\[^\\]+$" } | Split-Path -Leaf)
+                        }
+                        $SubKey | Add-Member -MemberType ScriptMethod -Name GetSubKeyNames -Value { $this.SubKeyNames } -PassThru
+                    }
+                }
+
+                Mock -CommandName Get-Service -ParameterFilter { $Name -like 'ctmag*' } -MockWith {
                     return @{
+                        Name   = $Name
+                        Status = 'Running'
+                    }
+                }
+
+                Mock -CommandName Restart-Service -ParameterFilter { $Name -like 'ctmag*' } -MockWith {
+                    Write-Host "The service is restard"
+                }
+                Mock -CommandName Test-ControlMAgentPort -MockWith { return $true }
+                Mock -CommandName Get-CimInstance -ParameterFilter { $ClassName -eq 'Win32_Service' } -MockWith { }
+                Mock -CommandName Get-NetFirewallPortFilter -MockWith {
+                    return @(
+                        [PSCustomObject]@{ InstanceID = 'Control-M Agent'; LocalPort = @('9001', '9002'); RemotePort = 'Any' }
+                        [PSCustomObject]@{ InstanceID = 'Control-M Server'; LocalPort = 'Any'; RemotePort = '9000' }
+                        [PSCustomObject]@{ InstanceID = 'Remote Desktop'; LocalPort = '3389'; RemotePort = 'Any' }
+                    )
+                }
+                Mock -CommandName Get-NetFirewallRule -MockWith {
+                    return $Name | ForEach-Object { [PSCustomObject]@{ InstanceID = $_ } }
+                }
+                Mock -CommandName Set-NetFirewallPortFilter -MockWith { }
+                Mock -CommandName Register-ControlMDiagnosticRevertTask -MockWith { }
+                Mock -CommandName Unregister-ControlMDiagnosticRevertTask -MockWith { }
+            }
+
+            BeforeEach {
+                $script:RegistryWriteError = $null
+                $global:Registry = @{
+                    "$RegistryPath"        = @{
+                        DEFAULT_AGENT = 'Default'
+                    }
+                    "$RegistryPath\CONFIG" = @{
                         ATCMNDATA           = '9000'
                         AGCMNDATA           = '9001'
                         TRACKER_EVENT_PORT  = '9002'
                         CTMSHOST            = 'server2'
                         CTMPERMHOSTS        = 'server2'
-                        OUTPUT_NAME         = 'MEMNAME'
                         COMM_TRACE          = '1'
-                        JOB_WAIT            = 'Y'
                         COMMOPT             = 'SSL=N;DUMMY=N'
                         LIMIT_LOG_FILE_SIZE = '11'
                         LIMIT_LOG_VERSIONS  = '11'
                     }
-                }
-
-                Mock -CommandName Get-Service -ParameterFilter { $Name -eq 'ctmag' } -MockWith {
-                    return @{
-                        Name   = 'ctmag'
-                        Status = 'Running'
+                    "$RegistryPath\WIN"    = @{
+                        OUTPUT_NAME = 'MEMNAME'
+                        JOB_WAIT    = 'Y'
+                    }
+                    "$RegistryPath\Agent2"        = @{ }
+                    "$RegistryPath\Agent2\CONFIG" = @{
+                        AGCMNDATA          = '7006'
+                        TRACKER_EVENT_PORT = '7035'
+                    }
+                    "$RegistryPath\Agent2\WIN"    = @{
+                        OUTPUT_NAME = 'MEMNAME'
                     }
                 }
-
-                Mock -CommandName Set-ItemProperty -ParameterFilter { $Path.StartsWith($RegistryPath) } -MockWith {
-                    Write-Host "Item $Name is set in the registry with $Value"
-                }
-
-                Mock -CommandName Restart-Service -ParameterFilter { $Name -eq 'ctmag' } -MockWith {
-                    Write-Host "The service is restard"
-                }
-                Mock -CommandName Get-NetFirewallPortFilter -MockWith { }
-                Mock -CommandName Set-NetFirewallPortFilter -MockWith { }
             }
 
             It 'Should return the configuration only' {
@@ -86,6 +142,18 @@ try {
                 $result.changed | Should -Be $false
             }
 
+            It 'Should read each registry key only once' {
+
+                $params = @{
+                    job_output_name = 'JOBNAME'
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $true
+                $result.config.job_output_name | Should -Be 'JOBNAME'
+                # One read per key for the snapshot and one read-back of the WIN key
+                Assert-MockCalled -CommandName Get-ItemProperty -ModuleName $ModuleUtilName -Times 4 -Exactly -Scope It
+            }
+
             It 'Should change port numbers' {
 
                 $params = @{
@@ -99,6 +167,25 @@ try {
                 $result.diff.after.agent_to_server_port | Should -Be 8000
                 $result.diff.after.server_to_agent_port | Should -Be 8001
                 $result.diff.after.tracker_event_port | SHould -Be 8002
+                $result.diff.before.firewall_rules['Control-M Agent'].local_port | Should -Be @('9001', '9002')
+                $result.diff.after.firewall_rules['Control-M Agent'].local_port | Should -Be @('8001', '8002')
+                $result.diff.after.firewall_rules['Control-M Server'].remote_port | Should -Be @('8000')
+                $result.diff.after.firewall_rules.ContainsKey('Remote Desktop') | Should -Be $false
+                Assert-MockCalled -CommandName Get-NetFirewallPortFilter -Times 1 -Exactly -Scope It
+                Assert-MockCalled -CommandName Set-NetFirewallPortFilter -Times 2 -Exactly -Scope It
+            }
+
+            It 'Should not list the firewall rules when the ports do not change' {
+
+                $params = @{
+                    agent_to_server_port = 9000
+                    server_to_agent_port = 9001
+                    job_output_name      = 'JOBNAME'
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $true
+                Assert-MockCalled -CommandName Get-NetFirewallPortFilter -Times 0 -Exactly -Scope It
+                Assert-MockCalled -CommandName Set-NetFirewallPortFilter -Times 0 -Exactly -Scope It
             }
 
             It 'Should change controlm server hosts' {
@@ -170,9 +257,549 @@ try {
                 $result.diff.before.limit_log_version | Should -Be 11
                 $result.diff.after.limit_log_version | Should -Be 99
             }
+
+            It 'Should fail when a setting is out of range' {
+
+                $params = @{
+                    tcpip_timeout = 1000000
+                }
+                $ExitHandler = [Ansible.Basic.AnsibleModule]::Exit
+                [Ansible.Basic.AnsibleModule]::Exit = { param([Int32]$rc) throw "exit: $rc" }
+                try {
+                    { Invoke-AnsibleModule -params $params } | Should -Throw 'exit: 1'
+                }
+                finally {
+                    [Ansible.Basic.AnsibleModule]::Exit = $ExitHandler
+                }
+                Assert-MockCalled -CommandName Get-ItemProperty -ModuleName $ModuleUtilName -Times 0 -Exactly -Scope It
+            }
+
+            It 'Should fail when a setting requires another value of a stored setting' {
+
+                $ExitHandler = [Ansible.Basic.AnsibleModule]::Exit
+                [Ansible.Basic.AnsibleModule]::Exit = { param([Int32]$rc) throw "exit: $rc" }
+                try {
+                    { Invoke-AnsibleModule -params @{ cjk_encoding = 'UTF-8' } } | Should -Throw 'exit: 1'
+                }
+                finally {
+                    [Ansible.Basic.AnsibleModule]::Exit = $ExitHandler
+                }
+                $global:Registry["$RegistryPath\WIN"].ContainsKey('APPLICATION_LOCALE') | Should -Be $false
+
+                $global:Registry["$RegistryPath\CONFIG"].I18N = 'CJK'
+                $result = Invoke-AnsibleModule -params @{ cjk_encoding = 'UTF-8' }
+                $result.changed | Should -Be $true
+                $global:Registry["$RegistryPath\WIN"].APPLICATION_LOCALE | Should -Be 'UTF-8'
+            }
+
+            It 'Should write all the changes of a registry key with a single handle' {
+
+                $params = @{
+                    agent_to_server_port = 8000
+                    server_to_agent_port = 8001
+                    job_output_name      = 'JOBNAME'
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $true
+                $global:Registry["$RegistryPath\CONFIG"].ATCMNDATA | Should -Be '8000'
+                $global:Registry["$RegistryPath\CONFIG"].AGCMNDATA | Should -Be '8001'
+                $global:Registry["$RegistryPath\WIN"].OUTPUT_NAME | Should -Be 'JOBNAME'
+                Assert-MockCalled -CommandName Open-ControlMRegistryKey -ParameterFilter { $Path -ne $RegistryPath } -Times 2 -Exactly -Scope It
+            }
+
+            It 'Should return only the changed settings or no configuration' {
+
+                $params = @{
+                    job_output_name = 'JOBNAME'
+                    return_config   = 'changed'
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $true
+                @($result.config.Keys) | Should -Be @('job_output_name')
+
+                $params.return_config = 'none'
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $false
+                $result.ContainsKey('config') | Should -Be $false
+            }
+
+            It 'Should return the timings of each phase with the profile option' {
+
+                $params = @{
+                    server_to_agent_port = 8001
+                    job_output_name      = 'JOBNAME'
+                    profile              = $true
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $true
+                @($result.timings.Keys) | Should -Contain 'restart_ms'
+                $result.timings.total_ms | Should -BeGreaterOrEqual $result.timings.compare_ms
+                # One read per key for the snapshot and one read-back per written key
+                $result.timings.registry_reads | Should -Be 5
+                # The two settings and the fingerprint
+                $result.timings.registry_writes | Should -Be 3
+                $result.timings.firewall_filters_scanned | Should -Be 3
+
+                $result = Invoke-AnsibleModule -params @{ job_output_name = 'JOBNAME' }
+                $result.ContainsKey('timings') | Should -Be $false
+            }
+
+            It 'Should return the full configuration of the instance as a fact' {
+
+                $result = Invoke-AnsibleModule -params @{ job_output_name = 'JOBNAME'; return_config = 'none' }
+                $result.ContainsKey('config') | Should -Be $false
+                $Fact = $result.ansible_facts.controlm_agent.Default
+                $Fact.config.job_output_name | Should -Be 'JOBNAME'
+                $Fact.config.agent_to_server_port | Should -Be 9000
+                $Fact.written | Should -Be $true
+                $Fact.default_instance | Should -Be $true
+                $Fact.collected | Should -Match 'Z$'
+
+                $result = Invoke-AnsibleModule -params @{ job_output_name = 'JOBNAME' }
+                $result.ansible_facts.controlm_agent.Default.written | Should -Be $false
+                $result.ansible_facts.controlm_agent.Default.config | Should -Be $result.config
+
+                $result = Invoke-AnsibleModule -params @{ instances = @(@{ name = 'Agent2'; job_output_name = 'JOBNAME' }) }
+                @($result.ansible_facts.controlm_agent.Keys) | Should -Be @('Agent2')
+                $result.ansible_facts.controlm_agent.Agent2.default_instance | Should -Be $false
+                $result.ansible_facts.controlm_agent.Agent2.written | Should -Be $true
+            }
+
+            It 'Should skip the comparison when the fingerprint matches' {
+
+                $params = @{
+                    job_output_name = 'JOBNAME'
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $true
+                $global:Registry[$RegistryPath].ContainsKey('ANSIBLE_CONFIG_FINGERPRINT') | Should -Be $true
+
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $false
+                $result.config.job_output_name | Should -Be 'JOBNAME'
+                Assert-MockCalled -CommandName Get-Service -Times 1 -Exactly -Scope It
+                Assert-MockCalled -CommandName Open-ControlMRegistryKey -Times 2 -Exactly -Scope It
+            }
+
+            It 'Should run the full comparison when the registry changed or with verify full' {
+
+                $params = @{
+                    job_output_name = 'JOBNAME'
+                }
+                Invoke-AnsibleModule -params $params | Out-Null
+                $global:Registry["$RegistryPath\WIN"].OUTPUT_NAME = 'MEMNAME'
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $true
+                $result.diff.before.job_output_name | Should -Be 'MEMNAME'
+
+                $params.verify = 'full'
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $false
+                Assert-MockCalled -CommandName Get-Service -Times 3 -Exactly -Scope It
+            }
+
+            It 'Should restore the previous values when a write fails' {
+
+                $script:RegistryWriteError = 'OUTPUT_NAME'
+                $params = @{
+                    agent_to_server_port = 8000
+                    job_output_name      = 'JOBNAME'
+                }
+                $ExitHandler = [Ansible.Basic.AnsibleModule]::Exit
+                [Ansible.Basic.AnsibleModule]::Exit = { param([Int32]$rc) throw "exit: $rc" }
+                try {
+                    { Invoke-AnsibleModule -params $params } | Should -Throw 'exit: 1'
+                }
+                finally {
+                    [Ansible.Basic.AnsibleModule]::Exit = $ExitHandler
+                }
+                $global:Registry["$RegistryPath\CONFIG"].ATCMNDATA | Should -Be '9000'
+                $global:Registry["$RegistryPath\WIN"].OUTPUT_NAME | Should -Be 'MEMNAME'
+            }
+
+            It 'Should restart the agent once and wait until it accepts connections' {
+
+                $params = @{
+                    tracker_event_port  = 8002
+                    limit_log_file_size = 1000
+                    limit_log_version   = 99
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $true
+                $result.restart_required | Should -Be $false
+                Assert-MockCalled -CommandName Restart-Service -Times 1 -Exactly -Scope It
+                Assert-MockCalled -CommandName Test-ControlMAgentPort -ParameterFilter { $Port -eq 9001 } -Times 1 -Exactly -Scope It
+            }
+
+            It 'Should not restart the agent when the setting does not require it' {
+
+                $params = @{
+                    job_output_name = 'JOBNAME'
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.restart_required | Should -Be $false
+                Assert-MockCalled -CommandName Restart-Service -Times 0 -Exactly -Scope It
+            }
+
+            It 'Should only report the restart with the never policy' {
+
+                $params = @{
+                    limit_log_version = 99
+                    restart           = 'never'
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.restart_required | Should -Be $true
+                $global:Registry[$RegistryPath].ContainsKey('ANSIBLE_RESTART_PENDING') | Should -Be $false
+                Assert-MockCalled -CommandName Restart-Service -Times 0 -Exactly -Scope It
+            }
+
+            It 'Should defer the restart until an auto run' {
+
+                $params = @{
+                    limit_log_version = 99
+                    restart           = 'deferred'
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.restart_required | Should -Be $true
+                $global:Registry[$RegistryPath].ContainsKey('ANSIBLE_RESTART_PENDING') | Should -Be $true
+                Assert-MockCalled -CommandName Restart-Service -Times 0 -Exactly -Scope It
+
+                $result = Invoke-AnsibleModule -params @{ }
+                $result.changed | Should -Be $true
+                $result.restart_required | Should -Be $false
+                $global:Registry[$RegistryPath].ContainsKey('ANSIBLE_RESTART_PENDING') | Should -Be $false
+                Assert-MockCalled -CommandName Restart-Service -Times 1 -Exactly -Scope It
+            }
+
+            It 'Should configure all the agent instances in one execution' {
+
+                $params = @{
+                    job_output_name = 'JOBNAME'
+                    instances       = @(
+                        @{ name = 'all' }
+                        @{ name = 'Agent2'; server_to_agent_port = 7016 }
+                    )
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $true
+                $result.instances.Default.changed | Should -Be $true
+                $result.instances.Default.config.job_output_name | Should -Be 'JOBNAME'
+                $result.instances.Agent2.config.job_output_name | Should -Be 'JOBNAME'
+                $result.instances.Agent2.config.server_to_agent_port | Should -Be 7016
+                $result.diff.after.Agent2.server_to_agent_port | Should -Be 7016
+                $result.diff.after.Default.ContainsKey('server_to_agent_port') | Should -Be $false
+                $global:Registry["$RegistryPath\Agent2\CONFIG"].AGCMNDATA | Should -Be '7016'
+                Assert-MockCalled -CommandName Get-ChildItem -Times 1 -Exactly -Scope It
+            }
+
+            It 'Should fail when two agent instances listen on the same port' {
+
+                $params = @{
+                    instances = @(
+                        @{ name = 'Agent2'; tracker_event_port = 9001 }
+                    )
+                }
+                $ExitHandler = [Ansible.Basic.AnsibleModule]::Exit
+                [Ansible.Basic.AnsibleModule]::Exit = { param([Int32]$rc) throw "exit: $rc" }
+                try {
+                    { Invoke-AnsibleModule -params $params } | Should -Throw 'exit: 1'
+                }
+                finally {
+                    [Ansible.Basic.AnsibleModule]::Exit = $ExitHandler
+                }
+                $global:Registry["$RegistryPath\Agent2\CONFIG"].TRACKER_EVENT_PORT | Should -Be '7035'
+            }
+
+            It 'Should not move the ports of the instances which are not targeted' {
+
+                $params = @{
+                    server_to_agent_port = 8000
+                    instances            = @(
+                        @{ name = 'Agent2' }
+                    )
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $true
+                @($result.instances.Keys) | Should -Be @('Agent2')
+                $global:Registry["$RegistryPath\Agent2\CONFIG"].AGCMNDATA | Should -Be '8000'
+                $global:Registry["$RegistryPath\CONFIG"].AGCMNDATA | Should -Be '9001'
+            }
+
+            It 'Should fail when the two ports of an agent instance are the same' {
+
+                $params = @{
+                    server_to_agent_port = 9002
+                }
+                $ExitHandler = [Ansible.Basic.AnsibleModule]::Exit
+                [Ansible.Basic.AnsibleModule]::Exit = { param([Int32]$rc) throw "exit: $rc" }
+                try {
+                    { Invoke-AnsibleModule -params $params } | Should -Throw 'exit: 1'
+                }
+                finally {
+                    [Ansible.Basic.AnsibleModule]::Exit = $ExitHandler
+                }
+                $global:Registry["$RegistryPath\CONFIG"].AGCMNDATA | Should -Be '9001'
+            }
+
+            It 'Should apply the settings dictionary with the options taking precedence' {
+
+                $params = @{
+                    job_output_name = 'JOBNAME'
+                    settings        = @{
+                        job_output_name     = 'MEMNAME'
+                        communication_trace = $false
+                        tracker_event_port  = 9003
+                    }
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $true
+                $result.diff.after.job_output_name | Should -Be 'JOBNAME'
+                $result.diff.after.communication_trace | Should -Be $false
+                $result.diff.after.tracker_event_port | Should -Be 9003
+                $result.config.job_output_name | Should -Be 'JOBNAME'
+            }
+
+            It 'Should expand the tuning profile with the settings dictionary and the options taking precedence' {
+
+                $params = @{
+                    tuning_profile    = 'troubleshooting'
+                    limit_log_version = 30
+                    settings          = @{
+                        limit_log_version        = 40
+                        days_to_retain_log_files = 3
+                    }
+                    restart           = 'never'
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $true
+                $result.diff.after.diagnostic_level | Should -Be 4
+                $result.diff.after.limit_log_file_size | Should -Be 100
+                $result.diff.after.limit_log_version | Should -Be 30
+                $result.diff.after.days_to_retain_log_files | Should -Be 3
+                $result.diff.after.ContainsKey('communication_trace') | Should -Be $false
+                $global:Registry["$RegistryPath\CONFIG"].DBGLVL | Should -Be '4'
+                $global:Registry["$RegistryPath\CONFIG"].LIMIT_LOG_VERSIONS | Should -Be '30'
+            }
+
+            It 'Should extend a preset with a user-defined tuning profile' {
+
+                $params = @{
+                    tuning_profile  = 'low_overhead'
+                    tuning_profiles = @(
+                        @{ name = 'low_overhead'; limit_log_version = 5; job_output_name = 'JOBNAME' }
+                        @{ name = 'site'; limit_log_version = 1 }
+                    )
+                    restart         = 'never'
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.diff.after.limit_log_version | Should -Be 5
+                $result.diff.after.limit_log_file_size | Should -Be 5
+                $result.diff.after.job_output_name | Should -Be 'JOBNAME'
+                $global:Registry["$RegistryPath\CONFIG"].EVENT_TIMEOUT | Should -Be '300'
+
+                $ExitHandler = [Ansible.Basic.AnsibleModule]::Exit
+                [Ansible.Basic.AnsibleModule]::Exit = { param([Int32]$rc) throw "exit: $rc" }
+                try {
+                    { Invoke-AnsibleModule -params @{ tuning_profile = 'fastest' } } | Should -Throw 'exit: 1'
+                }
+                finally {
+                    [Ansible.Basic.AnsibleModule]::Exit = $ExitHandler
+                }
+            }
+
+            It 'Should check the connectivity of each Control-M Server host once' {
+
+                Mock -CommandName Test-ControlMServerConnectivity -MockWith {
+                    return , @($Targets | ForEach-Object { [ordered]@{ host = $_.Host; port = $_.Port; addresses = @('10.0.0.1'); reachable = $true; latency_ms = 1; error = $null } })
+                }
+                $params = @{
+                    primary_controlm_server_host     = 'server1'
+                    authorized_controlm_server_hosts = 'server1|SERVER1|server3'
+                    verify_connectivity              = 'report'
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $true
+                $result.connectivity.Count | Should -Be 2
+                $result.connectivity[0].host | Should -Be 'server1'
+                $result.connectivity[1].host | Should -Be 'server3'
+                $result.connectivity[1].port | Should -Be 9000
+                Assert-MockCalled -CommandName Test-ControlMServerConnectivity -ParameterFilter { $Timeout -eq 5000 } -Times 1 -Exactly -Scope It
+            }
+
+            It 'Should fail before any change when a Control-M Server host is not reachable' {
+
+                Mock -CommandName Test-ControlMServerConnectivity -MockWith {
+                    return , @($Targets | ForEach-Object { [ordered]@{ host = $_.Host; port = $_.Port; addresses = @(); reachable = ($_.Host -ne 'server3'); latency_ms = $null; error = $null } })
+                }
+                $params = @{
+                    primary_controlm_server_host     = 'server1'
+                    authorized_controlm_server_hosts = 'server1|server3'
+                    verify_connectivity              = 'fail'
+                }
+                $ExitHandler = [Ansible.Basic.AnsibleModule]::Exit
+                [Ansible.Basic.AnsibleModule]::Exit = { param([Int32]$rc) throw "exit: $rc" }
+                try {
+                    { Invoke-AnsibleModule -params $params } | Should -Throw 'exit: 1'
+                }
+                finally {
+                    [Ansible.Basic.AnsibleModule]::Exit = $ExitHandler
+                }
+                $global:Registry["$RegistryPath\CONFIG"].CTMSHOST | Should -Be 'server2'
+                Assert-MockCalled -CommandName Open-ControlMRegistryKey -Times 0 -Exactly -Scope It
+            }
+
+            It 'Should restore the diagnostic settings once the duration has elapsed' {
+
+                $params = @{
+                    diagnostic_level    = 4
+                    communication_trace = $false
+                    diagnostic_duration = 60
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $true
+                $result.diagnostic_revert.remaining_minutes | Should -Be 60
+                $result.diagnostic_revert.settings.diagnostic_level | Should -Be 0
+                $result.diagnostic_revert.settings.communication_trace | Should -Be $true
+                $Revert = $global:Registry[$RegistryPath].ANSIBLE_DIAGNOSTIC_REVERT | ConvertFrom-Json
+                ($Revert.values | Where-Object { $_.name -eq 'DBGLVL' }).value | Should -BeNullOrEmpty
+                ($Revert.values | Where-Object { $_.name -eq 'COMM_TRACE' }).value | Should -Be '1'
+                Assert-MockCalled -CommandName Register-ControlMDiagnosticRevertTask -Times 1 -Exactly -Scope It
+
+                $result = Invoke-AnsibleModule -params @{ job_output_name = 'JOBNAME' }
+                $result.diagnostic_revert.remaining_minutes | Should -BeIn @(59, 60)
+
+                $result = Invoke-AnsibleModule -params @{ diagnostic_level = 2; diagnostic_duration = 120 }
+                $result.diagnostic_revert.remaining_minutes | Should -Be 120
+                $result.diagnostic_revert.settings.diagnostic_level | Should -Be 0
+                Assert-MockCalled -CommandName Register-ControlMDiagnosticRevertTask -Times 2 -Exactly -Scope It
+            }
+
+            It 'Should cancel the restore once the diagnostic settings are changed without a duration' {
+
+                $result = Invoke-AnsibleModule -params @{ diagnostic_level = 4; communication_trace = $false; diagnostic_duration = 60 }
+
+                $result = Invoke-AnsibleModule -params @{ diagnostic_level = 1 }
+                $result.diagnostic_revert.settings.Keys | Should -Be @('communication_trace')
+                Assert-MockCalled -CommandName Unregister-ControlMDiagnosticRevertTask -Times 0 -Exactly -Scope It
+
+                $result = Invoke-AnsibleModule -params @{ communication_trace = $true }
+                $result.ContainsKey('diagnostic_revert') | Should -Be $false
+                $global:Registry[$RegistryPath].ContainsKey('ANSIBLE_DIAGNOSTIC_REVERT') | Should -Be $false
+                $global:Registry["$RegistryPath\CONFIG"].DBGLVL | Should -Be '1'
+                Assert-MockCalled -CommandName Unregister-ControlMDiagnosticRevertTask -Times 1 -Exactly -Scope It
+            }
+
+            It 'Should report the disk space used by the logs and its estimate under the desired retention' {
+
+                $global:Registry["$RegistryPath\CONFIG"].AGENT_DIR = "$TestDrive"
+                New-Item -Path "$TestDrive\proclog\jobs" -ItemType Directory -Force | Out-Null
+                New-Item -Path "$TestDrive\dailylog" -ItemType Directory -Force | Out-Null
+                Set-Content -Path "$TestDrive\proclog\ctmag.log" -Value ('x' * 98) -NoNewline
+                Set-Content -Path "$TestDrive\proclog\jobs\job.log" -Value ('x' * 200) -NoNewline
+                Set-Content -Path "$TestDrive\proclog\jobs\comm.trc" -Value ('x' * 50) -NoNewline
+                Set-Content -Path "$TestDrive\dailylog\daily.log" -Value ('x' * 10) -NoNewline
+                (Get-Item -Path "$TestDrive\proclog\jobs\job.log").LastWriteTimeUtc = [DateTime]::UtcNow.AddDays(-5)
+
+                $result = Invoke-AnsibleModule -params @{ days_to_retain_log_files = 2; report_log_usage = $true }
+                $result.log_usage.truncated | Should -Be $false
+                $result.log_usage.proclog.files | Should -Be 2
+                $result.log_usage.proclog.bytes | Should -Be 298
+                $result.log_usage.proclog.oldest_file_age_days | Should -BeGreaterOrEqual 5
+                $result.log_usage.proclog.retention_days | Should -Be 2
+                $result.log_usage.proclog.estimated_bytes | Should -Be 98
+                $result.log_usage.trace.files | Should -Be 1
+                $result.log_usage.trace.estimated_bytes | Should -Be 50
+                $result.log_usage.dailylog.bytes | Should -Be 10
+                $result.log_usage.dailylog.retention_days | Should -Be 7
+
+                $result = Invoke-AnsibleModule -params @{ communication_trace = $false; report_log_usage = $true }
+                $result.log_usage.trace.bytes | Should -Be 50
+                $result.log_usage.trace.estimated_bytes | Should -Be 0
+
+                $result = Invoke-AnsibleModule -params @{ job_output_name = 'JOBNAME' }
+                $result.ContainsKey('log_usage') | Should -Be $false
+            }
+
+            It 'Should only count the most recent versions of each log file in the estimate' {
+
+                $global:Registry["$RegistryPath\CONFIG"].AGENT_DIR = "$TestDrive\versions"
+                New-Item -Path "$TestDrive\versions\proclog" -ItemType Directory -Force | Out-Null
+                Set-Content -Path "$TestDrive\versions\proclog\ctmag.log" -Value ('x' * 10) -NoNewline
+                Set-Content -Path "$TestDrive\versions\proclog\COMM.TRC" -Value ('x' * 5) -NoNewline
+                foreach ($Version in 1..3) {
+                    Set-Content -Path "$TestDrive\versions\proclog\ctmag.log.$Version" -Value ('x' * 10) -NoNewline
+                    (Get-Item -Path "$TestDrive\versions\proclog\ctmag.log.$Version").LastWriteTimeUtc = [DateTime]::UtcNow.AddHours(-$Version)
+                }
+
+                $result = Invoke-AnsibleModule -params @{ limit_log_version = 1; report_log_usage = $true }
+                $result.log_usage.proclog.files | Should -Be 4
+                $result.log_usage.proclog.bytes | Should -Be 40
+                $result.log_usage.proclog.estimated_bytes | Should -Be 20
+                $result.log_usage.trace.files | Should -Be 1
+            }
+
+            It 'Should make a plan without changing anything, then apply it' {
+
+                $params = @{
+                    agent_to_server_port = 8000
+                    job_output_name      = 'JOBNAME'
+                    mode                 = 'plan'
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $result.changed | Should -Be $true
+                $result.plan.agent.name | Should -Be 'Default'
+                $result.plan.agent.settings.Count | Should -Be 2
+                ($result.plan.agent.settings | Where-Object { $_.option -eq 'agent_to_server_port' }).expected | Should -Be '9000'
+                ($result.plan.agent.settings | Where-Object { $_.option -eq 'agent_to_server_port' }).value | Should -Be '8000'
+                $result.plan.agent.firewall_rules[0].rule | Should -Be 'Control-M Server'
+                $result.plan.agent.firewall_rules[0].after | Should -Be @('8000')
+                $result.plan.agent.restart_required | Should -Be $true
+                $global:Registry["$RegistryPath\CONFIG"].ATCMNDATA | Should -Be '9000'
+                $global:Registry[$RegistryPath].ContainsKey('ANSIBLE_CONFIG_FINGERPRINT') | Should -Be $false
+                Assert-MockCalled -CommandName Open-ControlMRegistryKey -Times 0 -Exactly -Scope It
+                Assert-MockCalled -CommandName Restart-Service -Times 0 -Exactly -Scope It
+
+                $result = Invoke-AnsibleModule -params @{ mode = 'apply'; plan = $result.plan }
+                $result.changed | Should -Be $true
+                $result.restart_required | Should -Be $false
+                $result.diff.before.agent_to_server_port | Should -Be 9000
+                $result.diff.after.agent_to_server_port | Should -Be 8000
+                $result.diff.after.firewall_rules['Control-M Server'].remote_port | Should -Be @('8000')
+                $result.config.job_output_name | Should -Be 'JOBNAME'
+                $global:Registry["$RegistryPath\CONFIG"].ATCMNDATA | Should -Be '8000'
+                $global:Registry["$RegistryPath\WIN"].OUTPUT_NAME | Should -Be 'JOBNAME'
+                Assert-MockCalled -CommandName Get-NetFirewallRule -Times 1 -Exactly -Scope It
+                Assert-MockCalled -CommandName Set-NetFirewallPortFilter -Times 1 -Exactly -Scope It
+                Assert-MockCalled -CommandName Restart-Service -Times 1 -Exactly -Scope It
+            }
+
+            It 'Should reject the plan when the host has drifted since the plan was made' {
+
+                $params = @{
+                    agent_to_server_port = 8000
+                    job_output_name      = 'JOBNAME'
+                    mode                 = 'plan'
+                }
+                $result = Invoke-AnsibleModule -params $params
+                $global:Registry["$RegistryPath\CONFIG"].ATCMNDATA = '9010'
+
+                $ExitHandler = [Ansible.Basic.AnsibleModule]::Exit
+                [Ansible.Basic.AnsibleModule]::Exit = { param([Int32]$rc) throw "exit: $rc" }
+                try {
+                    { Invoke-AnsibleModule -params @{ mode = 'apply'; plan = $result.plan } } | Should -Throw 'exit: 1'
+                }
+                finally {
+                    [Ansible.Basic.AnsibleModule]::Exit = $ExitHandler
+                }
+                $global:Registry["$RegistryPath\CONFIG"].ATCMNDATA | Should -Be '9010'
+                $global:Registry["$RegistryPath\WIN"].OUTPUT_NAME | Should -Be 'MEMNAME'
+                Assert-MockCalled -CommandName Open-ControlMRegistryKey -Times 0 -Exactly -Scope It
+                Assert-MockCalled -CommandName Set-NetFirewallPortFilter -Times 0 -Exactly -Scope It
+            }
         }
     }
 }
 finally {
+    Remove-Variable -Name Registry -Scope Global -ErrorAction SilentlyContinue
     Invoke-TestCleanup
 }
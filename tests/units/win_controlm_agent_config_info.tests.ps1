@@ -0,0 +1,118 @@
+# Set $ErrorActionPreference to what's set during Ansible execution
+$ErrorActionPreference = "Stop"
+
+#Get Current Directory
+$Here = Split-Path -Parent $MyInvocation.MyCommand.Path
+
+.$(Join-Path -Path $Here -ChildPath 'test_utils.ps1')
+
+# Update Pester if needed
+Update-Pester
+
+#Get Function Name
+$moduleName = (Split-Path -Leaf $MyInvocation.MyCommand.Path) -Replace ".Tests.ps1"
+
+#Resolve Path to Module path
+$ansibleModulePath = "$Here\..\..\library\$moduleName.ps1"
+
+Invoke-TestSetup
+
+Function Invoke-AnsibleModule {
+    [CmdletBinding()]
+    Param(
+        [hashtable]$params
+    )
+
+    begin {
+        $global:complex_args = @{
+            "_ansible_check_mode" = $false
+            "_ansible_diff"       = $false
+        } + $params
+    }
+    Process {
+        . $ansibleModulePath
+        return $module.result
+    }
+}
+
+$RegistryPath = 'HKLM:\SOFTWARE\BMC Software\Control-M/Agent'
+$ModuleUtilName = 'Ansible.ModuleUtils.ControlMAgent'
+
+try {
+
+    Describe 'win_controlm_agent_config_info' -Tag 'Get' {
+
+        Context 'Control/M Agent is installed' {
+
+            BeforeAll {
+
+                # The registry is read by the module util, the mock runs in its scope and only sees the global variables
+                Mock -CommandName Get-ItemProperty -ModuleName $ModuleUtilName -ParameterFilter { $Path.StartsWith('HKLM:\SOFTWARE\BMC Software\Control-M/Agent') } -MockWith {
+                    $RegistryValues = $global:Registry["$Path"]
+                    if ($RegistryValues) {
+                        return $RegistryValues.Clone()
+                    }
+                }
+            }
+
+            BeforeEach {
+                $global:Registry = @{
+                    "$RegistryPath"        = @{
+                        DEFAULT_AGENT = 'Default'
+                    }
+                    "$RegistryPath\CONFIG" = @{
+                        ATCMNDATA    = '9000'
+                        CTMSHOST     = 'server2'
+                        COMMOPT      = 'SSL=Y;DUMMY=N'
+                        CODE_VERSION = '9.0.19.200'
+                    }
+                    "$RegistryPath\WIN"    = @{
+                        OUTPUT_NAME = 'JOBNAME'
+                    }
+                }
+            }
+
+            It 'Should return all the settings' {
+
+                $result = Invoke-AnsibleModule -params @{ }
+                $result.changed | Should -Be $false
+                $result.config.agent_to_server_port | Should -Be 9000
+                $result.config.ssl | Should -Be $true
+                $result.config.job_output_name | Should -Be 'JOBNAME'
+                $result.config.default_agent_name | Should -Be 'Default'
+                $result.config.server_to_agent_port | Should -Be 7006
+                Assert-MockCalled -CommandName Get-ItemProperty -ModuleName $ModuleUtilName -Times 3 -Exactly -Scope It
+            }
+
+            It 'Should only read the keys holding the requested settings' {
+
+                $params = @{
+                    keys = @('agent_version', 'primary_controlm_server_host')
+                }
+                $result = Invoke-AnsibleModule -params $params
+                @($result.config.Keys | Sort-Object) | Should -Be @('agent_version', 'primary_controlm_server_host')
+                $result.config.agent_version | Should -Be '9.0.19.200'
+                $result.config.primary_controlm_server_host | Should -Be 'server2'
+                Assert-MockCalled -CommandName Get-ItemProperty -ModuleName $ModuleUtilName -ParameterFilter { $Path.EndsWith('\CONFIG') } -Times 1 -Exactly -Scope It
+                Assert-MockCalled -CommandName Get-ItemProperty -ModuleName $ModuleUtilName -Times 1 -Exactly -Scope It
+            }
+
+            It 'Should fail when the agent is not installed' {
+
+                $global:Registry = @{ }
+                $ExitHandler = [Ansible.Basic.AnsibleModule]::Exit
+                [Ansible.Basic.AnsibleModule]::Exit = { param([Int32]$rc) throw "exit: $rc" }
+                try {
+                    { Invoke-AnsibleModule -params @{ keys = @('agent_version') } } | Should -Throw 'exit: 1'
+                }
+                finally {
+                    [Ansible.Basic.AnsibleModule]::Exit = $ExitHandler
+                }
+            }
+        }
+    }
+}
+finally {
+    Remove-Variable -Name Registry -Scope Global -ErrorAction SilentlyContinue
+    Invoke-TestCleanup
+}
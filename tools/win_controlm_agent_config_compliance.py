@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Informatique CDC. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""Checks Control-M Agent configurations collected from many hosts against a baseline, offline.
+
+The settings, their types and choices are read from the documentation of the
+win_controlm_agent_config module and their ranges from its settings table, with the parser of
+the role module_utils shared with the action plugin. The baseline is compiled once into a list of rules, then the
+configurations are read from JSON lines files, such as the file written by the
+win_controlm_agent_config_report callback plugin, and checked in a single pass. Each record
+holds a host, an optional instance and the config returned by the module, or the instances
+returned by the module. Only the counts of each rule are kept in memory, the violations of
+each record are written as soon as it is checked.
+
+The baseline is a YAML or JSON file. It is either a dictionary of settings, each with the
+expected value or a dictionary of constraints, or a list of rules:
+
+    ssl: yes
+    limit_log_version: {max: 10}
+    tcpip_timeout: {min: 30, max: 120}
+
+    - setting: persistent_connection
+      equals: yes
+      hosts: ['dc1-*', 'dc2-*']
+
+A rule checks one setting with one or more of the equals, in, min, max and pattern constraints.
+With hosts, the rule only applies to the hosts matching one of the shell-style patterns. A record
+which does not report the setting, such as a configuration returned for a subset of the settings,
+is counted as missing for the rule and not as a violation.
+
+Usage: win_controlm_agent_config_compliance.py --baseline baseline.yml [--violations violations.jsonl] configs.jsonl...
+"""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import argparse
+import fnmatch
+import io
+import json
+import os
+import re
+import sys
+
+try:
+    import yaml
+except ImportError:  # The baseline is read as JSON only
+    yaml = None
+
+# The documentation of the module is read by a file of the role module_utils, shared with the action plugin
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module_utils'))
+try:
+    import win_controlm_agent_config_options as documentation
+except ImportError:  # PyYAML is missing
+    documentation = None
+
+STUB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'library', 'win_controlm_agent_config.py')
+
+CONSTRAINTS = ('equals', 'in', 'min', 'max', 'pattern')
+
+STRING_TYPES = (str, type(u''))
+
+TRUE_VALUES = frozenset(['yes', 'on', '1', 'true', 'y'])
+FALSE_VALUES = frozenset(['no', 'off', '0', 'false', 'n'])
+
+
+class BaselineError(ValueError):
+    """Raised when the baseline cannot be compiled against the documented settings."""
+
+
+def load_settings(path=STUB_PATH):
+    """Returns the definition of each setting reported in config by the module.
+
+    Each definition holds the type of the setting and, when documented, its choices, its
+    range (min and max) and its max_length.
+    """
+    if documentation is None:
+        raise BaselineError('PyYAML is required to read the documentation of the module')
+    try:
+        table = documentation.load_settings_table(documented=documentation.load_documented_settings(path))
+        options = documentation.parse_options(documentation.load_stub_variable('DOCUMENTATION', path)['options'], table)
+        config = documentation.load_stub_variable('RETURN', path)['config']['contains']
+    except documentation.DocumentationError as error:
+        raise BaselineError(str(error))
+    settings = {}
+    for name, returned in config.items():
+        option = options.get(name, {})
+        setting = {'type': returned['type']}
+        if option.get('choices'):
+            setting['choices'] = option['choices']
+        for key in ('min', 'max', 'max_length'):
+            if key in option:
+                setting[key] = option[key]
+        settings[name] = setting
+    return settings
+
+
+def convert_value(name, setting, value):
+    """Converts a value of the baseline to the type of the setting, as returned by the module."""
+    if setting['type'] == 'bool':
+        if isinstance(value, bool):
+            return value
+        text = str(value).lower()
+        if text in TRUE_VALUES:
+            return True
+        if text in FALSE_VALUES:
+            return False
+    elif setting['type'] == 'int':
+        if not isinstance(value, bool):
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                pass
+    elif not isinstance(value, (dict, list)):
+        return value if isinstance(value, STRING_TYPES) else str(value)
+    raise BaselineError('The value %r of the "%s" setting is not a %s' % (value, name, setting['type']))
+
+
+def check_documented(name, setting, value):
+    """Fails if a value of the baseline can never be returned for the setting."""
+    if 'choices' in setting and value not in setting['choices']:
+        raise BaselineError('The value %r of the "%s" setting is not one of %s' % (value, name, ', '.join(setting['choices'])))
+    if 'min' in setting and not setting['min'] <= value <= setting['max']:
+        raise BaselineError('The value %r of the "%s" setting is not in the range %d-%d' % (value, name, setting['min'], setting['max']))
+    if 'max_length' in setting and len(value) > setting['max_length']:
+        raise BaselineError('The value %r of the "%s" setting is longer than %d characters' % (value, name, setting['max_length']))
+
+
+def get_rules(baseline):
+    """Returns the baseline as a list of rule dictionaries."""
+    if isinstance(baseline, list):
+        return baseline
+    if not isinstance(baseline, dict):
+        raise BaselineError('The baseline must be a dictionary of settings or a list of rules')
+    rules = []
+    for name, value in baseline.items():
+        rule = dict(value) if isinstance(value, dict) else {'equals': value}
+        rule['setting'] = name
+        rules.append(rule)
+    return rules
+
+
+class Rule:
+    """A compiled rule of the baseline, with the counts of the records it has checked."""
+
+    __slots__ = ('name', 'setting', 'expected', 'hosts', 'test', 'checked', 'violations', 'missing')
+
+    def __init__(self, name, setting, expected, hosts, test):
+        self.name = name
+        self.setting = setting
+        self.expected = expected
+        self.hosts = hosts
+        self.test = test
+        self.checked = 0
+        self.violations = 0
+        self.missing = 0
+
+    def summary(self):
+        return {
+            'rule': self.name,
+            'setting': self.setting,
+            'expected': self.expected,
+            'checked': self.checked,
+            'violations': self.violations,
+            'missing': self.missing,
+        }
+
+
+def compile_test(name, setting, rule):
+    """Returns the function testing a value returned by the module against the constraints of a rule."""
+    tests = []
+    if 'equals' in rule:
+        equals = convert_value(name, setting, rule['equals'])
+        check_documented(name, setting, equals)
+        tests.append(lambda value: value == equals)
+    if 'in' in rule:
+        if not isinstance(rule['in'], list):
+            raise BaselineError('The "in" constraint of the "%s" setting must be a list' % name)
+        allowed = [convert_value(name, setting, value) for value in rule['in']]
+        for value in allowed:
+            check_documented(name, setting, value)
+        allowed = frozenset(allowed)
+        tests.append(lambda value: value in allowed)
+    if 'min' in rule or 'max' in rule:
+        if setting['type'] != 'int':
+            bound = 'min' if 'min' in rule else 'max'
+            raise BaselineError('The "%s" constraint cannot be used with the %s setting "%s"' % (bound, setting['type'], name))
+        low = convert_value(name, setting, rule['min']) if 'min' in rule else float('-inf')
+        high = convert_value(name, setting, rule['max']) if 'max' in rule else float('inf')
+        tests.append(lambda value: isinstance(value, int) and low <= value <= high)
+    if 'pattern' in rule:
+        if setting['type'] != 'str':
+            raise BaselineError('The "pattern" constraint cannot be used with the %s setting "%s"' % (setting['type'], name))
+        try:
+            pattern = re.compile(rule['pattern'])
+        except re.error as error:
+            raise BaselineError('The pattern of the "%s" setting is not valid: %s' % (name, error))
+        tests.append(lambda value: isinstance(value, STRING_TYPES) and pattern.match(value) is not None)
+
+    if not tests:
+        raise BaselineError('The rule of the "%s" setting has none of the %s constraints' % (name, ', '.join(CONSTRAINTS)))
+    if len(tests) == 1:
+        return tests[0]
+
+    def test_all(value):
+        for test in tests:
+            if not test(value):
+                return False
+        return True
+    return test_all
+
+
+def compile_rules(baseline, settings):
+    """Compiles a baseline into a list of rules, failing on any setting or value the module cannot return."""
+    rules = []
+    for index, rule in enumerate(get_rules(baseline)):
+        if not isinstance(rule, dict) or 'setting' not in rule:
+            raise BaselineError('The rule %d of the baseline does not define a setting' % (index + 1))
+        name = rule['setting']
+        if name not in settings:
+            raise BaselineError('The baseline contains the unknown setting "%s"' % name)
+        unknown = sorted(set(rule) - set(CONSTRAINTS) - set(['setting', 'hosts', 'name']))
+        if unknown:
+            raise BaselineError('The rule of the "%s" setting contains the unknown keys %s' % (name, ', '.join(unknown)))
+
+        hosts = rule.get('hosts')
+        if isinstance(hosts, STRING_TYPES):
+            hosts = [hosts]
+        host_pattern = None
+        if hosts:
+            host_pattern = re.compile('|'.join('(?:%s)' % fnmatch.translate(host) for host in hosts))
+        expected = dict((key, rule[key]) for key in CONSTRAINTS if key in rule)
+        rule_name = rule.get('name') or (name if not hosts else '%s[%s]' % (name, ','.join(hosts)))
+        rules.append(Rule(rule_name, name, expected, host_pattern, compile_test(name, settings[name], rule)))
+    return rules
+
+
+def load_baseline(path):
+    """Loads a baseline from a YAML or JSON file."""
+    with io.open(path, 'r', encoding='utf-8') as baseline:
+        if yaml is not None:
+            return yaml.safe_load(baseline) or {}
+        return json.load(baseline)
+
+
+def iter_configs(lines):
+    """Yields the host, instance and configuration of each record of JSON lines."""
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        host = record.get('host')
+        if isinstance(record.get('instances'), dict):
+            for instance, result in record['instances'].items():
+                yield host, instance, result.get('config') or {}
+        else:
+            yield host, record.get('instance'), record.get('config') or {}
+
+
+class Evaluation:
+    """Checks configurations against compiled rules and counts the results."""
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.records = 0
+        self.violating_records = 0
+        # The rules sharing the same hosts are matched once per record
+        self.scopes = {}
+        for rule in rules:
+            key = rule.hosts.pattern if rule.hosts else None
+            self.scopes.setdefault(key, (rule.hosts, []))[1].append(rule)
+
+    def check(self, host, instance, config):
+        """Checks a configuration and returns its violations."""
+        self.records += 1
+        violations = []
+        for hosts, rules in self.scopes.values():
+            if hosts is not None and (host is None or not hosts.match(host)):
+                continue
+            for rule in rules:
+                rule.checked += 1
+                if rule.setting not in config:
+                    rule.missing += 1
+                elif not rule.test(config[rule.setting]):
+                    rule.violations += 1
+                    violations.append({'rule': rule.name, 'setting': rule.setting, 'value': config[rule.setting], 'expected': rule.expected})
+        if violations:
+            self.violating_records += 1
+        return violations
+
+    def run(self, lines, output=None):
+        """Checks the records of JSON lines, writing a line per violating record to output."""
+        for host, instance, config in iter_configs(lines):
+            violations = self.check(host, instance, config)
+            if violations and output is not None:
+                output.write(json.dumps({'host': host, 'instance': instance, 'violations': violations}, sort_keys=True) + '\n')
+        return self.summary()
+
+    def summary(self):
+        return {
+            'records': self.records,
+            'violating_records': self.violating_records,
+            'rules': [rule.summary() for rule in self.rules],
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Checks Control-M Agent configurations against a baseline.')
+    parser.add_argument('configs', nargs='*', default=['-'], help='JSON lines files of configurations, - for the standard input')
+    parser.add_argument('--baseline', required=True, help='YAML or JSON file of the baseline')
+    parser.add_argument('--violations', help='JSON lines file where the violations of each record are written, the standard output by default')
+    parser.add_argument('--summary', help='JSON file where the counts of each rule are written, the standard error by default')
+    parser.add_argument('--documentation', default=STUB_PATH, help='documentation stub of the win_controlm_agent_config module')
+    args = parser.parse_args(argv)
+
+    try:
+        rules = compile_rules(load_baseline(args.baseline), load_settings(args.documentation))
+    except BaselineError as error:
+        parser.exit(2, '%s: error: %s\n' % (parser.prog, error))
+
+    evaluation = Evaluation(rules)
+    output = io.open(args.violations, 'w', encoding='utf-8') if args.violations else sys.stdout
+    try:
+        for path in args.configs:
+            if path == '-':
+                evaluation.run(sys.stdin, output)
+            else:
+                with io.open(path, 'r', encoding='utf-8') as lines:
+                    evaluation.run(lines, output)
+    finally:
+        if args.violations:
+            output.close()
+
+    summary = json.dumps(evaluation.summary(), indent=2, sort_keys=True)
+    if args.summary:
+        with io.open(args.summary, 'w', encoding='utf-8') as summary_file:
+            summary_file.write(summary + '\n')
+    else:
+        sys.stderr.write(summary + '\n')
+    return 1 if evaluation.violating_records else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())